@@ -7,7 +7,6 @@ Algorithm originally from here: https://github.com/jradavenport/FBEYE
 '''
 
 import numpy as np
-from scipy.stats import binned_statistic
 
 def aflare(t, p):
     """
@@ -22,6 +21,9 @@ def aflare(t, p):
     a fixed number of free parameters. Instead, for fitting a single peak
     use the aflare1 method.
 
+    For many peaks, aflare_fast gives the same model much faster, and
+    aflare_jac its derivatives for gradient based fitting.
+
     Parameters
     ----------
     t : 1-d array
@@ -78,9 +80,11 @@ def aflare1(t, tpeak, fwhm, ampl, upsample=False, uptime=10):
     ampl : float
         The amplitude of the flare
     upsample : bool
-        If True up-sample the model flare to ensure more precise energies.
+        If True average the model flare over each exposure (the median time
+        between points) to ensure more precise energies. See aflare1_binned
     uptime : float
-        How many times to up-sample the data (Default is 10)
+        Not used any more, the exposure average is now exact (this used
+        to be how many times to up-sample the data)
 
     Returns
     -------
@@ -91,31 +95,9 @@ def aflare1(t, tpeak, fwhm, ampl, upsample=False, uptime=10):
     _fd = [0.689008, -1.60053, 0.302963, -0.278318]
 
     if upsample:
+        # the exact average over each exposure, no need to actually upsample
         dt = np.nanmedian(np.diff(t))
-        timeup = np.linspace(min(t)-dt, max(t)+dt, t.size * uptime)
-
-        flareup = np.piecewise(timeup, [(timeup<= tpeak) * (timeup-tpeak)/fwhm > -1.,
-                                        (timeup > tpeak)],
-                                    [lambda x: (_fr[0]+                       # 0th order
-                                                _fr[1]*((x-tpeak)/fwhm)+      # 1st order
-                                                _fr[2]*((x-tpeak)/fwhm)**2.+  # 2nd order
-                                                _fr[3]*((x-tpeak)/fwhm)**3.+  # 3rd order
-                                                _fr[4]*((x-tpeak)/fwhm)**4. ),# 4th order
-                                     lambda x: (_fd[0]*np.exp( ((x-tpeak)/fwhm)*_fd[1] ) +
-                                                _fd[2]*np.exp( ((x-tpeak)/fwhm)*_fd[3] ))]
-                                    ) * np.abs(ampl) # amplitude
-
-        # and now downsample back to the original time...
-        ## this way might be better, but makes assumption of uniform time bins
-        # flare = np.nanmean(flareup.reshape(-1, uptime), axis=1)
-
-        ## This way does linear interp. back to any input time grid
-        # flare = np.interp(t, timeup, flareup)
-
-        ## this was uses "binned statistic"
-        downbins = np.concatenate((t-dt/2.,[max(t)+dt/2.]))
-        flare,_,_ = binned_statistic(timeup, flareup, statistic='mean',
-                                 bins=downbins)
+        flare = aflare1_binned(t, tpeak, fwhm, ampl, exptime=dt)
 
     else:
         flare = np.piecewise(t, [(t<= tpeak) * (t-tpeak)/fwhm > -1.,
@@ -129,4 +111,270 @@ def aflare1(t, tpeak, fwhm, ampl, upsample=False, uptime=10):
                                             _fd[2]*np.exp( ((x-tpeak)/fwhm)*_fd[3] ))]
                                 ) * np.abs(ampl) # amplitude
 
-    return flare
\ No newline at end of file
+    return flare
+
+
+# the aflare1 decay never reaches zero, but by this many FWHM after the
+# peak it is < 1e-12 of the amplitude. Used to only evaluate flares where
+# they matter
+DECAY_FWHM = 100.
+
+
+def _aflare1_cumulative(x):
+    '''
+    The integral of the (unit amplitude, unit FWHM) aflare1 template from
+    -infinity to x, where x = (t - tpeak) / fwhm
+    '''
+    _fr = [1.00000, 1.94053, -0.175084, -2.24588, -1.12498]
+    _fd = [0.689008, -1.60053, 0.302963, -0.278318]
+
+    x = np.asarray(x, dtype='float')
+
+    # the rise, a polynomial from x=-1 to 0. Its integral is another
+    # polynomial (highest order first for polyval), zero at x=-1
+    xr = np.clip(x, -1., 0.)
+    rpoly = np.append([_fr[n] / (n+1.) for n in range(len(_fr)-1, -1, -1)], 0.)
+    rise = np.polyval(rpoly, xr) - np.polyval(rpoly, -1.)
+
+    # the decay, 2 exponentials from x=0 on
+    xd = np.clip(x, 0., None)
+    decay = (_fd[0] / _fd[1] * (np.exp(_fd[1] * xd) - 1.) +
+             _fd[2] / _fd[3] * (np.exp(_fd[3] * xd) - 1.))
+
+    return rise + decay
+
+
+def aflare1_integral(t0, t1, tpeak, fwhm, ampl):
+    '''
+    The exact integral of aflare1 between times t0 and t1, i.e. the area
+    under the flare in (time units) x (flux units). All the inputs can be
+    arrays, e.g. the start & end of each exposure.
+    '''
+    fwhm = np.asarray(fwhm, dtype='float')
+    return (_aflare1_cumulative((np.asarray(t1) - tpeak) / fwhm) -
+            _aflare1_cumulative((np.asarray(t0) - tpeak) / fwhm)) * fwhm * np.abs(ampl)
+
+
+def aflare1_ed(fwhm, ampl, tpeak=0., tmin=-np.inf, tmax=np.inf):
+    '''
+    The Equivalent Duration of an aflare1 flare, from the exact integral
+    of the template instead of summing it over the sampled light curve,
+    so it does not depend on the cadence.
+
+    Parameters
+    ----------
+    fwhm : float or array
+        The "Full Width at Half Maximum", in DAYS
+    ampl : float or array
+        The amplitude, in RELATIVE FLUX
+    tpeak : float or array, optional
+        The time of the flare peak, only needed with tmin/tmax
+    tmin, tmax : float, optional
+        Only count the part of the flare between these times, e.g. the
+        ends of the light curve (Default is the whole flare)
+
+    Returns
+    -------
+    ED in SECONDS, like appaloosa.EquivDur
+    '''
+    return aflare1_integral(tmin, tmax, tpeak, fwhm, ampl) * 60.0 * 60.0 * 24.0
+
+
+def aflare1_binned(t, tpeak, fwhm, ampl, exptime=None):
+    '''
+    aflare1 averaged over each exposure, [t - exptime/2, t + exptime/2],
+    computed exactly from the integral of the template (aflare1_integral).
+    This is what a long (e.g. 30 min Kepler) cadence actually measures, at
+    about the cost of aflare1 itself. Works with curve_fit like aflare1.
+
+    Parameters
+    ----------
+    t : 1-d array
+        The time array (middle of each exposure)
+    tpeak, fwhm, ampl : float
+        As in aflare1
+    exptime : float or 1-d array, optional
+        The exposure time(s), same units as t. Default is the median time
+        between points
+
+    Returns
+    -------
+    flare : 1-d array
+        The mean flux of the flare model in each exposure
+    '''
+    t = np.asarray(t, dtype='float')
+    if exptime is None:
+        exptime = np.nanmedian(np.diff(t))
+
+    # one pass over both ends of every exposure
+    n = len(t)
+    edges = np.concatenate((t - exptime / 2., t + exptime / 2.))
+    cum = _aflare1_cumulative((edges - tpeak) / fwhm)
+    return (cum[n:] - cum[:n]) * fwhm * np.abs(ampl) / exptime
+
+
+def aflare_binned(t, p, exptime=None):
+    '''
+    The exposure averaged version of aflare, for any number of peaks.
+    See aflare1_binned
+
+    Parameters
+    ----------
+    t : 1-d array
+        The time array (middle of each exposure)
+    p : 1-d array
+        p == [tpeak, fwhm (units of time), amplitude (units of flux)] x N
+    exptime : float or 1-d array, optional
+        Default is the median time between points
+    '''
+    t = np.asarray(t, dtype='float')
+    if exptime is None:
+        exptime = np.nanmedian(np.diff(t))
+
+    Nflare = int( np.floor( (len(p)/3.0) ) )
+
+    flare = np.zeros_like(t)
+    for i in range(Nflare):
+        flare = flare + aflare1_binned(t, p[0+i*3], p[1+i*3], p[2+i*3], exptime=exptime)
+
+    return flare
+
+
+# the template coefficients, as used in aflare & aflare1
+_FR = [1.00000, 1.94053, -0.175084, -2.24588, -1.12498]
+_FD = [0.689008, -1.60053, 0.302963, -0.278318]
+
+
+def _support(t, p):
+    # the (N, 3) parameters, and every (time index, flare index) pair where
+    # each flare is non-zero, i.e. from tpeak - fwhm to DECAY_FWHM after
+    p = np.asarray(p, dtype='float')
+    p = p.ravel()[0:int(np.floor(p.size / 3.0)) * 3].reshape(-1, 3)
+
+    i0 = np.searchsorted(t, p[:, 0] - np.abs(p[:, 1]))
+    i1 = np.searchsorted(t, p[:, 0] + DECAY_FWHM * np.abs(p[:, 1]))
+    nwin = i1 - i0
+
+    comp = np.repeat(np.arange(p.shape[0]), nwin)
+    first = np.cumsum(nwin) - nwin
+    idx = i0[comp] + np.arange(comp.size) - first[comp]
+    return p, idx, comp
+
+
+def _template(x):
+    # the unit flare and its derivative, at x = (t - tpeak) / fwhm
+    rise = (x > -1.) & (x <= 0.)
+    decay = x > 0.
+
+    g = np.zeros_like(x)
+    dg = np.zeros_like(x)
+
+    xr = x[rise]
+    g[rise] = _FR[0] + xr * (_FR[1] + xr * (_FR[2] + xr * (_FR[3] + xr * _FR[4])))
+    dg[rise] = _FR[1] + xr * (2. * _FR[2] + xr * (3. * _FR[3] + xr * 4. * _FR[4]))
+
+    xd = x[decay]
+    e1 = _FD[0] * np.exp(_FD[1] * xd)
+    e2 = _FD[2] * np.exp(_FD[3] * xd)
+    g[decay] = e1 + e2
+    dg[decay] = _FD[1] * e1 + _FD[3] * e2
+    return g, dg
+
+
+def aflare_fast(t, p):
+    '''
+    The same model as aflare, for any number of peaks, without looping
+    over them: every flare is evaluated at once, and only on the part of
+    the time array where it is non-zero (see DECAY_FWHM).
+
+    Parameters
+    ----------
+    t : 1-d array
+        The time array, must be sorted
+    p : array
+        The flare parameters, either [tpeak, fwhm, amplitude] x N like
+        aflare, or an (N, 3) array
+
+    Returns
+    -------
+    flare : 1-d array
+        The flux of the flare model evaluated at each time
+    '''
+    t = np.asarray(t, dtype='float')
+    p, idx, comp = _support(t, p)
+
+    x = (t[idx] - p[comp, 0]) / p[comp, 1]
+    g, _ = _template(x)
+
+    return np.bincount(idx, weights=g * p[comp, 2], minlength=t.size)
+
+
+def aflare_jac(t, p, sparse=False):
+    '''
+    The analytic Jacobian of aflare_fast, i.e. the derivative of the model
+    at each time with respect to each parameter. For gradient based fitting
+    of complex flares, e.g. scipy.optimize.least_squares(..., jac=...)
+
+    Parameters
+    ----------
+    t : 1-d array
+        The time array, must be sorted
+    p : array
+        The flare parameters, as in aflare_fast
+    sparse : bool, optional
+        Return a scipy.sparse matrix, since each flare only covers part of
+        the light curve (Default is False, a dense array)
+
+    Returns
+    -------
+    (len(t), 3N) array, the columns in the order of p:
+    d/dtpeak, d/dfwhm, d/damplitude for each flare
+    '''
+    t = np.asarray(t, dtype='float')
+    p, idx, comp = _support(t, p)
+
+    x = (t[idx] - p[comp, 0]) / p[comp, 1]
+    g, dg = _template(x)
+
+    # f = A g(x), x = (t - tpeak) / fwhm
+    d_tpeak = -p[comp, 2] * dg / p[comp, 1]
+    d_fwhm = -p[comp, 2] * dg * x / p[comp, 1]
+    d_ampl = g
+
+    rows = np.concatenate((idx, idx, idx))
+    cols = np.concatenate((comp * 3, comp * 3 + 1, comp * 3 + 2))
+    vals = np.concatenate((d_tpeak, d_fwhm, d_ampl))
+
+    if sparse:
+        from scipy.sparse import csr_matrix
+        return csr_matrix((vals, (rows, cols)), shape=(t.size, p.shape[0] * 3))
+
+    jac = np.zeros((t.size, p.shape[0] * 3))
+    jac[rows, cols] = vals
+    return jac
+
+
+def aflare1_binned_jac(t, tpeak, fwhm, ampl, exptime=None):
+    '''
+    The analytic Jacobian of aflare1_binned (for ampl >= 0)
+
+    Returns
+    -------
+    (len(t), 3) array: d/dtpeak, d/dfwhm, d/dampl
+    '''
+    t = np.asarray(t, dtype='float')
+    if exptime is None:
+        exptime = np.nanmedian(np.diff(t))
+
+    n = len(t)
+    x = (np.concatenate((t - exptime / 2., t + exptime / 2.)) - tpeak) / fwhm
+    cum = _aflare1_cumulative(x)
+    g, _ = _template(x)
+
+    # model = A fwhm (C(x1) - C(x0)) / exptime, and dC/dx = g
+    dcum = cum[n:] - cum[:n]
+    d_tpeak = ampl * (g[:n] - g[n:]) / exptime
+    d_fwhm = ampl * (dcum - (x[n:] * g[n:] - x[:n] * g[:n])) / exptime
+    d_ampl = fwhm * dcum / exptime
+
+    return np.column_stack((d_tpeak, d_fwhm, d_ampl))
@@ -6,32 +6,28 @@ script to carry out flare finding in Kepler LC's
 import numpy as np
 import os.path
 from os.path import expanduser
-import time
 import datetime
 from version import __version__
-from aflare import aflare1
+from aflare import aflare1, aflare1_ed, DECAY_FWHM
 import detrend
-from gatspy.periodic import LombScargleFast
+import rayleigh
+import lccache
+import lcsource
+import instrument
+import runlength
+import modelstore
+import flarefit
+from atomic import AtomicFile
+from lcio import GetLCfits, GetLCvdb, GetLCeverest, GetLCtxt
 import warnings
-import matplotlib.pyplot as plt
 import pandas as pd
-from scipy import stats
-from scipy.optimize import curve_fit
-from scipy.signal import wiener
-from scipy import signal
-from astropy.io import fits
-import matplotlib
 import glob
-matplotlib.rcParams.update({'font.size':18})
-matplotlib.rcParams.update({'font.family':'serif'})
-from scipy.signal import savgol_filter
 
-# from rayleigh import RayleighPowerSpectrum
-try:
-    import MySQLdb
-    haz_mysql = True
-except ImportError:
-    haz_mysql = False
+# NOTE: the heavier dependencies (scipy.stats, scipy.signal, scipy.optimize,
+# gatspy, astropy, matplotlib, MySQLdb) are imported inside the functions
+# that use them, so the headless detection path starts up quickly.
+# Plotting lives in plotting.py, file formats in lcio.py,
+# and the database in lcsource.py
 
 
 def chisq(data, error, model):
@@ -42,9 +38,21 @@ def chisq(data, error, model):
     return np.sum( ((data - model) / error)**2.0 ) / np.size(data)
 
 
+# the database connection is kept open and re-used for every light curve
+# fetched in this process, see lcsource.py
+_lcsource = None
+
+
+def _DefaultSource():
+    global _lcsource
+    if _lcsource is None:
+        _lcsource = lcsource.MySQLSource('auth.txt')
+    return _lcsource
+
+
 def GetLCdb(objectid, type='', readfile=False,
           savefile=False, exten = '.lc.gz',
-          onecadence=False):
+          onecadence=False, source=None):
     '''
     Retrieve the lightcurve/data from the UW database.
 
@@ -63,6 +71,10 @@ def GetLCdb(objectid, type='', readfile=False,
     onecadence : bool, optional
         For quarters with Long and Short cadence, remove the Long data.
         Default is False. Can be done later to the data output
+    source : lcsource.LCSource, optional
+        Where to get the data from. Default is the UW MySQL database, using
+        the credentials in "auth.txt". Use lcsource.SQLiteSource for a
+        local copy of the database.
 
     Returns
     -------
@@ -71,71 +83,49 @@ def GetLCdb(objectid, type='', readfile=False,
         SAP_QUALITY, LCFLAG, SAP_FLUX, SAP_FLUX_ERR
     '''
 
-    isok = 0 # a flag to check if database returned sensible answer
-    ntry = 0
+    data = None
 
     if readfile is True:
         # attempt to find file in working dir
         if os.path.isfile(str(objectid) + exten):
             data = np.loadtxt(str(objectid) + exten)
-            isok = 101
-
-
-    while isok<1:
-        # this holds the keys to the db... don't put on github!
-        auth = np.loadtxt('auth.txt', dtype='string')
-
-        # connect to the db
-        db = MySQLdb.connect(passwd=auth[2], db="Kepler",
-                             user=auth[1], host=auth[0])
 
-        query = 'SELECT QUARTER, TIME, PDCSAP_FLUX, PDCSAP_FLUX_ERR, ' +\
-                'SAP_QUALITY, LCFLAG, SAP_FLUX, SAP_FLUX_ERR ' +\
-                'FROM Kepler.source WHERE KEPLERID=' + str(objectid)
+    if data is None:
+        data = GetLCdbBatch([objectid], type=type, source=source)[int(objectid)]
 
-        # only get SLC or LLC data if requested
-        if type=='slc':
-            query = query + ' AND LCFLAG=0 '
-        if type=='llc':
-            query = query + ' AND LCFLAG=1 '
+    if onecadence is True:
+        data = data[OneCadence(data, returnmask=True)]
 
-        query = query + ' ORDER BY TIME;'
+    if savefile is True:
+        # output a file in working directory
+        np.savetxt(str(objectid) + exten, data)
 
-        # make a cursor to the db
-        cur = db.cursor()
-        cur.execute(query)
+    return data
 
-        # get all the data
-        rows = cur.fetchall()
 
-        # convert to numpy data array
-        data = np.asarray(rows)
+def GetLCdbBatch(objectids, type='', onecadence=False, source=None):
+    '''
+    Retrieve the lightcurves for many objects from the database at once,
+    using as few queries as possible. See GetLCdb for the parameters.
 
-        # close the cursor to the db
-        cur.close()
+    Returns
+    -------
+    dict of numpy arrays (same columns as GetLCdb), keyed by int(objectid)
+    '''
+    if source is None:
+        source = _DefaultSource()
 
-        # make sure the database returned the actual light curve
-        if len(data[:,0] > 99):
-            isok = 10
-        # only try 10 times... shouldn't ever need this limit
-        if ntry > 9:
-            isok = 2
-        ntry = ntry + 1
-        time.sleep(10) # give the database a breather
+    lcs = source.fetch(objectids, type=type)
 
     if onecadence is True:
-        data_raw = data.copy()
-        data = OneCadence(data_raw)
+        for k in lcs:
+            lcs[k] = OneCadence(lcs[k])
 
-    if savefile is True:
-        # output a file in working directory
-        np.savetxt(str(objectid) + exten, data)
+    return lcs
 
-    return data
 
 
-
-def Get(mode, file, objectid, win_size=3):
+def Get(mode, file, objectid, win_size=3, cachedir='', ftype='sap'):
     
     '''
     
@@ -150,7 +140,10 @@ def Get(mode, file, objectid, win_size=3):
     mode: type of light curve, e.g. EVEREST LC, 
           Vanderburg LC, raw MAST .fits file etc.
     win_size: window size for scatter generator
-    
+    cachedir: if set, directory for the on-disk cache of cleaned
+              light curves (see lccache.py). Default is no cache
+    ftype: flux type to read from MAST .fits files, 'sap' or 'pdc'
+
     Returns:
     ------------
     lc: light curve DataFrame
@@ -208,6 +201,12 @@ def Get(mode, file, objectid, win_size=3):
         elif mode in ('txt','ktwo'):
             return file
 
+    if cachedir != '':
+        key = lccache.CacheKey(file, mode, win_size=win_size, ftype=ftype)
+        cached = lccache.CacheLoad(cachedir, key)
+        if cached is not None:
+            return (GetOutfile(mode, file), GetObjectID(mode)) + cached
+
     modes = {'fits': GetLCfits,
              'ktwo': GetLCfits, 
              'vdb': GetLCvdb, 
@@ -215,7 +214,10 @@ def Get(mode, file, objectid, win_size=3):
              'txt': GetLCtxt, 
              'csv': GetLCvdb}
     
-    lc = modes[mode](file).dropna(how='any')
+    if mode in ('fits', 'ktwo'):
+        lc = modes[mode](file, ftype=ftype).dropna(how='any')
+    else:
+        lc = modes[mode](file).dropna(how='any')
 
     t = lc.time.values
     dt = np.nanmedian(t[1:] - t[0:-1])
@@ -233,96 +235,15 @@ def Get(mode, file, objectid, win_size=3):
     if 'error' not in lc.columns:
         lc['error'] = np.nanmedian(lc.flux_raw.rolling(win_size, center=True).std())
 
-    return GetOutfile(mode, file), GetObjectID(mode), np.array(lc.qtr), np.array(lc.time), np.array(lc.quality), np.array(lc.exptime), np.array(lc.flux_raw), np.array(lc.error)
-        
-def GetLCfits(file):
-    
-    '''
-    Parameters
-    ----------
-    file : light curve file location for a MAST archive .fits file
-
-    Returns
-    -------
-    lc: light curve DataFrame with columns [time, quality, flux_raw, error]
-    '''
-
-    hdu = fits.open(file)
-    data_rec = hdu[1].data
-    lc = pd.DataFrame({'time':data_rec['TIME'].byteswap().newbyteorder(),
-                      'flux_raw':data_rec['SAP_FLUX'].byteswap().newbyteorder(),
-                      'error':data_rec['SAP_FLUX_ERR'].byteswap().newbyteorder(),
-                      'quality':data_rec['SAP_QUALITY'].byteswap().newbyteorder()})
-    
-
-    return lc
-
-
-def GetLCvdb(file):
+    out = (np.array(lc.qtr), np.array(lc.time), np.array(lc.quality),
+           np.array(lc.exptime), np.array(lc.flux_raw), np.array(lc.error))
 
-    '''
-    Parameters
-    ----------
-    file : light curve file location for a Vanderburg de-trended .txt file
+    if cachedir != '':
+        lccache.CacheSave(cachedir, key, *out)
 
-    Returns
-    -------
-    lc: light curve DataFrame with columns [time, flux_raw]
-    '''
-    
-    lc = pd.read_csv(file,index_col=False)
-    lc.rename(index=str, 
-              columns={'BJD - 2454833': 'time',' Corrected Flux':'flux_raw'},
-              inplace=True,
-              )
-    return lc
-
-
-def GetLCeverest(file):
-    
-    '''
-    Parameters
-    ----------
-    file : light curve file location for a Vanderburg de-trended .txt file
-
-    Returns
-    -------
-    lc: light curve DataFrame with columns [time, flux_raw]
-    '''
-    
-    hdu = fits.open(file)
-    data_rec = hdu[1].data
-    lc = pd.DataFrame({'time':np.array(data_rec['TIME']).byteswap().newbyteorder(),
-                      'flux_raw':np.array(data_rec['FLUX']).byteswap().newbyteorder(),})
-    #keep the outliers... for now
-    #lc['quality'] = data_rec['OUTLIER'].byteswap().newbyteorder()
-  
-    return lc
-
-
-def GetLCtxt(file):
-
-    '''
-    Parameters
-    ----------
-    file : light curve file location for a basic .txt file
-
-    Returns
-    -------
-    lc: light curve DataFrame with columns [time, flux_raw, error]
-    '''
-    
-    lc = pd.read_csv(file,
-                     index_col=False,
-                     usecols=(0,1,2),
-                     skiprows=1,
-                     header = None,
-                     names = ['time','flux_raw','error'])
+    return (GetOutfile(mode, file), GetObjectID(mode)) + out
         
-    return lc
-
-
-def OneCadence(data):
+def OneCadence(data, returnmask=False):
     '''
     Within each quarter of data from the database, pick the data with the
     fastest cadence. We want to study 1-min if available. Don't want
@@ -332,31 +253,34 @@ def OneCadence(data):
     ----------
     data : numpy array
         the result from MySQL database query, using the getLC() function
+    returnmask : bool, optional
+        If True, return a boolean array (True = keep) instead of the
+        filtered data. Lets callers pick out only the columns they need.
+        (Default is False)
 
     Returns
     -------
-    Data array
+    Data array, or the boolean mask if returnmask=True.
+    Rows keep their original (time) order.
 
     '''
-    # get the unique quarters
-    qtr = data[:,0]
+    # quarters are integers, but careful w/ floats
+    qtr = np.round(data[:,0])
     cadence = data[:,5]
-    uQtr = np.unique(qtr)
-
-    indx = []
-
-    # for each quarter, is there more than one cadence?
-    for q in uQtr:
-        x = np.where( (np.abs(qtr-q) < 0.1) )
 
-        etimes = np.unique(cadence[x])
-        y = np.where( (cadence[x] == min(etimes)) )
+    # sort once by (quarter, cadence). The first entry of each quarter is
+    # then the fastest cadence observed in that quarter
+    srt = np.lexsort((cadence, qtr))
+    _, first, inv = np.unique(qtr[srt], return_index=True, return_inverse=True)
+    fastest = cadence[srt][first]
 
-        indx = np.append(indx, x[0][y])
+    ok = np.zeros(len(qtr), dtype='bool')
+    ok[srt] = (cadence[srt] == fastest[np.ravel(inv)])
 
-    indx = np.array(indx, dtype='int')
+    if returnmask is True:
+        return ok
 
-    data_out = data[indx,:]
+    data_out = data[ok,:]
     return data_out
 
 def func_specific(wert):
@@ -403,15 +327,10 @@ def DetectCandidate(time, flux, error, flags, model,
     cand1 = np.where((chi >= error_cut) & (bad < 1))[0]
 
     _, dl, dr = detrend.FindGaps(time) # find edges of time windows
-    for i in range(0, len(dl)):
-        x1 = np.where((np.abs(time[cand1]-time[dr[i]-1]) < gapwindow))
-        x2 = np.where((np.abs(time[cand1]-time[dl[i]]) < gapwindow))
-        cand1 = np.delete(cand1, x1)
-        cand1 = np.delete(cand1, x2)
+    cand1 = detrend.GapGuard(time, cand1, gapwindow=gapwindow, dl=dl, dr=dr)
 
     # find start and stop index, combine neighboring candidates in to same events
-    cstart = cand1[np.append([0], np.where((cand1[1:]-cand1[:-1] > minsep))[0]+1)]
-    cstop = cand1[np.append(np.where((cand1[1:]-cand1[:-1] > minsep))[0], [len(cand1)-1])]
+    cstart, cstop = runlength.GroupIndices(cand1, minsep=minsep)
 
     # for now just return index of candidates
     if returnall is True:
@@ -422,7 +341,7 @@ def DetectCandidate(time, flux, error, flags, model,
 
 def FINDflare(flux, error, N1=3, N2=1, N3=3,
               avg_std=False, std_window=7,
-              returnbinary=False, debug=False):
+              returnbinary=False, debug=False, sigma=None):
     '''
     The algorithm for local changes due to flares defined by
     S. W. Chang et al. (2015), Eqn. 3a-d
@@ -463,6 +382,10 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
         Should code return the start and stop indicies of flares (default,
         set to False) or a binary array where 1=flares (set to True)
         (Not part of original algorithm)
+    sigma : float, optional
+        Use this as the stddev of the data, instead of measuring it. e.g.
+        for data already in units of sigma (Default is None)
+        (Not part of original algorithm)
     '''
 
     med_i = np.nanmedian(flux)
@@ -470,7 +393,9 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
     if debug is True:
         print("DEBUG: med_i = " + str(med_i))
 
-    if avg_std is False:
+    if sigma is not None:
+        sig_i = sigma
+    elif avg_std is False:
         sig_i = np.nanstd(flux) # just the stddev of the window
     else:
         # take the average of the rolling stddev in the window.
@@ -490,36 +415,112 @@ def FINDflare(flux, error, N1=3, N2=1, N3=3,
         print(sum(cc>N2))
 
     # pass cuts from Eqns 3a,b,c
-    ctmp = np.where((ca > 0) & (cb > N1) & (cc > N2))
+    cindx = (ca > 0) & (cb > N1) & (cc > N2)
 
-    cindx = np.zeros_like(flux)
-    cindx[ctmp] = 1
+    # the old reverse-counting loop never flagged the first or last point,
+    # keep it that way so the same flares are found
+    if len(cindx) > 0:
+        cindx[0] = False
+        cindx[-1] = False
 
-    # Need to find cumulative number of points that pass "ctmp"
-    # Count in reverse!
-    ConM = np.zeros_like(flux)
-    # this requires a full pass thru the data -> bottleneck
-    for k in range(2, len(flux)):
-        ConM[-k] = cindx[-k] * (ConM[-(k-1)] + cindx[-k])
+    # flares are runs of at least N3 consecutive points that pass the cuts
+    istart_i, istop_i, _ = runlength.Runs(cindx, minlen=N3)
 
-    # these only defined between dl[i] and dr[i]
-    # find flare start where values in ConM switch from 0 to >=N3
-    istart_i = np.where((ConM[1:] >= N3) &
-                        (ConM[0:-1] - ConM[1:] < 0))[0] + 1
+    if returnbinary is False:
+        return istart_i, istop_i
+    else:
+        return runlength.RunMask(istart_i, istop_i, len(flux))
 
-    # use the value of ConM to determine how many points away stop is
-    istop_i = istart_i + (ConM[istart_i] - 1)
 
-    istart_i = np.array(istart_i, dtype='int')
-    istop_i = np.array(istop_i, dtype='int')
+def FINDflareBatch(fluxes, errors, N1=3, N2=1, N3=3,
+                   avg_std=False, std_window=7,
+                   returnbinary=False, sigma=None):
+    '''
+    Run FINDflare on many arrays at once, e.g. the detrended residuals of
+    every segment of every star, when re-running with new N1/N2/N3.
+
+    The arrays are packed in to a NaN padded 2-D array, so the medians,
+    stddevs, cuts and runs are all done in one vectorized pass rather than
+    a Python loop. Gives the same flares as calling FINDflare on each one.
+
+    Parameters
+    ----------
+    fluxes : list of numpy arrays
+        data to search over, can all be different lengths
+    errors : list of numpy arrays
+        errors corresponding to each data array
+    N1, N2, N3, avg_std, std_window : optional
+        same as for FINDflare
+    returnbinary : bool, optional
+        same as for FINDflare, but a list with one array per input
+    sigma : float or numpy array, optional
+        same as for FINDflare, or one value per input array
+
+    Returns
+    -------
+    (list of flare start index arrays, list of flare stop index arrays),
+    one per input array
+    '''
+    nrow = len(fluxes)
+    lens = np.array([len(f) for f in fluxes], dtype='int')
+    if nrow == 0:
+        return [], []
+
+    # one extra column of padding, so runs can't join across rows below
+    ncol = np.max(lens) + 1
+    valid = np.arange(ncol)[None, :] < lens[:, None]
+
+    flux = np.zeros((nrow, ncol)) + np.nan
+    error = np.zeros((nrow, ncol)) + np.nan
+    flux[valid] = np.concatenate([np.asarray(f, dtype='float') for f in fluxes])
+    error[valid] = np.concatenate([np.asarray(e, dtype='float') for e in errors])
+
+    with warnings.catch_warnings():
+        # empty rows give all-NaN slices, which just won't find flares
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        # row medians from 1 sort (NaNs sort to the end), much faster than
+        # np.nanmedian(axis=1), which loops over the rows
+        nok = np.sum(np.isfinite(flux), axis=1)
+        fsort = np.sort(flux, axis=1)
+        lo = fsort[np.arange(nrow), np.maximum((nok - 1) // 2, 0)]
+        hi = fsort[np.arange(nrow), nok // 2]
+        med_i = np.where(nok > 0, (lo + hi) / 2., np.nan)[:, None]
+
+        if sigma is not None:
+            sig_i = np.zeros((nrow, 1)) + np.reshape(sigma, (-1, 1))
+        elif avg_std is False:
+            sig_i = np.nanstd(flux, axis=1)[:, None]
+        else:
+            # rolling std down each column of the transpose = along each row
+            rstd = pd.DataFrame(flux.T).rolling(std_window, center=True).std().values
+            sig_i = np.nanmedian(rstd, axis=0)[:, None]
+
+    ca = flux - med_i
+    cb = np.abs(ca) / sig_i
+    cc = np.abs(ca - error) / sig_i
+
+    # pass cuts from Eqns 3a,b,c
+    cindx = (ca > 0) & (cb > N1) & (cc > N2)
+
+    # as in FINDflare, the first and last point of each array are never flagged
+    ok = lens > 0
+    cindx[ok, 0] = False
+    cindx[ok, lens[ok] - 1] = False
+
+    # runs along the flattened array, the padding column keeps rows apart
+    start, stop, _ = runlength.Runs(cindx.ravel(), minlen=N3)
+    row = start // ncol
+
+    # split back in to one array per input
+    split = np.searchsorted(row, np.arange(1, nrow))
+    istart = np.split(start - row * ncol, split)
+    istop = np.split(stop - row * ncol, split)
 
     if returnbinary is False:
-        return istart_i, istop_i
+        return istart, istop
     else:
-        bin_out = np.zeros_like(flux, dtype='int')
-        for k in range(len(istart_i)):
-            bin_out[istart_i[k]:istop_i[k]+1] = 1
-        return bin_out
+        return [runlength.RunMask(istart[k], istop[k], lens[k]) for k in range(nrow)]
 
 
 def FlagCuts(flags, bad_flags = (16, 128, 2048), returngood=True):
@@ -563,137 +564,278 @@ def EquivDur(time, flux):
     Output has units of SECONDS
     '''
 
-    p = np.trapz(flux, x=(time * 60.0 * 60.0 * 24.0))
+    p = np.trapezoid(flux, x=(time * 60.0 * 60.0 * 24.0))
     return p
 
 
-def FlareStats(time, flux, error, model, istart=-1, istop=-1,
-               c1=(-1,-1), c2=(-1,-1), cpoly=2, ReturnHeader=False):
+# The statistics FlareStats can compute. Each has the output columns it
+# fills, the other statistics it needs first, and a cost class: 'cheap',
+# 'test' (scipy.stats tests) or 'fit' (the aflare1 fit). Entries with no
+# columns are shared steps, e.g. the continuum fit. A statistic is a function
+# of the dict of data & results so far, returning its column values. Add more
+# with RegisterFlareStat.
+FLARESTATS = {}
+
+# the sets of statistics to compute, by name. 'standard' is the original
+# FlareStats output (the columns & order the .flare files have)
+FLARESTATS_PROFILES = {
+    'standard': ['times', 'peak', 'duration', 'aflare1', 'chisq', 'ks_model',
+                 'ks_cont', 'ed'],
+    'catalog-minimal': ['times', 'peak', 'duration', 'ed'],
+    'full': ['times', 'peak', 'duration', 'aflare1', 'chisq', 'ks_model',
+             'ks_cont', 'ed', 'ed_aflare1'],
+    }
+
+FLARESTATS_COSTS = ('cheap', 'test', 'fit')
+
+
+def RegisterFlareStat(name, func, columns=(), needs=(), cost='cheap'):
     '''
-    Compute properties of a flare event. Assumes flux is in relative flux units,
-    i.e. rel_flux = (flux - median) / median
+    Add a statistic that FlareStats can compute, see FLARESTATS
 
     Parameters
     ----------
-    time : 1d numpy array
-    flux : 1d numpy array
-    error : 1d numpy array
-    model : 1d numpy array
-        These 4 arrays must have the same number of elements
-    istart : int, optional
-        The index in the input arrays (time,flux,error,model) that the
-        flare starts at. If not used, defaults to the first data point.
-    istop : int, optional
-        The index in the input arrays (time,flux,error,model) that the
-        flare ends at. If not used, defaults to the last data point.
-
+    name : str
+    func : function
+        Takes the dict FlareStats builds for each flare (the input arrays,
+        the flare's part of them, and what the statistics in "needs" put in
+        it), returns a list of values, one per column
+    columns : list of str, optional
+        The names of the output columns
+    needs : list of str, optional
+        The statistics (or steps) to run first
+    cost : str, optional
+        One of FLARESTATS_COSTS (Default is 'cheap')
     '''
+    if cost not in FLARESTATS_COSTS:
+        raise ValueError('cost must be one of: ' + ', '.join(FLARESTATS_COSTS))
+    for n in needs:
+        if n not in FLARESTATS:
+            raise ValueError('Unknown FlareStats statistic: ' + n)
+    FLARESTATS[name] = {'func': func, 'columns': list(columns),
+                        'needs': list(needs), 'cost': cost}
+    return
 
-    # if FLARE indicies are not stated by user, use start/stop of data
-    if (istart < 0):
-        istart = 0
-    if (istop < 0):
-        istop = len(flux)-1
-
-    # can't have flare start/stop at same point
-    if (istart == istop):
-        istop = istop + 1
-        istart = istart - 1
 
-    # need to have flare at least 3 datapoints long
-    if (istop-istart < 2):
-        istop = istop + 1
-
-    # print(istart, istop) # % ;
+def FlareStatsPlan(profile='standard'):
+    '''
+    Which statistics FlareStats will run for a profile, in order (the ones
+    each needs first), and the columns it will return
 
-    tstart = time[istart]
-    tstop = time[istop]
-    dur0 = tstop - tstart
+    Parameters
+    ----------
+    profile : str or list of str
+        A name in FLARESTATS_PROFILES, or a list of statistic names
 
+    Returns
+    -------
+    (list of statistic names, list of column names)
+    '''
+    if isinstance(profile, str):
+        if profile not in FLARESTATS_PROFILES:
+            raise ValueError('Unknown FlareStats profile: ' + profile)
+        profile = FLARESTATS_PROFILES[profile]
+
+    order = []
+    def _add(name):
+        if name not in FLARESTATS:
+            raise ValueError('Unknown FlareStats statistic: ' + name)
+        if name in order:
+            return
+        for n in FLARESTATS[name]['needs']:
+            _add(n)
+        order.append(name)
+
+    for name in profile:
+        _add(name)
+
+    # the columns come out in the order the profile lists them
+    columns = [c for name in profile for c in FLARESTATS[name]['columns']]
+    return order, columns
+
+
+def _FSContinuum(fs):
     # define continuum regions around the flare, same duration as
     # the flare, but spaced by half a duration on either side
+    time = fs['time']
+    c1 = fs['c1']
+    c2 = fs['c2']
+    cpoly = fs['cpoly']
     if (c1[0]==-1):
-        t0 = tstart - dur0
-        t1 = tstart - dur0/2.
+        t0 = fs['tstart'] - fs['dur0']
+        t1 = fs['tstart'] - fs['dur0']/2.
         c1 = np.where((time >= t0) & (time <= t1))
     if (c2[0]==-1):
-        t0 = tstop + dur0/2.
-        t1 = tstop + dur0
+        t0 = fs['tstop'] + fs['dur0']/2.
+        t1 = fs['tstop'] + fs['dur0']
         c2 = np.where((time >= t0) & (time <= t1))
 
-    flareflux = flux[istart:istop+1]
-    flaretime = time[istart:istop+1]
-    modelflux = model[istart:istop+1]
-    flareerror = error[istart:istop+1]
-
     contindx = np.concatenate((c1[0], c2[0]))
     if (len(contindx) == 0):
         # if NO continuum regions are found, then just use 1st/last point of flare
-        contindx = np.array([istart, istop])
+        contindx = np.array([fs['istart'], fs['istop']])
         cpoly = 1
-    contflux = flux[contindx] # flux IN cont. regions
-    conttime = time[contindx]
-    contfit = np.polyfit(conttime, contflux, cpoly)
-    contline = np.polyval(contfit, flaretime) # poly fit to cont. regions
+    fs['contflux'] = fs['flux'][contindx] # flux IN cont. regions
+    fs['conttime'] = time[contindx]
+    fs['contfit'] = np.polyfit(fs['conttime'], fs['contflux'], cpoly)
+    fs['contline'] = np.polyval(fs['contfit'], fs['flaretime']) # poly fit to cont. regions
 
-    medflux = np.nanmedian(model)
+    fs['medflux'] = np.nanmedian(fs['model'])
+    return []
 
+
+def _FSPeak(fs):
     # measure flare amplitude
-    ampl = np.max(flareflux-contline) / medflux
-    tpeak = flaretime[np.argmax(flareflux-contline)]
+    flare = fs['flareflux'] - fs['contline']
+    ampl = np.max(flare) / fs['medflux']
+    tpeak = fs['flaretime'][np.argmax(flare)]
 
-    p05 = np.where((flareflux-contline <= ampl*0.5))
+    p05 = np.where((flare <= ampl*0.5))
     if len(p05[0]) == 0:
-        fwhm = dur0 * 0.25
-        # print('> warning') # % ;
+        fwhm = fs['dur0'] * 0.25
     else:
-        fwhm = np.max(flaretime[p05]) - np.min(flaretime[p05])
-
-    # fit flare with single aflare model
-    pguess = (tpeak, fwhm, ampl)
-    # print(pguess) # % ;
-    # print(len(flaretime)) # % ;
-
-    try:
-        popt1, pcov = curve_fit(aflare1, np.array(flaretime), (flareflux-contline) / medflux, p0=pguess)
-    except ValueError:
-        # tried to fit bad data, so just fill in with NaN's
-        # shouldn't happen often
-        popt1 = np.array([np.nan, np.nan, np.nan])
-    except RuntimeError:
-        # could not converge on a fit with aflare
+        fwhm = np.max(fs['flaretime'][p05]) - np.min(fs['flaretime'][p05])
+    return [tpeak, ampl, fwhm]
+
+
+def _FSAflare1(fs):
+    # fit flare with single aflare model, started from the flare's moments
+    exptime = fs['exptime']
+    if exptime is not None and np.size(exptime) > 1:
+        exptime = np.asarray(exptime)[fs['istart']:fs['istop']+1]
+
+    popt1, status, nfev = flarefit.FitAflare1(np.array(fs['flaretime']),
+                                              (fs['flareflux']-fs['contline']) / fs['medflux'],
+                                              exptime=exptime, max_nfev=fs['max_nfev'])
+    if status == 0:
+        # could not converge on a fit with aflare in the budget
         # fill with bad flag values
         popt1 = np.array([-99., -99., -99.])
+    # (status = -2 is bad data, which are already NaN's)
+
+    fs['popt1'] = popt1
+    fs['fit_status'] = status
+    if fs['fitinfo'] is not None:
+        fs['fitinfo']['status'] = status
+        fs['fitinfo']['nfev'] = nfev
+    return list(popt1)
 
-    # flare_chisq = total( flareflux - modelflux)**2.  / total(error)**2
-    flare_chisq = chisq(flareflux, flareerror, modelflux)
 
+def _FSKSModel(fs):
     # measure KS stats of flare versus model
-    ks_d, ks_p = stats.ks_2samp(flareflux, modelflux)
+    from scipy import stats
+    return list(stats.ks_2samp(fs['flareflux'], fs['modelflux']))
+
 
+def _FSKSCont(fs):
     # measure KS stats of flare versus continuum regions
-    ks_dc, ks_pc = stats.ks_2samp(flareflux-contline, contflux-np.polyval(contfit, conttime))
+    from scipy import stats
+    return list(stats.ks_2samp(fs['flareflux'] - fs['contline'],
+                               fs['contflux'] - np.polyval(fs['contfit'], fs['conttime'])))
+
+
+def _FSEDAflare1(fs):
+    # the exact ED of the fitted aflare1, when the fit worked
+    if fs['fit_status'] > 0:
+        return [aflare1_ed(fs['popt1'][1], fs['popt1'][2])]
+    return [fs['popt1'][1]]
+
+
+RegisterFlareStat('continuum', _FSContinuum)
+RegisterFlareStat('times', lambda fs: [fs['tstart'], fs['tstop']],
+                  columns=['t_start', 't_stop'])
+RegisterFlareStat('peak', _FSPeak, columns=['t_peak', 'amplitude', 'FWHM'],
+                  needs=['continuum'])
+RegisterFlareStat('duration', lambda fs: [fs['dur0']], columns=['duration'])
+RegisterFlareStat('aflare1', _FSAflare1, needs=['continuum'], cost='fit',
+                  columns=['t_peak_aflare1', 't_FWHM_aflare1', 'amplitude_aflare1'])
+RegisterFlareStat('chisq', lambda fs: [chisq(fs['flareflux'], fs['flareerror'], fs['modelflux'])],
+                  columns=['flare_chisq'])
+RegisterFlareStat('ks_model', _FSKSModel, columns=['KS_d_model', 'KS_p_model'], cost='test')
+RegisterFlareStat('ks_cont', _FSKSCont, columns=['KS_d_cont', 'KS_p_cont'],
+                  needs=['continuum'], cost='test')
+RegisterFlareStat('ed', lambda fs: [EquivDur(np.array(fs['flaretime']),
+                                             (fs['flareflux']-fs['contline'])/fs['medflux'])],
+                  columns=['Equiv_Dur'], needs=['continuum'])
+RegisterFlareStat('ed_aflare1', _FSEDAflare1, columns=['ED_aflare1'], needs=['aflare1'])
 
-    # put flux in relative units, remove dependence on brightness of stars
-    # rel_flux = (flux_gap - flux_model) / np.median(flux_model)
-    # rel_error = error / np.median(flux_model)
 
-    # measure flare ED
-    ed = EquivDur(np.array(flaretime), (flareflux-contline)/medflux)
+def FlareStats(time, flux, error, model, istart=-1, istop=-1,
+               c1=(-1,-1), c2=(-1,-1), cpoly=2, ReturnHeader=False, exptime=None,
+               max_nfev=flarefit.MAX_NFEV, fitinfo=None, profile='standard'):
+    '''
+    Compute properties of a flare event. Assumes flux is in relative flux units,
+    i.e. rel_flux = (flux - median) / median
 
-    # output a dict or array?
-    params = np.array((tstart, tstop, tpeak, ampl, fwhm, dur0,
-                       popt1[0], popt1[1], popt1[2],
-                       flare_chisq, ks_d, ks_p, ks_dc, ks_pc, ed), dtype='float')
-    # the parameter names for later reference
-    header = ['t_start', 't_stop', 't_peak', 'amplitude', 'FWHM', 'duration',
-             't_peak_aflare1', 't_FWHM_aflare1', 'amplitude_aflare1',
-             'flare_chisq', 'KS_d_model', 'KS_p_model', 'KS_d_cont', 'KS_p_cont', 'Equiv_Dur']
+    Parameters
+    ----------
+    time : 1d numpy array
+    flux : 1d numpy array
+    error : 1d numpy array
+    model : 1d numpy array
+        These 4 arrays must have the same number of elements
+    istart : int, optional
+        The index in the input arrays (time,flux,error,model) that the
+        flare starts at. If not used, defaults to the first data point.
+    istop : int, optional
+        The index in the input arrays (time,flux,error,model) that the
+        flare ends at. If not used, defaults to the last data point.
+    exptime : float or 1d numpy array, optional
+        The exposure time (days) of the data. If given, the aflare1 fit
+        uses the model averaged over each exposure (aflare1_binned), which
+        matters for long cadence data. Default is to fit aflare1 as is.
+    max_nfev : int, optional
+        The most model evaluations to spend on the aflare1 fit, see
+        flarefit.FitAflare1. If it runs out, the fit is filled with -99's
+    fitinfo : dict, optional
+        If given, the fit's status and number of evaluations are stored in
+        it (keys 'status', 'nfev')
+    profile : str or list, optional
+        Which statistics to compute, a name from FLARESTATS_PROFILES or a
+        list of names from FLARESTATS. Only those (and what they need) are
+        run. Default is 'standard', all the original columns. Use
+        'catalog-minimal' for just the times, amplitude and ED (no fits
+        or KS tests), or 'full' for everything.
 
+    '''
+    order, header = FlareStatsPlan(profile)
     if ReturnHeader is True:
         return header
-    else:
-        return params
+
+    # if FLARE indicies are not stated by user, use start/stop of data
+    if (istart < 0):
+        istart = 0
+    if (istop < 0):
+        istop = len(flux)-1
+
+    # can't have flare start/stop at same point
+    if (istart == istop):
+        istop = istop + 1
+        istart = istart - 1
+
+    # need to have flare at least 3 datapoints long
+    if (istop-istart < 2):
+        istop = istop + 1
+
+    fs = {'time': time, 'flux': flux, 'error': error, 'model': model,
+          'istart': istart, 'istop': istop, 'c1': c1, 'c2': c2, 'cpoly': cpoly,
+          'exptime': exptime, 'max_nfev': max_nfev, 'fitinfo': fitinfo,
+          'tstart': time[istart], 'tstop': time[istop],
+          'dur0': time[istop] - time[istart],
+          'flareflux': flux[istart:istop+1],
+          'flaretime': time[istart:istop+1],
+          'modelflux': model[istart:istop+1],
+          'flareerror': error[istart:istop+1]}
+
+    values = {}
+    for name in order:
+        values[name] = FLARESTATS[name]['func'](fs)
+
+    # output in the profile's column order
+    params = [v for name in order for v in values[name]]
+    cols = [c for name in order for c in FLARESTATS[name]['columns']]
+    params = dict(zip(cols, params))
+    return np.array([params[c] for c in header], dtype='float')
 
 
 def MeasureS2N(flux, error, model, istart=-1, istop=-1):
@@ -723,6 +865,8 @@ def FlarePer(time, minper=0.1, maxper=30.0, nper=20000):
 
     '''
 
+    from gatspy.periodic import LombScargleFast
+
     # use energy = 1 for flare times.
     # This will create something like the window function
     energy = np.ones_like(time)
@@ -746,59 +890,181 @@ def FlarePer(time, minper=0.1, maxper=30.0, nper=20000):
     return pk, pp
 
 
+def FlarePerBatch(times_list, minper=0.1, maxper=30.0, nper=20000,
+                  method='block'):
+    '''
+    Look for periodicity in the flare occurrence times of many stars at once,
+    see FlarePer for the motivation.
+
+    All stars are scored on the same frequency grid as FlarePer uses, with
+    the Rayleigh test (the power spectrum of a series of event times) from
+    the rayleigh module, evaluated for every star in one batched call.
+
+    Parameters
+    ----------
+    times_list : list of 1-d arrays
+        The flare peak times (days) for each star
+    minper, maxper, nper : optional
+        The period grid, same as FlarePer
+    method : str, optional
+        Passed to rayleigh.RayleighPowerBatch (Default is 'block')
+
+    Returns
+    -------
+    (peak period, peak power, false alarm probability) arrays,
+    one entry per star. Stars with fewer than 2 flares get NaN's.
+    '''
+
+    df = (1./minper - 1./maxper) / nper
+    f0 = 1./maxper
+    freq = f0 + df * np.arange(nper)
+    per = 1./freq
+
+    z = rayleigh.RayleighPowerBatch(times_list, freq, method=method)
+
+    ipk = np.argmax(z, axis=1)
+    pk = per[ipk] # peak period
+    pp = z[np.arange(len(ipk)), ipk] # peak period power
+
+    # the single-frequency Rayleigh power is exponentially distributed,
+    # P(>z) = exp(-z). Correct for the number of independent frequencies
+    # searched, set by the time baseline of each star's flares
+    nflare = np.array([np.size(t) for t in times_list])
+    base = np.array([np.ptp(t) if np.size(t) > 1 else 0. for t in times_list])
+    nindep = np.clip((freq[-1] - freq[0]) * base, 1., nper)
+    fap = -np.expm1(nindep * np.log1p(-np.exp(-pp)))
+
+    bad = np.where((nflare < 2))
+    pk[bad] = np.nan
+    pp[bad] = np.nan
+    fap[bad] = np.nan
+
+    return pk, pp, fap
+
+
 def MultiFind(time, flux, error, flags, mode=3,
-              gapwindow=0.1, minsep=3, debug=False):
+              gapwindow=0.1, minsep=3, debug=False, diag=None, prof=None, params=None):
     '''
     this needs to be either
     1. made in to simple multi-pass cleaner,
     2. made in to "run till no signif change" cleaner, or
     3. folded back in to main code
+
+    If "diag" is a dict, the flare candidate points are stored in it (key
+    'cand') for the diagnostic plots, see SaveDiagnostics. Nothing is
+    plotted here.
+
+    "prof" is an optional instrument.Profiler, to time each detrend step.
+
+    mode=5 uses the same detrending as mode=3, then searches the residuals
+    with a bank of flare templates (see MatchedFilter) instead of 1.
+
+    This is just MultiModel followed by MultiDetect. The two are separate
+    so the (slow) detrend can be done once, and the detection re-run with
+    many parameters, see sweep.py
+
+    If "params" is a dict, the fitted model components are stored in it,
+    see MultiModel.
     '''
+    flux_model, flux_diff = MultiModel(time, flux, error, mode=mode,
+                                       debug=debug, prof=prof, params=params)
 
+    istart, istop = MultiDetect(time, flux, error, flags, flux_model, flux_diff,
+                                mode=mode, gapwindow=gapwindow, minsep=minsep,
+                                diag=diag, prof=prof)
+    return istart, istop, flux_model
 
-    # the bad data points (search where bad < 1)
-    bad = FlagCuts(flags, returngood=False)
+
+def MultiModel(time, flux, error, mode=3, debug=False, prof=None, params=None):
+    '''
+    The detrending half of MultiFind
+
+    If "params" is a dict, the pieces of the model (sin fits, spline, etc)
+    are stored in it (key 'components'), so the model can be rebuilt later
+    without re-fitting, see modelstore.py
+
+    Returns
+    -------
+    (flux_model, flux_diff): the model of the light curve, and the residual
+    that MultiDetect searches. For mode 3 the residual is filtered by a
+    flare template, for mode 5 it is the MatchedFilter significance.
+    '''
+    if mode not in (1, 2, 3, 4, 5):
+        raise ValueError('unknown mode: ' + str(mode))
+
+    if prof is None:
+        prof = instrument.NULL
+    npts = len(time)
     flux_i = np.copy(flux)
 
     if (mode == 1):
         # just use the multi-pass boxcar and average. Simple. Too simple...
-        flux_model1 = detrend.MultiBoxcar(time, flux, error, kernel=0.1)
-        flux_model2 = detrend.MultiBoxcar(time, flux, error, kernel=1.0)
-        flux_model3 = detrend.MultiBoxcar(time, flux, error, kernel=10.0)
+        with prof.span('MultiBoxcar', npts=npts):
+            flux_model1, comp1 = detrend.MultiBoxcar(time, flux, error, kernel=0.1,
+                                                     returnparams=True)
+            flux_model2, comp2 = detrend.MultiBoxcar(time, flux, error, kernel=1.0,
+                                                     returnparams=True)
+            flux_model3, comp3 = detrend.MultiBoxcar(time, flux, error, kernel=10.0,
+                                                     returnparams=True)
 
         flux_model = (flux_model1 + flux_model2 + flux_model3) / 3.
         flux_diff = flux - flux_model
+        for comp in (comp1, comp2, comp3):
+            comp['scale'] = 1. / 3.
+        components = [comp1, comp2, comp3]
 
     if (mode == 2):
         # first do a pass thru w/ largebox to get obvious flares
-        box1 = detrend.MultiBoxcar(time, flux_i, error, kernel=2.0, numpass=2)
-        sin1 = detrend.FitSin(time, box1, error, maxnum=2, maxper=(max(time)-min(time)))
-
-        box2 = detrend.MultiBoxcar(time, flux_i - sin1, error, kernel=0.25)
+        with prof.span('MultiBoxcar', npts=npts):
+            box1 = detrend.MultiBoxcar(time, flux_i, error, kernel=2.0, numpass=2)
+        with prof.span('FitSin', npts=npts):
+            sin1, comp_sin = detrend.FitSin(time, box1, error, maxnum=2,
+                                            maxper=(max(time)-min(time)), returnparams=True)
+
+        with prof.span('MultiBoxcar', npts=npts):
+            box2, comp_box = detrend.MultiBoxcar(time, flux_i - sin1, error, kernel=0.25,
+                                                 returnparams=True)
         flux_model = (box2 + sin1)
         flux_diff = flux - flux_model
+        components = [comp_box, comp_sin]
 
 
-    if (mode == 3):
+    if (mode == 3) or (mode == 5):
         # do iterative rejection and spline fit - like FBEYE did
         # also like DFM & Hogg suggest w/ BART
 
-        box1 = detrend.MultiBoxcar(time, flux, error, kernel=2.0, numpass=2)
-        sin1 = detrend.FitSin(time, box1, error, maxnum=5, maxper=(max(time)-min(time)),
-                              per2=False, debug=debug)
+        with prof.span('MultiBoxcar', npts=npts):
+            box1 = detrend.MultiBoxcar(time, flux, error, kernel=2.0, numpass=2)
+        with prof.span('FitSin', npts=npts):
+            sin1, comp_sin = detrend.FitSin(time, box1, error, maxnum=5,
+                                            maxper=(max(time)-min(time)),
+                                            per2=False, debug=debug, returnparams=True)
         # sin1 = detrend.FitMedSin(time, box1, error)
-        box3 = detrend.MultiBoxcar(time, flux - sin1, error, kernel=0.3)
+        with prof.span('MultiBoxcar', npts=npts):
+            box3 = detrend.MultiBoxcar(time, flux - sin1, error, kernel=0.3)
         t = np.array(time)
         dt = np.nanmedian(t[1:] - t[0:-1])
-        print(dt)
+        if debug is True:
+            print(dt)
         exptime_m = (np.nanmax(time) - np.nanmin(time)) / len(time)
         # ksep used to = 0.07...
-        flux_model = detrend.IRLSSpline(time, box3, error, numpass=20, debug=debug, ksep=exptime_m*10.) + sin1
+        with prof.span('IRLSSpline', npts=npts):
+            spl, comp_spl = detrend.IRLSSpline(time, box3, error, numpass=20, debug=debug,
+                                               ksep=exptime_m*10., returnparams=True)
+        flux_model = spl + sin1
+        components = [comp_spl, comp_sin]
 
+    if (mode == 3):
         signalfwhm = dt * 2
         ftime = np.arange(0, 2, dt)
         modelfilter = aflare1(ftime, 1, signalfwhm, 1)
-        flux_diff = signal.correlate(flux - flux_model, modelfilter, mode='same')
+        from scipy import signal
+        with prof.span('correlate', npts=npts, nfilter=len(modelfilter)):
+            flux_diff = signal.correlate(flux - flux_model, modelfilter, mode='same')
+
+    if (mode == 5):
+        with prof.span('MatchedFilter', npts=npts):
+            flux_diff = MatchedFilter(time, flux - flux_model)
 
     if (mode == 4):
         # fit data with a SAVGOL filter
@@ -806,87 +1072,146 @@ def MultiFind(time, flux, error, flags, mode=3,
         Nsmo = np.floor(0.2 / dt)
         if Nsmo % 2 == 0:
             Nsmo = Nsmo + 1
-        flux_model = savgol_filter(flux, Nsmo, 2, mode='nearest')
+        from scipy.signal import savgol_filter
+        with prof.span('savgol_filter', npts=npts):
+            flux_model = savgol_filter(flux, Nsmo, 2, mode='nearest')
         flux_diff = flux - flux_model
+        # the smoothed curve is only known on this time grid
+        components = [{'kind': 'interp', 'x': np.array(time, dtype='float'),
+                       'y': np.array(flux_model, dtype='float')}]
 
+    if params is not None:
+        params['components'] = components
+
+    return flux_model, flux_diff
+
+
+def MultiDetect(time, flux, error, flags, flux_model, flux_diff, mode=3,
+                N1=3, N2=1, N3=3, gapwindow=0.1, minsep=3, diag=None, prof=None):
+    '''
+    The detection half of MultiFind: run FINDflare on the residual from
+    MultiModel, toss out bad flags & points near the edges, and combine the
+    candidates in to flare events.
+
+    Returns
+    -------
+    (flare start index, flare stop index)
+    '''
+    if prof is None:
+        prof = instrument.NULL
+    npts = len(time)
+
+    # the bad data points (search where bad < 1)
+    bad = FlagCuts(flags, returngood=False)
+
+    finderr = error
+    findstd = None
+    if (mode == 5):
+        # already in units of sigma, so don't re-measure the stddev
+        finderr = np.ones_like(flux_diff)
+        findstd = 1.
 
     # run final flare-find on DATA - MODEL
-    isflare = FINDflare(flux_diff, error, N1=3, N3=3,
-                        returnbinary=True, avg_std=True)
+    with prof.span('FINDflare', npts=npts):
+        isflare = FINDflare(flux_diff, finderr, N1=N1, N2=N2, N3=N3,
+                            returnbinary=True, avg_std=True, sigma=findstd)
+
+    if (mode == 5):
+        # the template responses are broad, so bright flares leak in to the
+        # points around them. Trim each event to where the data is > N1 sigma
+        isflare = runlength.TrimRuns(isflare, (flux - flux_model) > N1 * error)
 
 
     # now pick out final flare candidate points from above
     cand1 = np.where((bad < 1) & (isflare > 0))[0]
 
-    x1 = np.where((np.abs(time[cand1]-time[-1]) < gapwindow))
-    x2 = np.where((np.abs(time[cand1]-time[0]) < gapwindow))
-    cand1 = np.delete(cand1, x1)
-    cand1 = np.delete(cand1, x2)
+    # toss out candidates near the start/end of this span of data
+    cand1 = detrend.GapGuard(time, cand1, gapwindow=gapwindow)
 
-    # print(len(cand1))
-    if (len(cand1) < 1):
-        istart = np.array([])
-        istop = np.array([])
-    else:
-        # find start and stop index, combine neighboring candidates in to same events
-        istart = cand1[np.append([0], np.where((cand1[1:]-cand1[:-1] > minsep))[0]+1)]
-        istop = cand1[np.append(np.where((cand1[1:]-cand1[:-1] > minsep))[0], [len(cand1)-1])]
+    # find start and stop index, combine neighboring candidates in to same events
+    istart, istop = runlength.GroupIndices(cand1, minsep=minsep)
 
     # if start & stop times are the same, add 1 more datum on the end
     to1 = np.where((istart-istop == 0))
     if len(to1[0])>0:
         istop[to1] += 1
 
-    if debug is True:
-        plt.figure()
-        plt.title('debugging plot')
-        plt.scatter(time, flux, alpha=0.5,label='flux')
-        plt.plot(time,flux_model, c='black',label='flux model')
-        plt.scatter(time[cand1], flux[cand1], c='red',label='flare candidates')
-        plt.legend()
-        plt.show()
-        plt.close()
+    if diag is not None:
+        diag['cand'] = cand1
 
-    # print(istart, len(istart))
-    return istart, istop, flux_model
+    return istart, istop
+
+
+def MatchedFilter(time, flux, fwhm=None, decay=10.):
+    '''
+    Multi-scale matched filter: correlate the (detrended) flux with aflare1
+    templates over a range of FWHMs, and return the largest significance
+    at each point. Used by MultiFind mode=5.
+
+    The correlations use overlap-add FFTs, so the cost grows ~n log(m)
+    rather than n*m for a direct correlation with an m point template.
+
+    Parameters
+    ----------
+    time : numpy array
+    flux : numpy array
+        the residual flux, i.e. data - model
+    fwhm : list of floats, optional
+        the template FWHMs in days. Default is 1, 2, 4 ... 32 times the
+        cadence, which spans both short SLC and long LLC flares
+    decay : float, optional
+        how many FWHMs of the template decay to keep (Default is 10)
 
+    Returns
+    -------
+    numpy array of the max significance (in sigma) over all the templates.
+    Each template response is normalized by its own robust noise (MAD).
+    '''
+    from scipy.signal import oaconvolve
 
-# sketching some baby step ideas w/a matched filter
-'''
-def MatchedFilterFind(time, flux, signalfwhm=0.01):
     dt = np.nanmedian(time[1:] - time[0:-1])
-    ftime = np.arange(0, 2, dt)
-    modelfilter = aflare1(ftime, 1, signalfwhm, 1)
+    if fwhm is None:
+        fwhm = dt * 2.**np.arange(0, 6)
 
-    corr = signal.correlate(flux-np.nanmedian(flux), modelfilter, mode='same')
+    good = np.isfinite(flux)
+    resid = np.where(good, flux - np.nanmedian(flux), 0.)
+    npts = len(resid)
 
-    plt.figure()
-    plt.plot(time, flux - np.nanmedian(flux))
-    plt.plot(time, corr,'red')
-    plt.show()
+    sig = np.zeros(npts) - np.inf
+    for w in fwhm:
+        # template on the cadence grid, peak at index nrise
+        nrise = int(np.ceil(w / dt))
+        ndecay = int(np.ceil(decay * w / dt))
+        ftime = np.arange(-nrise, ndecay + 1) * dt
+        tmpl = aflare1(ftime, 0., w, 1.)
+        tmpl = tmpl / np.sqrt(np.sum(tmpl**2.))
 
-    return
-'''
+        # correlate: response[i] = sum_k resid[i+k] * tmpl[k]
+        resp = oaconvolve(resid, tmpl[::-1], mode='full')[ndecay:ndecay + npts]
 
+        med = np.median(resp[good])
+        noise = 1.4826 * np.median(np.abs(resp[good] - med))
+        if noise > 0:
+            sig = np.maximum(sig, (resp - med) / noise)
 
-def FakeFlares(time, flux, error, flags, tstart, tstop,
-               nfake=100, npass=1, ampl=(0.1,100), dur=(0.5,60),
-               outfile='', savefile=False, gapwindow=0.1,
-               verboseout=False, display=False, debug=False):
-    '''
-    Create nfake number of events, inject them in to data
-    Use grid of amplitudes and durations, keep ampl in relative flux units
-    Keep track of energy in Equiv Dur
+    sig[~good] = np.nan
+    return sig
 
-    duration defined in minutes
-    amplitude defined multiples of the median error
 
-    still need to implement npass, to re-do whole thing and average results
+def InjectFakes(time, flux, error, tstart, tstop, nfake=100,
+                ampl=(0.1,100), dur=(0.5,60)):
     '''
+    Add nfake random aflare1 events to the flux, avoiding known flares.
+    Used by FakeFlares, see there for the units of ampl and dur.
 
-    # QUESTION: how many fake flares can I inject at once?
-    # i.e. can I get away with doing fewer re-runs with more flares injected?
+    Each fake is only evaluated from its start to where it has decayed away
+    (DECAY_FWHM), and its ED is the exact integral of the template over the
+    light curve (aflare1_ed), so it does not depend on the cadence.
 
+    Returns
+    -------
+    (new flux, peak times, amplitudes, durations, ED, S/N) of the fakes
+    '''
     std = np.nanmedian(error)
 
     ampl_fake = (np.random.random(nfake) * (ampl[1] - ampl[0]) + ampl[0]) * std
@@ -898,9 +1223,7 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
 
     new_flux = np.array(flux)#, copy=True)
     time = np.array(time)
-    error = np.array(error) 
-    flags = np.array(flags)
-    
+
     for k in range(nfake):
         # generate random peak time, avoid known flares
         isok = False
@@ -917,25 +1240,30 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
 
         t0_fake[k] = t0
 
-        # generate the fake flare
-        fl_flux = aflare1(time, t0, dur_fake[k], ampl_fake[k])
-
-        # in_fl = np.where((time >= t0-dur_fake[k]) & (time <= t0 + 3.0*dur_fake[k]))
+        # generate the fake flare, just where it is non-zero
+        i0, i1 = np.searchsorted(time, [t0 - dur_fake[k], t0 + DECAY_FWHM * dur_fake[k]])
+        fl_flux = aflare1(time[i0:i1], t0, dur_fake[k], ampl_fake[k])
 
         s2n_fake[k] = np.sqrt( np.sum((fl_flux**2.0) / (std**2.0)) )
-        ed_fake[k] = EquivDur(time, fl_flux)
+        ed_fake[k] = aflare1_ed(dur_fake[k], ampl_fake[k], tpeak=t0,
+                                tmin=time[0], tmax=time[-1])
 
         # inject flare in to light curve
-        new_flux = new_flux + fl_flux
+        new_flux[i0:i1] = new_flux[i0:i1] + fl_flux
 
-    '''
-    Re-run flare finding for data + fake flares
-    Figure out: which flares were recovered?
-    '''
+    return new_flux, t0_fake, ampl_fake, dur_fake, ed_fake, s2n_fake
 
-    # all the hard decision making should go here
-    istart, istop, flux_model = MultiFind(time, new_flux, error, flags, gapwindow=gapwindow, debug=debug)
 
+def FakeCompleteness(time, istart, istop, t0_fake, ed_fake, nbins=20):
+    '''
+    Which of the fake flares were recovered, and the fraction recovered
+    in bins of ED
+
+    Returns
+    -------
+    (recovered 0/1 per fake, ED bin centers, fraction recovered per bin)
+    '''
+    nfake = len(t0_fake)
     rec_fake = np.zeros(nfake)
 
     if len(istart)>0: # in case no flares are recovered, even after injection
@@ -947,11 +1275,6 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
             if (len(rec[0]) > 0):
                 rec_fake[k] = 1
 
-    # nbins = int(nfake/10.)
-    # if nbins < 10:
-    #     nbins = 10
-    nbins = 20
-
     # the number of events per bin recovered
     rec_bin_N, ed_bin = np.histogram(ed_fake, weights=rec_fake, bins=nbins)
     # the number of events per bin
@@ -961,6 +1284,77 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
 
     rec_bin = rec_bin_N / rec_bin_D
 
+    return rec_fake, ed_bin_center, rec_bin
+
+
+def EDLimits(ed_fake, frac_rec, smooth=3):
+    '''
+    The ED where a completeness curve (from FakeCompleteness) reaches
+    68% and 90%, after smoothing it with a Wiener filter of size "smooth"
+
+    Returns
+    -------
+    (ED68, ED90, the finite bins, smoothed completeness in those bins).
+    ED68/ED90 are -99 if never reached.
+    '''
+    from scipy.signal import wiener
+
+    rl = np.isfinite(frac_rec)
+    frac_rec_sm = wiener(frac_rec[rl], smooth)
+
+    x68 = np.where((frac_rec_sm >= 0.68))
+    if len(x68[0])>0:
+        ed68_i = min(ed_fake[rl][x68])
+    else:
+        ed68_i = -99
+
+    x90 = np.where((frac_rec_sm >= 0.90))
+    if len(x90[0])>0:
+        ed90_i = min(ed_fake[rl][x90])
+    else:
+        ed90_i = -99
+
+    return ed68_i, ed90_i, rl, frac_rec_sm
+
+
+def FakeFlares(time, flux, error, flags, tstart, tstop,
+               nfake=100, npass=1, ampl=(0.1,100), dur=(0.5,60),
+               outfile='', savefile=False, gapwindow=0.1,
+               verboseout=False, debug=False, prof=None, mode=3):
+    '''
+    Create nfake number of events, inject them in to data
+    Use grid of amplitudes and durations, keep ampl in relative flux units
+    Keep track of energy in Equiv Dur
+
+    duration defined in minutes
+    amplitude defined multiples of the median error
+
+    still need to implement npass, to re-do whole thing and average results
+    '''
+
+    # QUESTION: how many fake flares can I inject at once?
+    # i.e. can I get away with doing fewer re-runs with more flares injected?
+
+    std = np.nanmedian(error)
+    time = np.array(time)
+    error = np.array(error)
+    flags = np.array(flags)
+
+    new_flux, t0_fake, ampl_fake, dur_fake, ed_fake, s2n_fake = \
+        InjectFakes(time, flux, error, tstart, tstop, nfake=nfake, ampl=ampl, dur=dur)
+
+    '''
+    Re-run flare finding for data + fake flares
+    Figure out: which flares were recovered?
+    '''
+
+    # all the hard decision making should go here
+    with (prof or instrument.NULL).span('MultiFind', npts=len(time)):
+        istart, istop, flux_model = MultiFind(time, new_flux, error, flags, gapwindow=gapwindow,
+                                              debug=debug, prof=prof, mode=mode)
+
+    rec_fake, ed_bin_center, rec_bin = FakeCompleteness(time, istart, istop, t0_fake, ed_fake)
+
     if savefile is True:
         # look to see if output folder exists
         # fldr = objectid[0:3]
@@ -984,20 +1378,8 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
             dfout, metadata = h5load(pd.HDFStore(outfile))
         
         # use this completeness curve to estimate 68% complete
-        rl = np.isfinite(rec_bin)
+        ed68_i, ed90_i, rl, frac_rec_sm = EDLimits(ed_bin_center, rec_bin)
         w_in = rec_bin[rl]
-        frac_rec_sm = wiener(w_in, 3)
-        x68 = np.where((frac_rec_sm >= 0.68))
-        if len(x68[0])>0:
-            ed68_i = min(ed_bin_center[rl][x68])
-        else:
-            ed68_i = -99
-
-        x90 = np.where((frac_rec_sm >= 0.90))
-        if len(x90[0])>0:
-            ed90_i = min(ed_bin_center[rl][x90])
-        else:
-            ed90_i = -99
 
         outrow = [[item] for item in [min(time), max(time), std, nfake, ampl[0], 
                   ampl[1], dur[0], dur[1], ed68_i, ed90_i, 
@@ -1011,9 +1393,9 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
                             str(frac_rec_sm[i]) + '\n'
                 header = header + ['ed_bin_center','rec_bin','frac_rec_sm']
                 outrow = outrow+[ed_bin_center[rl][i],rec_bin[rl][i],frac_rec_sm[i]]
-                dfout = dfout.append(pd.DataFrame(dict(zip(header,outrow))),ignore_index=True)
+                dfout = pd.concat([dfout, pd.DataFrame(dict(zip(header,outrow)))],ignore_index=True)
         else:
-            dfout = dfout.append(pd.DataFrame(dict(zip(header,outrow))),ignore_index=True)
+            dfout = pd.concat([dfout, pd.DataFrame(dict(zip(header,outrow)))],ignore_index=True)
 
         h5store(outfile,dfout,**metadata)
 
@@ -1021,18 +1403,22 @@ def FakeFlares(time, flux, error, flags, tstart, tstop,
     return ed_bin_center, rec_bin
 
 
-# objectid = '9726699'  # GJ 1243
-def RunLC(file='', objectid='', ftype='sap', lctype='',
-          display=False, readfile=False, debug=False, dofake=True,
-          dbmode='fits', gapwindow=0.1, maxgap=0.125, verbosefake=False, nfake=100):
-    '''
-    Main wrapper to obtain and process a light curve
+def LoadLC(file='', objectid='', ftype='sap', lctype='', readfile=False,
+           dbmode='fits', cachedir='', source=None, debug=False, prof=None):
     '''
+    Read a light curve for RunLC (or sweep.PrepSweep), from any of the
+    dbmode's. See RunLC for the options.
 
+    Returns
+    -------
+    outfile, objectid, qtr, time, lcflag, exptime, flux_raw, error
+    '''
+    if prof is None:
+        prof = instrument.NULL
 
     # pick and process a totally random LC.
     # important for reality checking!
-    if (objectid is 'random'):
+    if (objectid == 'random'):
         obj, num = np.loadtxt('get_objects.out', skiprows=1, unpack=True, dtype='str')
         rand_id = int(np.random.random() * len(obj))
         objectid = obj[rand_id]
@@ -1044,27 +1430,30 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
         print(file, objectid)
 
     #---------------------------------------------------
-    if dbmode is 'mysql':
-        data_raw = GetLCdb(objectid, readfile=readfile, type=lctype, onecadence=False)
-        data = OneCadence(data_raw)
+    if dbmode == 'mysql':
+        with prof.span('GetLCdb'):
+            data = GetLCdb(objectid, readfile=readfile, type=lctype, onecadence=False,
+                           source=source)
+        # only pull the columns we need out of the fastest cadence data
+        ok = OneCadence(data, returnmask=True)
 
         # data columns are:
         # QUARTER, TIME, PDCFLUX, PDCFLUX_ERR, SAP_QUALITY, LCFLAG, SAPFLUX, SAPFLUX_ERR
 
-        qtr = data[:,0]
-        time = data[:,1]
-        lcflag = data[:,4] # actual SAP_QUALITY
+        qtr = data[ok,0]
+        time = data[ok,1]
+        lcflag = data[ok,4] # actual SAP_QUALITY
 
-        exptime = data[:,5] # actually the LCFLAG
-        exptime[np.where((exptime < 1))] = 54.2 / 60. / 60. / 24.
-        exptime[np.where((exptime > 0))] = 30 * 54.2 / 60. / 60. / 24.
+        # LCFLAG is 0 for short cadence, 1 for long
+        exptime = np.where((data[ok,5] < 1), 54.2 / 60. / 60. / 24.,
+                           30 * 54.2 / 60. / 60. / 24.)
 
         if ftype == 'sap':
-            flux_raw = data[:,6]
-            error = data[:,7]
+            flux_raw = data[ok,6]
+            error = data[ok,7]
         else: # for PDC data
-            flux_raw = data[:,2]
-            error = data[:,3]
+            flux_raw = data[ok,2]
+            error = data[ok,3]
 
         # put flare output in to a set of subdirectories.
         # use first 3 digits to help keep directories to ~1k files
@@ -1079,8 +1468,62 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
         outfile = outdir + objectid
 
     elif dbmode in ('txt','ktwo','everest','vdb','csv','fits'):
-        outfile, objectid, qtr, time, lcflag, exptime, flux_raw, error = Get(dbmode,file, objectid)
-    
+        with prof.span('Get'):
+            outfile, objectid, qtr, time, lcflag, exptime, flux_raw, error = Get(dbmode, file, objectid, cachedir=cachedir, ftype=ftype)
+
+    return outfile, objectid, qtr, time, lcflag, exptime, flux_raw, error
+
+
+# objectid = '9726699'  # GJ 1243
+def RunLC(file='', objectid='', ftype='sap', lctype='',
+          display=False, readfile=False, debug=False, dofake=True,
+          dbmode='fits', gapwindow=0.1, maxgap=0.125, verbosefake=False, nfake=100,
+          cachedir='', source=None, diagnostics=False, profile=False, findmode=3,
+          savemodel=False, statsprofile='standard', store=None, nproc=1):
+    '''
+    Main wrapper to obtain and process a light curve
+
+    The compute path never plots. With diagnostics=True the data behind the
+    diagnostic plots (completeness curves, light curve and model, MultiFind
+    candidates) are saved next to the outputs, in outfile + '_diag.h5'.
+    Draw them later with plotting.RenderDiagnostics. display=True also
+    saves the diagnostics, and renders them in a background process.
+
+    For dbmode='mysql', the light curve is read with GetLCdb from "source"
+    (Default is the UW database, see lcsource.py for a local SQLite copy).
+
+    Set cachedir to a directory to keep an on-disk cache of the cleaned
+    light curves, which makes re-runs (e.g. with new parameters) skip the
+    file parsing in Get.
+
+    With profile=True the wall time, CPU time, peak memory and array sizes
+    of each stage are written to outfile + '_timing.jsonl' (see instrument.py)
+
+    findmode picks the MultiFind detrend/search mode, for both the real and
+    the fake flares (Default is 3, mode 5 is the matched filter bank)
+
+    With savemodel=True the detrend model of each segment is saved to
+    outfile + '_model.h5' in a compact form, so it can be reloaded and
+    rebuilt later without re-fitting (see modelstore.py)
+
+    statsprofile picks which FlareStats statistics go in the output (see
+    FLARESTATS_PROFILES). The statistics computed are listed in the output
+    metadata ('FlareStats-Profile', 'FlareStats-Stats'). The flares are
+    measured with flarefit.FitFlares, on nproc processes (Default is 1).
+    If the profile fits aflare1, how each fit went is in the last columns
+    (fit_status, fit_nfev), after ED68i and ED90i.
+
+    If store is an open pandas HDFStore (see worker.RunShard), the flares
+    and the ED limits of each gap are appended to it (tables 'flares' and
+    'limits', with the File and ObjectID on every row), instead of writing
+    the _flare.h5 and _fake.h5 files for this light curve.
+    '''
+    prof = instrument.Profiler(enabled=profile, File=file, Version=__version__)
+
+    outfile, objectid, qtr, time, lcflag, exptime, flux_raw, error = \
+        LoadLC(file=file, objectid=objectid, ftype=ftype, lctype=lctype, readfile=readfile,
+               dbmode=dbmode, cachedir=cachedir, source=source, debug=debug, prof=prof)
+
     #-----------------------------------------------
 
     if debug is True:
@@ -1088,12 +1531,16 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
 
     ### Basic flattening
     # flatten quarters with polymonial
-    flux_qtr = detrend.QtrFlat(time, flux_raw, qtr)
+    prof.meta['ObjectID'] = objectid
+    with prof.span('QtrFlat', npts=len(time)):
+        flux_qtr = detrend.QtrFlat(time, flux_raw, qtr)
 
     # then flatten between gaps
-    flux_gap = detrend.GapFlat(time, flux_qtr, maxgap=maxgap)
+    with prof.span('GapFlat', npts=len(time)):
+        flux_gap = detrend.GapFlat(time, flux_qtr, maxgap=maxgap)
 
-    _, dl, dr = detrend.FindGaps(time, maxgap=maxgap)
+    with prof.span('FindGaps', npts=len(time)):
+        _, dl, dr = detrend.FindGaps(time, maxgap=maxgap)
     if debug is True:
         print("dl")
         print(dl)
@@ -1107,14 +1554,33 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
     ed90 = []
     flux_model = np.zeros_like(flux_gap)
 
+    if display is True:
+        diagnostics = True
+    diag = {'cand': [], 'completeness': [], 'limits': []}
+    models = []
+
+    # FakeFlares adds to the _fake.h5 file one segment at a time, so clear
+    # out any left from an earlier (maybe unfinished) run of this light curve
+    if dofake is True and store is None and os.path.isfile(outfile + '_fake.h5'):
+        os.remove(outfile + '_fake.h5')
+
     for i in range(0, len(dl)):
         # detect flares in this gap
         if debug is True:
             print(i, str(datetime.datetime.now()) + ' MultiFind started')
 
-        istart_i, istop_i, flux_model_i = MultiFind(time[dl[i]:dr[i]], flux_gap[dl[i]:dr[i]],
-                                                    error[dl[i]:dr[i]], lcflag[dl[i]:dr[i]],
-                                                    gapwindow=gapwindow, debug=debug)
+        diag_i = {}
+        params_i = {}
+        with prof.span('MultiFind', segment=i, npts=int(dr[i]-dl[i])):
+            istart_i, istop_i, flux_model_i = MultiFind(time[dl[i]:dr[i]], flux_gap[dl[i]:dr[i]],
+                                                        error[dl[i]:dr[i]], lcflag[dl[i]:dr[i]],
+                                                        gapwindow=gapwindow, debug=debug,
+                                                        diag=diag_i, prof=prof, mode=findmode,
+                                                        params=params_i)
+        diag['cand'].append(diag_i['cand'] + dl[i])
+        if savemodel is True:
+            models.append(modelstore.SegmentModel(time[dl[i]:dr[i]], flux_gap[dl[i]:dr[i]],
+                                                  params_i['components'], mode=findmode))
 
         # run artificial flare test in this gap
         if debug is True:
@@ -1129,46 +1595,31 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
             else:
                 t_tmp1 = []
                 t_tmp2 = []
-            ed_fake, frac_rec = FakeFlares(time[dl[i]:dr[i]], flux_gap[dl[i]:dr[i]]/medflux - 1.0,
-                                           error[dl[i]:dr[i]]/medflux, lcflag[dl[i]:dr[i]],
-                                           t_tmp1, t_tmp2,
-                                           savefile=True, verboseout=verbosefake, gapwindow=gapwindow,
-                                           outfile=outfile + '_fake.h5', display=display,
-                                           nfake=nfake, debug=debug)
-
-            rl = np.isfinite(frac_rec)
-            frac_rec_sm = wiener(frac_rec[rl], 3)
+            with prof.span('FakeFlares', segment=i, npts=int(dr[i]-dl[i]), nfake=nfake):
+                ed_fake, frac_rec = FakeFlares(time[dl[i]:dr[i]], flux_gap[dl[i]:dr[i]]/medflux - 1.0,
+                                               error[dl[i]:dr[i]]/medflux, lcflag[dl[i]:dr[i]],
+                                               t_tmp1, t_tmp2,
+                                               savefile=(store is None), verboseout=verbosefake,
+                                               gapwindow=gapwindow, outfile=outfile + '_fake.h5',
+                                               nfake=nfake, debug=debug, prof=prof,
+                                               mode=findmode)
 
             # use this completeness curve to estimate 68% complete
-            x68 = np.where((frac_rec_sm >= 0.68))
-            if len(x68[0])>0:
-                ed68_i = min(ed_fake[rl][x68])
-            else:
-                ed68_i = -99
-
-            x90 = np.where((frac_rec_sm >= 0.90))
-            if len(x90[0])>0:
-                ed90_i = min(ed_fake[rl][x90])
-            else:
-                ed90_i = -99
-
-            if display is True:
-                # print(np.shape(ed_fake), np.shape(frac_rec), np.shape(rl), np.shape(frac_rec_sm))
-                plt.figure()
-                plt.plot(ed_fake, frac_rec, c='k')
-                plt.plot(ed_fake[rl], frac_rec_sm, c='red', linestyle='dashed', lw=2)
-                plt.vlines([ed68_i, ed90_i], ymin=0, ymax=1, colors='b',alpha=0.75, lw=5)
-                plt.xlabel('Flare Equivalent Duration (seconds)')
-                plt.ylabel('Fraction of Recovered Flares')
-
-                plt.xlim((0,np.nanmax(ed_fake)))
-                plt.savefig(file + '_fake_recovered.pdf',dpi=300, bbox_inches='tight', pad_inches=0.5)
-                plt.show()
+            ed68_i, ed90_i, rl, frac_rec_sm = EDLimits(ed_fake, frac_rec)
+
+            if diagnostics is True:
+                frac_rec_sm_all = np.zeros_like(ed_fake) * np.nan
+                frac_rec_sm_all[rl] = frac_rec_sm
+                diag['completeness'].append(pd.DataFrame({'gap': i, 'ed_fake': ed_fake,
+                                                          'frac_rec': frac_rec,
+                                                          'frac_rec_sm': frac_rec_sm_all}))
         else:
             # for speed you can skip the fake-flare tests
             ed68_i = -199
             ed90_i = -199
 
+        diag['limits'].append([i, ed68_i, ed90_i])
+
         ed68 = np.append(ed68, np.zeros(len(istart_i)) + ed68_i)
         ed90 = np.append(ed90, np.zeros(len(istart_i)) + ed90_i)
 
@@ -1203,40 +1654,17 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
 
     # print(istart)
 
-    if display is True:
-        print(str(len(istart))+' flare candidates found')
-
-        plt.figure()
-        plt.plot(time, flux_gap, 'k', alpha=0.7, lw=0.8)
-
-        # for g in dl:
-        #     plt.scatter(time[g], flux_gap[g], color='blue', marker='v',s=40)
-
-        # plt.scatter(time[istart], flux_gap[istart], color='red', marker='*',s=90)
-        # plt.scatter(time[istop], flux_gap[istop], color='orange', marker='p',s=60, alpha=0.5)
-        for g in range(len(istart)):
-            plt.plot(time[istart[g]:istop[g]+1],
-                     flux_gap[istart[g]:istop[g]+1],color='red', lw=1)
-
-        plt.plot(time, flux_model, 'blue', lw=3, alpha=0.7)
-
+    if savemodel is True:
+        with prof.span('SaveModels', nsegments=len(models)):
+            modelstore.SaveModels(outfile + '_model.h5', models,
+                                  metadata={'ObjectID': objectid, 'File': file})
 
-        plt.xlabel('Time (BJD - 2454833 days)')
-        plt.ylabel(r'Flux (e- sec$^{-1}$)')
-
-        xdur = np.nanmax(time) - np.nanmin(time)
-        xdur0 = np.nanmin(time) + xdur/2.
-        xdur1 = np.nanmin(time) + xdur/2. + 2.6
-        plt.xlim(xdur0, xdur1) # only plot a chunk of the data
-
-        xdurok = np.where((time >= xdur0) & (time <= xdur1))
-        if len(xdurok[0])>0:
-            yminmax = [np.nanmin(flux_gap[xdurok]), np.nanmax(flux_gap[xdurok])]
-            if sum(np.isfinite(yminmax)) > 1:
-                plt.ylim(yminmax[0], yminmax[1])
-
-        plt.savefig(file + '_lightcurve.pdf', dpi=300, bbox_inches='tight', pad_inches=0.5)
-        plt.show()
+    if diagnostics is True:
+        SaveDiagnostics(outfile + '_diag.h5', time, flux_gap, flux_model, dl, dr,
+                        istart, istop, diag)
+        if display is True:
+            print(str(len(istart))+' flare candidates found')
+            RenderBackground(outfile + '_diag.h5', prefix=file)
 
     '''
     #-- IF YOU WANT TO PLAY WITH THE WAVELET STUFF MORE, WORK HERE
@@ -1256,7 +1684,7 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
     '''
 
     # set this to silence bad fit warnings from polyfit
-    warnings.simplefilter('ignore', np.RankWarning)
+    warnings.simplefilter('ignore', np.exceptions.RankWarning)
     
     metadata = {'ObjectID' : objectid,
                  'File' : file,
@@ -1264,41 +1692,127 @@ def RunLC(file='', objectid='', ftype='sap', lctype='',
                  'Appaloosa-Version': __version__,
                  'N_epoch in LC' : str(len(time)),
                  'Total exp time of LC' : str(np.sum(exptime)),
+                 'FlareStats-Profile' : str(statsprofile),
+                 'FlareStats-Stats' : ','.join(FlareStatsPlan(statsprofile)[0]),
                  }
 
     if debug is True:
         print(str(datetime.datetime.now()) + 'Getting output header')
         
     header = FlareStats(time, flux_gap, error, flux_model,
-                        ReturnHeader=True)
-    header = header + ['ED68i','ED90i']
-    dfout = pd.DataFrame()
-    
+                        ReturnHeader=True, profile=statsprofile)
+
     if debug is True:
         print(str(datetime.datetime.now()) + 'Getting FlareStats')
-        
-    # loop over EACH FLARE, compute stats
-    for i in range(0,len(istart)):
-        stats_i = FlareStats(time, flux_gap, error, flux_model,
-                             istart=istart[i], istop=istop[i])
-        _ = [[item] for item in [*stats_i,ed68[i],ed90[i]]]
-        dfout = dfout.append(pd.DataFrame(dict(zip(header,_))),
-                             ignore_index=True)
-        
-    h5store(outfile + '_flare.h5',dfout,**metadata)
+
+    # compute the stats of EACH FLARE
+    with prof.span('FlareStats', nflares=len(istart), nproc=nproc):
+        fits = flarefit.FitFlares(time, flux_gap, error, flux_model, istart, istop,
+                                  nproc=nproc, profile=statsprofile)
+
+    # keep the original column order, the fit info goes on the end
+    dfout = fits[header].astype('float')
+    dfout['ED68i'] = np.array(ed68, dtype='float')
+    dfout['ED90i'] = np.array(ed90, dtype='float')
+    for col in fits.columns[len(header):]:
+        dfout[col] = fits[col]
+
+    if store is None:
+        h5store(outfile + '_flare.h5',dfout,**metadata)
+    else:
+        limits = pd.DataFrame(diag['limits'], columns=['gap', 'ed68', 'ed90'])
+        limits['t_min'] = time[dl]
+        limits['t_max'] = time[np.array(dr) - 1]
+        StoreAppend(store, 'flares', dfout, File=file, ObjectID=objectid)
+        StoreAppend(store, 'limits', limits, File=file, ObjectID=objectid)
+
+    prof.write(outfile + '_timing.jsonl')
     return
 
+
+def SaveDiagnostics(filename, time, flux_gap, flux_model, dl, dr,
+                    istart, istop, diag):
+    '''
+    Save the data behind the RunLC diagnostic plots, so they can be drawn
+    later (see plotting.RenderDiagnostics) without blocking the pipeline.
+
+    The HDF5 file has these tables:
+    lightcurve : time, flux, flux_model, gap index, and flags for the
+                 MultiFind candidate points and the final flare points
+    flares : istart, istop
+    completeness : gap, ed_fake, frac_rec, frac_rec_sm (fake flare tests)
+    limits : gap, ed68, ed90
+    '''
+    gap = np.zeros(len(time), dtype='int')
+    for i in range(len(dl)):
+        gap[dl[i]:dr[i]] = i
+
+    cand = np.zeros(len(time), dtype='int')
+    if len(diag['cand']) > 0:
+        cand[np.array(np.concatenate(diag['cand']), dtype='int')] = 1
+
+    isflare = np.zeros(len(time), dtype='int')
+    for k in range(len(istart)):
+        isflare[istart[k]:istop[k]+1] = 1
+
+    # written to a temporary file first, like h5store
+    with AtomicFile(filename) as tmpfile:
+        with pd.HDFStore(tmpfile, mode='w') as store:
+            store.put('lightcurve', pd.DataFrame({'time': time, 'flux': flux_gap,
+                                                  'flux_model': flux_model, 'gap': gap,
+                                                  'cand': cand, 'isflare': isflare}))
+            store.put('flares', pd.DataFrame({'istart': np.array(istart, dtype='int'),
+                                              'istop': np.array(istop, dtype='int')}))
+            if len(diag['completeness']) > 0:
+                store.put('completeness', pd.concat(diag['completeness'], ignore_index=True))
+            store.put('limits', pd.DataFrame(np.array(diag['limits'], dtype='float').reshape(-1, 3),
+                                             columns=['gap', 'ed68', 'ed90']))
+    return
+
+
+def RenderBackground(diagfile, prefix=''):
+    '''
+    Draw the diagnostic plots from SaveDiagnostics in a separate background
+    process (with a non-interactive backend), so the caller never imports
+    matplotlib or waits on it. Returns the subprocess.Popen object.
+    '''
+    import subprocess
+    import sys
+
+    env = dict(os.environ)
+    env['MPLBACKEND'] = 'Agg'
+    code = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plotting.py')
+    return subprocess.Popen([sys.executable, code, diagfile, prefix], env=env)
+
+
 #Use h5 to store metadata and data such that it is easy to propagate, 
 #found here: https://stackoverflow.com/a/29130146
 #originally from Pandas Cookbook
 
 def h5store(filename, df, **kwargs):
-    store = pd.HDFStore(filename)
-    store.put('mydata', df)
-    store.get_storer('mydata').attrs.metadata = kwargs
-    store.close()
+    # write to a temporary file and rename it in to place, so a run that
+    # dies part way through never leaves a partial file that looks complete
+    with AtomicFile(filename) as tmpfile:
+        with pd.HDFStore(tmpfile, mode='w') as store:
+            store.put('mydata', df)
+            store.get_storer('mydata').attrs.metadata = kwargs
+    return
+
+def StoreAppend(store, key, df, **kwargs):
+    '''
+    Append a table to an open HDFStore, with the kwargs (e.g. File) added
+    as columns on every row, so results from many light curves can share
+    one file. String columns have room for 256 characters.
+    '''
+    df = df.copy()
+    for k in kwargs:
+        df[k] = str(kwargs[k])
+    strings = [k for k in df.columns if pd.api.types.is_string_dtype(df[k])]
+    store.append(key, df, format='table', data_columns=strings,
+                 min_itemsize={k: 256 for k in strings}, index=False)
     return
 
+
 def h5load(store):
     data = store['mydata']
     metadata = store.get_storer('mydata').attrs.metadata
@@ -1307,8 +1821,13 @@ def h5load(store):
 
 
 # let this file be called from the terminal directly. e.g.:
-# $python appaloosa.py 12345678
+# $python appaloosa.py kplr012345678-2009131105131_llc.fits
+# add --diagnostics to also save the data behind the diagnostic plots
+# (_diag.h5), --display to render the plots too (in the background),
+# and --debug for the verbose printing
 if __name__ == "__main__":
     import sys
-    RunLC(file=str(sys.argv[1]), dbmode='fits', display=True, debug=True, nfake=100)
+    RunLC(file=str(sys.argv[1]), dbmode='fits', nfake=100,
+          diagnostics=('--diagnostics' in sys.argv),
+          display=('--display' in sys.argv), debug=('--debug' in sys.argv))
 
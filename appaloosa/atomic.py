@@ -0,0 +1,28 @@
+'''
+Write output files so a run that dies part way through never leaves a
+partial file that looks complete: write to a temporary file next to it,
+then rename it in to place (os.replace is atomic on the same filesystem).
+
+    with atomic.AtomicFile(outfile + '_flare.h5') as tmpfile:
+        with pd.HDFStore(tmpfile, mode='w') as store:
+            store.put('mydata', df)
+'''
+
+import os
+import contextlib
+
+
+@contextlib.contextmanager
+def AtomicFile(filename):
+    '''
+    Context manager giving a temporary filename to write to. If the block
+    finishes it is renamed to filename, and if it raises (or is interrupted)
+    the temporary file is removed and filename is left as it was.
+    '''
+    tmpfile = filename + '.' + str(os.getpid()) + '.tmp'
+    try:
+        yield tmpfile
+        os.replace(tmpfile, filename)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
@@ -0,0 +1,285 @@
+'''
+Benchmarks for tracking the speed of appaloosa between versions.
+
+Results are appended to a CSV file, with the appaloosa version and date
+on every row, so a slowdown shows up by comparing rows between versions.
+'''
+
+import numpy as np
+import os
+import sys
+import subprocess
+import datetime
+import tempfile
+import shutil
+from version import __version__
+
+# where appaloosa.py and friends live, so a fresh interpreter can import them
+_codedir = os.path.dirname(os.path.abspath(__file__))
+
+# modules that should NOT be loaded by the headless detection path
+HEAVY_MODULES = ('matplotlib', 'astropy', 'gatspy', 'MySQLdb',
+                 'scipy.stats', 'scipy.signal', 'scipy.optimize')
+
+
+def _WriteResults(outfile, rows, header):
+    # append benchmark rows to a CSV, writing the header for new files
+    newfile = not os.path.isfile(outfile)
+    f = open(outfile, 'a')
+    if newfile:
+        f.write(', '.join(header) + '\n')
+    for row in rows:
+        f.write(', '.join([str(x) for x in row]) + '\n')
+    f.close()
+    return
+
+
+def ImportTime(module='appaloosa', nrep=5, outfile=''):
+    '''
+    Measure how long a fresh Python interpreter takes to import a module,
+    the fixed start-up cost paid by every short (e.g. one star Condor) job.
+
+    Parameters
+    ----------
+    module : str, optional
+        The module to import (Default is 'appaloosa')
+    nrep : int, optional
+        Number of fresh interpreters to time (Default is 5)
+    outfile : str, optional
+        If set, append the results to this CSV file
+
+    Returns
+    -------
+    (median import time in seconds, list of HEAVY_MODULES that got loaded)
+    '''
+    code = ('import sys, time; t0 = time.perf_counter(); import ' + module +
+            '; t1 = time.perf_counter(); print(t1 - t0); ' +
+            'print(",".join([m for m in ' + repr(HEAVY_MODULES) +
+            ' if m in sys.modules]))')
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = _codedir + os.pathsep + env.get('PYTHONPATH', '')
+
+    dt = np.zeros(nrep)
+    heavy = []
+    for k in range(nrep):
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      env=env, cwd=_codedir)
+        lines = out.decode().strip().split('\n')
+        dt[k] = float(lines[0])
+        if len(lines) > 1 and lines[1] != '':
+            heavy = lines[1].split(',')
+
+    if outfile != '':
+        _WriteResults(outfile, [[__version__, str(datetime.datetime.now()), module,
+                                 nrep, np.median(dt), np.min(dt), ' '.join(heavy)]],
+                      ['version', 'date', 'module', 'nrep',
+                       'median_sec', 'min_sec', 'heavy_modules'])
+
+    return np.median(dt), heavy
+
+
+# the light curve sizes to benchmark: (length in days, cadence)
+SIZES = {'1mo_llc': (30., 'llc'),
+         '1qtr_llc': (93., 'llc'),
+         '1yr_llc': (372., 'llc'),
+         '4yr_llc': (1470., 'llc'),
+         '1mo_slc': (30., 'slc'),
+         '1qtr_slc': (93., 'slc'),
+         '1yr_slc': (372., 'slc'),
+         '4yr_slc': (1470., 'slc')}
+
+# the MultiFind detrending modes to benchmark
+MULTIFIND_MODES = (1, 2, 3, 4, 5)
+
+STAGES = ('QtrFlat', 'GapFlat', 'MultiBoxcar', 'FitSin', 'IRLSSpline') + \
+         tuple(['MultiFind_mode' + str(m) for m in MULTIFIND_MODES]) + \
+         ('FINDflare', 'FakeFlares', 'FlareStats', 'RunLC')
+
+
+def BenchPipeline(sizes=None, stages=None, nfake=10, seed=42,
+                  outfile='bench_pipeline.csv'):
+    '''
+    Time each stage of the flare finding pipeline on synthetic light curves
+    (see synthetic.py) of increasing size, from 1 month of long cadence up
+    to 4 years of short cadence.
+
+    The segment-level stages (MultiBoxcar ... FlareStats) are run on every
+    gap-to-gap segment of the light curve, the way RunLC does.
+
+    Parameters
+    ----------
+    sizes : list of str, optional
+        Keys of SIZES to run. Default is all of them
+    stages : list of str, optional
+        Names from STAGES to run. Default is all of them
+    nfake : int, optional
+        Number of fake flares per segment for FakeFlares and RunLC
+        (Default is 10)
+    seed : int, optional
+        Random seed for the synthetic light curves (Default is 42)
+    outfile : str, optional
+        CSV file to append the results to, one row per (size, stage)
+
+    Returns
+    -------
+    list of the timing records (dicts)
+    '''
+    import appaloosa
+    import detrend
+    import instrument
+    import synthetic
+
+    if sizes is None:
+        sizes = list(SIZES.keys())
+    if stages is None:
+        stages = STAGES
+
+    records = []
+    for size in sizes:
+        ndays, cadence = SIZES[size]
+        lc, _ = synthetic.SyntheticLC(ndays=ndays, cadence=cadence, seed=seed)
+        time = lc['time'].values
+        flux = lc['flux'].values
+        error = lc['error'].values
+        flags = lc['quality'].values
+        qtr = lc['qtr'].values
+
+        prof = instrument.Profiler()
+
+        if 'QtrFlat' in stages:
+            with prof.span('QtrFlat', npts=len(time)):
+                detrend.QtrFlat(time, flux, qtr)
+        if 'GapFlat' in stages:
+            with prof.span('GapFlat', npts=len(time)):
+                detrend.GapFlat(time, flux)
+
+        _, dl, dr = detrend.FindGaps(time)
+        segs = [slice(dl[i], dr[i]) for i in range(len(dl))]
+
+        def _segments(name, func):
+            # run one stage over every segment, inside a single span
+            if name not in stages:
+                return
+            with prof.span(name, npts=len(time), nsegments=len(segs)):
+                for s in segs:
+                    func(time[s], flux[s], error[s], flags[s])
+
+        _segments('MultiBoxcar', lambda t, f, e, q:
+                  detrend.MultiBoxcar(t, f, e, kernel=2.0, numpass=2))
+        _segments('FitSin', lambda t, f, e, q:
+                  detrend.FitSin(t, f, e, maxnum=5, maxper=(max(t)-min(t))))
+        _segments('IRLSSpline', lambda t, f, e, q:
+                  detrend.IRLSSpline(t, f, e, numpass=20,
+                                     ksep=(np.nanmax(t) - np.nanmin(t)) / len(t) * 10.))
+        for m in MULTIFIND_MODES:
+            _segments('MultiFind_mode' + str(m), lambda t, f, e, q:
+                      appaloosa.MultiFind(t, f, e, q, mode=m))
+
+        # the later stages need a model and flares to work on
+        need = [x for x in ('FINDflare', 'FakeFlares', 'FlareStats') if x in stages]
+        if len(need) > 0:
+            found = [appaloosa.MultiFind(time[s], flux[s], error[s], flags[s]) for s in segs]
+
+            _segments('FINDflare', lambda t, f, e, q:
+                      appaloosa.FINDflare(f - np.nanmedian(f), e, avg_std=True))
+
+            if 'FakeFlares' in stages:
+                with prof.span('FakeFlares', npts=len(time), nsegments=len(segs), nfake=nfake):
+                    for s, (istart, istop, model) in zip(segs, found):
+                        med = np.nanmedian(model)
+                        appaloosa.FakeFlares(time[s], flux[s] / med - 1., error[s] / med,
+                                             flags[s], time[s][istart], time[s][istop],
+                                             nfake=nfake, savefile=False)
+
+            if 'FlareStats' in stages:
+                nfl = int(np.sum([len(f[0]) for f in found]))
+                with prof.span('FlareStats', npts=len(time), nflares=nfl):
+                    for s, (istart, istop, model) in zip(segs, found):
+                        for i in range(len(istart)):
+                            appaloosa.FlareStats(time[s], flux[s], error[s], model,
+                                                 istart=istart[i], istop=istop[i])
+
+        if 'RunLC' in stages:
+            # RunLC writes its outputs next to the light curve file, so
+            # all of it goes in a temporary directory that is removed after
+            tmpdir = tempfile.mkdtemp()
+            try:
+                lcfile = os.path.join(tmpdir, 'synthetic_' + size + '.txt')
+                synthetic.WriteTxt(lc, lcfile)
+                with prof.span('RunLC', npts=len(time), nfake=nfake):
+                    appaloosa.RunLC(file=lcfile, dbmode='txt', nfake=nfake)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        for rec in prof.records:
+            rec['size'] = size
+            rec['cadence'] = cadence
+            records.append(rec)
+
+    if outfile != '':
+        now = str(datetime.datetime.now())
+        keys = ['size', 'span', 'wall_sec', 'cpu_sec', 'peak_rss_mb', 'npts']
+        _WriteResults(outfile, [[__version__, now] + [rec.get(k, '') for k in keys]
+                                for rec in records],
+                      ['version', 'date', 'size', 'stage', 'wall_sec', 'cpu_sec',
+                       'peak_rss_mb', 'npts'])
+
+    return records
+
+
+def CompareVersions(outfile='bench_pipeline.csv', old='', new=__version__,
+                    threshold=1.2):
+    '''
+    Compare the benchmark results of two versions, to spot regressions.
+
+    Parameters
+    ----------
+    outfile : str, optional
+        The CSV file written by BenchPipeline
+    old : str, optional
+        The version to compare against. Default is the one before "new"
+    new : str, optional
+        Default is the current version
+    threshold : float, optional
+        Report (size, stage) pairs that got slower by more than this
+        factor (Default is 1.2)
+
+    Returns
+    -------
+    DataFrame of the median wall time per (size, stage) for both versions,
+    and their ratio (new / old)
+    '''
+    import pandas as pd
+
+    df = pd.read_csv(outfile, skipinitialspace=True, dtype={'version': str})
+
+    if old == '':
+        versions = [v for v in pd.unique(df['version']) if v != new]
+        old = versions[-1]
+
+    med = df.groupby(['version', 'size', 'stage'])['wall_sec'].median()
+    out = pd.DataFrame({'old': med[old], 'new': med[new]}).dropna()
+    out['ratio'] = out['new'] / out['old']
+
+    slow = out[out['ratio'] > threshold]
+    if slow.shape[0] > 0:
+        print('Slower in ' + new + ' than ' + old + ':')
+        print(slow)
+
+    return out
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python benchmark.py
+# $python benchmark.py pipeline 1mo_llc 1qtr_llc
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'pipeline':
+        if len(sys.argv) > 2:
+            BenchPipeline(sizes=sys.argv[2:])
+        else:
+            BenchPipeline()
+    else:
+        t_imp, heavy = ImportTime(outfile='bench_import.csv')
+        print('import appaloosa: ' + str(t_imp) + ' sec')
+        print('heavy modules loaded: ' + ', '.join(heavy))
@@ -110,7 +110,8 @@ def PrepUW(prefix=''):
     return
 
 
-def PrepWWU(prefix='', nice=False, bin=10):
+def PrepWWU(prefix='', nice=False, bin=10, shard=False, timing=None, manifest='',
+            worker=False):
     '''
     Generate the Condor config file needed to script the running of Appaloosa,
     and the little helper shell script. Built for running on the WWU CS Compute Cluster.
@@ -120,12 +121,32 @@ def PrepWWU(prefix='', nice=False, bin=10):
     prefix : str, optional
         What prefix to call this run. By default a unique string of HEX code is used,
         based on the timestamp.
+    bin : int, optional
+        How many Condor config files to split the jobs in to (Default is 10)
+    shard : bool, optional
+        If True, split the files so each config file should take about the
+        same time to run (see shards.py), instead of the same number of
+        files. The shard manifest is saved as prefix_shards.json in the
+        run directory. (Default is False)
+    timing : list of str, optional
+        _timing.jsonl files from previous runs, to predict the run times
+        with when shard=True. Default is to use the FITS headers
+    manifest : str, optional
+        Use the shards in this manifest (from shards.PlanShards) instead
+    worker : bool, optional
+        With shard or manifest, queue one job per shard that runs all of
+        its files in one process (worker.py), instead of one job per file.
+        Writes a single config file. Raises a ValueError without shard or
+        manifest. (Default is False)
 
     Returns
     -------
     Generates files in the working directory for running Condor.
 
     '''
+    if worker is True and manifest == '' and shard is False:
+        raise ValueError('worker=True needs the files in shards, use shard=True or a manifest')
+
     if (prefix==''):
         prefix = HexTime()
 
@@ -153,9 +174,38 @@ def PrepWWU(prefix='', nice=False, bin=10):
 
     pyversion = home + "/anaconda2/bin/python"
 
+    # the files for each config file, as lists of indices in to kid
+    if manifest != '' or shard is True:
+        import shards
+        if manifest != '':
+            man = shards.ReadManifest(manifest)
+        else:
+            manifest = workdir + prefix + '_shards.json'
+            man = shards.PlanShards([dir + k for k in kid], nshard=bin, timing=timing,
+                                    outfile=manifest)
+        kid = np.array([f[len(dir):] if f.startswith(dir) else f
+                        for s in man['shards'] for f in s['files']])
+        nper = [len(s['files']) for s in man['shards']]
+        bin = len(nper)
+        groups = np.split(np.arange(len(kid)), np.cumsum(nper)[:-1])
+    else:
+        isplit = int(float(len(kid)) / bin)
+        groups = [np.arange(i * isplit, (i + 1) * isplit) for i in range(bin)]
+        # the last window should be large enough to finish it
+        groups[-1] = np.arange((bin - 1) * isplit, len(kid))
+
     # the path to the actual science code
     python_code = home + '/python/appaloosa/appaloosa.py'
 
+    # the Arguments of each job, for each config file
+    args = [[os.path.join(dir, kid[k]) for k in g] for g in groups]
+
+    if worker is True:
+        # one job per shard, each running every file in it
+        python_code = home + '/python/appaloosa/worker.py'
+        args = [[manifest + ' ' + str(i) for i in range(bin)]]
+        bin = 1
+
     # 2222222222222222 create CONDOR .cfg file
     for i in range(bin):
         if bin is 1:
@@ -181,16 +231,9 @@ def PrepWWU(prefix='', nice=False, bin=10):
         f2.write('Output = ' + workdir + 'out' + inum + '.txt \n')
         f2.write(' \n')
 
-        isplit = int(float(len(kid)) / bin)
-        istart = i * isplit
-        istop = (i + 1) * isplit
-        if (i + 1) == bin:
-            # the last window should be large enough to finish it
-            istop = len(kid)
-
-        for k in range(istart, istop):
+        for a in args[i]:
             # put entry in to CONDOR .cfg file for this window
-            f2.write('Arguments = ' + dir + kid[k] + ' \n')
+            f2.write('Arguments = ' + a + ' \n')
             f2.write('Queue \n')
 
         f2.write(' \n')
@@ -200,7 +243,7 @@ def PrepWWU(prefix='', nice=False, bin=10):
     # create the very simple PYTHON-launching shell script
     f3 = open(shellscript,'w')
     f3.write("#!/bin/bash \n")
-    f3.write(pyversion + " " + python_code + " $1 \n")
+    f3.write(pyversion + " " + python_code + " $@ \n")
     f3.close()
 
     # fix permissions
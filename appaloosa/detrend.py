@@ -5,13 +5,9 @@ Use this file to keep various detrending methods
 import numpy as np
 #from pandas import rolling_median #, rolling_mean, rolling_std, rolling_skew
 import pandas as pd
-from scipy.optimize import curve_fit
-from gatspy.periodic import LombScargleFast
-from gatspy.periodic import SuperSmoother
 # import pywt
-from scipy import signal
-from scipy.interpolate import LSQUnivariateSpline, UnivariateSpline
-import matplotlib.pyplot as plt
+# NOTE: scipy.optimize, scipy.interpolate and gatspy are imported inside the
+# functions that need them, to keep "import detrend" fast
 
 
 def rolling_poly(time, flux, error, order=3, window=0.5):
@@ -146,6 +142,60 @@ def FindGaps(time, maxgap=0.125, minspan=2.0):
     return gap_out, left, right
 
 
+def GapGuard(time, indx, gapwindow=0.1, dl=None, dr=None):
+    '''
+    Remove the candidate points that are within gapwindow of a gap edge.
+    Instead of looping over every gap, the edges are sorted once and each
+    point only checks its nearest edges, found with one searchsorted.
+
+    This is not always the same as the old loop in DetectCandidate and
+    MultiFind. That found the points near both edges of a span first, then
+    np.delete'd the first set before the second, so the second set of
+    indices pointed at the wrong (shifted) points. It could keep points
+    that should go, drop good ones, or raise an IndexError. GapGuard
+    removes exactly the points within gapwindow of an edge.
+
+    Parameters
+    ----------
+    time : numpy array
+    indx : int array
+        indices of the candidate points
+    gapwindow : float, optional
+        (Default is 0.1 days)
+    dl, dr : int arrays, optional
+        left and right edges of the data spans, as from FindGaps. Default is
+        to treat the whole light curve as 1 span, i.e. only guard the first
+        and last points
+
+    Returns
+    -------
+    the indices in indx that are not near a gap edge
+    '''
+    indx = np.asarray(indx, dtype='int')
+    if len(indx) == 0 or len(time) == 0:
+        return indx
+
+    if dl is None or dr is None:
+        dl = [0]
+        dr = [len(time)]
+
+    # every edge has the same window around it, so a point is in a
+    # forbidden interval if it's within gapwindow of its nearest edge
+    edges = np.sort(np.concatenate((time[np.asarray(dl, dtype='int')],
+                                    time[np.asarray(dr, dtype='int') - 1])))
+    edges = edges[np.isfinite(edges)]
+    if len(edges) == 0:
+        return indx
+
+    tc = time[indx]
+    j = np.searchsorted(edges, tc)
+    left = edges[np.maximum(j - 1, 0)]
+    right = edges[np.minimum(j, len(edges) - 1)]
+    near = (np.abs(tc - left) < gapwindow) | (np.abs(tc - right) < gapwindow)
+
+    return indx[~near]
+
+
 def _sinfunc(t, per, amp, t0, yoff):
     return np.sin((t - t0) * 2.0 * np.pi / per) * amp  + yoff
 
@@ -157,7 +207,7 @@ def _sinfunc2(t, per1, amp1, t01, per2, amp2, t02, yoff):
 
 def FitSin(time, flux, error, maxnum=5, nper=20000,
            minper=0.1, maxper=30.0, plim=0.25,
-           returnmodel=True, debug=False, per2=False):
+           returnmodel=True, debug=False, per2=False, returnparams=False):
     '''
     Use Lomb Scargle to find periods, fit sins, remove, repeat.
 
@@ -173,10 +223,18 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
     maxper:
     plim:
     debug:
+    returnparams : bool, optional
+        Also return the fit, as a modelstore component (Default is False)
 
     Returns
     -------
+    The sin model (or the flux with it removed, if returnmodel=False). With
+    returnparams=True, a tuple of that and the component dict, which has
+    one [period, amplitude, t0, offset] row per sin fit
     '''
+    from scipy.optimize import curve_fit
+    from gatspy.periodic import LombScargleFast
+
     # periods = np.linspace(minper, maxper, nper)
 
     flux_out = np.array(flux, copy=True)
@@ -187,6 +245,7 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
 
     medflux = np.nanmedian(flux)
     # ti = time[dl[i]:dr[i]]
+    sin_params = []
 
     for k in range(0, maxnum):
         # Use Jake Vanderplas faster version!
@@ -228,6 +287,8 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
 
                 flux_out = flux_out - _sinfunc2(time, *pfit)
                 sin_out = sin_out + _sinfunc2(time, *pfit)
+                sin_params.append([pfit[0], pfit[1], pfit[2], pfit[6]])
+                sin_params.append([pfit[3], pfit[4], pfit[5], 0.])
 
             else:
                 p0 = [pk, 3.0 * np.nanstd(flux_out-medflux), 0.0, 0.0]
@@ -240,6 +301,7 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
 
                 flux_out = flux_out - _sinfunc(time, *pfit)
                 sin_out = sin_out + _sinfunc(time, *pfit)
+                sin_params.append(list(pfit))
 
         # add the median flux for this window BACK in
         sin_out = sin_out + medflux
@@ -251,9 +313,16 @@ def FitSin(time, flux, error, maxnum=5, nper=20000,
     #     plt.show()
 
     if returnmodel is True:
-        return sin_out
+        out = sin_out
     else:
-        return flux_out
+        out = flux_out
+
+    if returnparams is True:
+        # medflux was added back in once per trial
+        comp = {'kind': 'sin', 'params': np.array(sin_params, dtype='float').reshape(-1, 4),
+                'offset': medflux * maxnum}
+        return out, comp
+    return out
 
 
 '''
@@ -275,6 +344,7 @@ def FitMedSin(time, flux, error, nper=20000,
 
     
     # Use Jake Vanderplas supersmoother version
+    from gatspy.periodic import SuperSmoother
     pgram = SuperSmoother()
     pgram.optimizer.period_range=(minper,maxper)
     pgram = pgram.fit(time,
@@ -299,7 +369,7 @@ def FitMedSin(time, flux, error, nper=20000,
 
 def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
                 sigclip=5, pcentclip=5, returnindx=False,
-                debug=False):
+                debug=False, returnparams=False):
     '''
     Boxcar smoothing with multi-pass outlier rejection. Uses both errors
     and local scatter for rejection
@@ -320,6 +390,9 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
     pcentclip : int, optional
         % to clip for outliers, i.e. 5= keep 5th-95th percentile
         (Default is 5)
+    returnparams : bool, optional
+        Also return the points the model interpolates between, as a
+        modelstore component (Default is False)
 
     Returns
     -------
@@ -387,13 +460,18 @@ def MultiBoxcar(time, flux, error, numpass=3, kernel=2.0,
 
     indx_out = flux_i.index.values
 
+    if returnparams is True:
+        return flux_sm, {'kind': 'interp', 'x': np.array(flux_i.time_i, dtype='float'),
+                         'y': np.array(flux_i.flux, dtype='float')}
+
     if returnindx is False:
         return flux_sm
     else:
         return np.array(indx_out, dtype='int')
 
 
-def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=False):
+def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=False,
+               returnparams=False):
     '''
     IRLS = Iterative Re-weight Least Squares
 
@@ -406,12 +484,18 @@ def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=
     ksep
     numpass
     order
+    returnparams : bool, optional
+        Also return the spline knots and coefficients, as a modelstore
+        component (Default is False)
 
     Returns
     -------
-
+    The spline model. With returnparams=True, a tuple of that and the
+    component dict
     '''
 
+    from scipy.interpolate import LSQUnivariateSpline
+
     weight = 1. / (error**2.0)
 
     knots = np.arange(np.nanmin(time) + ksep, np.nanmax(time) - ksep, ksep)
@@ -436,6 +520,12 @@ def IRLSSpline(time, flux, error, Q=400.0, ksep=0.07, numpass=5, order=3, debug=
 
         weight = Q / ((error**2.0) * (chisq + Q))
 
+    if returnparams is True:
+        # the full knot vector has the end knots repeated "order" more times
+        kn = spl.get_knots()
+        t = np.concatenate((np.zeros(order) + kn[0], kn, np.zeros(order) + kn[-1]))
+        return spl(time), {'kind': 'spline', 't': t, 'c': spl.get_coeffs(), 'k': order}
+
     return spl(time)
 
 
@@ -0,0 +1,207 @@
+'''
+Fitting the aflare1 model to flares, with a limited budget per flare.
+
+The old FlareStats fit (curve_fit, no bounds) could take thousands of
+model evaluations on a bad flare before giving up, and a few of those
+per star dominated the run time. FitAflare1 uses least_squares with
+bounds, the analytic Jacobian (aflare.py), a starting guess from the
+flare's moments, and a maximum number of evaluations. FitFlares runs
+FlareStats (which uses FitAflare1) on many flares at once in a pool, and
+also reports how each fit went.
+'''
+
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from aflare import aflare1, aflare1_binned, aflare_jac, aflare1_binned_jac, aflare1_integral
+
+# the area under the unit amplitude, unit FWHM aflare1 template
+_AREA = float(aflare1_integral(-np.inf, np.inf, 0., 1., 1.))
+
+# the default number of model evaluations allowed per flare
+MAX_NFEV = 100
+
+
+def MomentGuess(time, flux):
+    '''
+    A starting guess for the aflare1 fit, from the flare's moments: the
+    time and flux of the peak, and the FWHM that gives the template the
+    same area as the flare.
+
+    Parameters
+    ----------
+    time : 1d numpy array
+    flux : 1d numpy array
+        The flare, with the continuum removed
+
+    Returns
+    -------
+    (tpeak, fwhm, ampl)
+    '''
+    time = np.asarray(time, dtype='float')
+    flux = np.asarray(flux, dtype='float')
+
+    k = np.nanargmax(flux)
+    ampl = flux[k]
+    tpeak = time[k]
+
+    dt = np.nanmedian(np.diff(time)) if len(time) > 1 else 1.
+    area = np.nansum(np.clip(flux, 0, None)) * dt
+    if ampl > 0:
+        fwhm = area / (ampl * _AREA)
+    else:
+        fwhm = dt
+    fwhm = np.clip(fwhm, dt / 2., max(time[-1] - time[0], dt))
+
+    return tpeak, fwhm, ampl
+
+
+def FitAflare1(time, flux, error=None, p0=None, exptime=None, max_nfev=MAX_NFEV):
+    '''
+    Fit one flare with aflare1, with bounds and a limited budget.
+
+    Parameters
+    ----------
+    time : 1d numpy array
+        must be sorted
+    flux : 1d numpy array
+        The flare, in relative flux with the continuum removed
+    error : 1d numpy array, optional
+        Default is to weight every point the same
+    p0 : (tpeak, fwhm, ampl), optional
+        The starting guess. Default is MomentGuess
+    exptime : float or 1d numpy array, optional
+        If given, fit the exposure averaged model (aflare1_binned)
+    max_nfev : int, optional
+        The most model evaluations to spend on this flare (Default is
+        MAX_NFEV). The best fit so far is returned if it runs out.
+
+    Returns
+    -------
+    (popt, status, nfev). status is from scipy.optimize.least_squares:
+    >0 converged, 0 ran out of evaluations, -1 bad input. If the fit could
+    not be run at all (e.g. NaN's in the data, or no data) popt is NaN's
+    and status is -2, with nfev = 0.
+    '''
+    from scipy.optimize import least_squares
+
+    time = np.asarray(time, dtype='float')
+    flux = np.asarray(flux, dtype='float')
+    if error is None:
+        wt = np.ones_like(flux)
+    else:
+        wt = 1. / np.asarray(error, dtype='float')
+
+    try:
+        # an empty or all NaN flare fails in here too, and shouldn't take
+        # the rest of the flares (e.g. a FitFlares pool) down with it
+        if p0 is None:
+            p0 = MomentGuess(time, flux)
+
+        # the peak is in the window, the flare is at least a bit narrower than
+        # a cadence and at most a few times the window, and it goes up
+        dt = np.nanmedian(np.diff(time)) if len(time) > 1 else 1.
+        span = max(time[-1] - time[0], dt)
+        peak = max(np.nanmax(np.abs(flux)), np.abs(p0[2]), 1e-10)
+        lo = np.array([time[0], dt / 100., 0.])
+        hi = np.array([time[-1], span * 5., peak * 10.])
+        if not hi[0] > lo[0]:
+            hi[0] = lo[0] + dt
+
+        x0 = np.clip(np.array([p0[0], np.abs(p0[1]), np.abs(p0[2])], dtype='float'), lo, hi)
+
+        if exptime is None:
+            resid = lambda p: (aflare1(time, *p) - flux) * wt
+            jac = lambda p: aflare_jac(time, p) * wt[:, None]
+        else:
+            resid = lambda p: (aflare1_binned(time, *p, exptime=exptime) - flux) * wt
+            jac = lambda p: aflare1_binned_jac(time, *p, exptime=exptime) * wt[:, None]
+
+        res = least_squares(resid, x0, jac=jac, bounds=(lo, hi), method='trf',
+                            x_scale='jac', max_nfev=max_nfev)
+    except (ValueError, IndexError):
+        # tried to fit bad data, shouldn't happen often
+        return np.array([np.nan, np.nan, np.nan]), -2, 0
+
+    return res.x, res.status, res.nfev
+
+
+# each worker gets the light curve once, then just the flare indices
+_fitdata = None
+
+
+def _InitFit(time, flux, error, model, exptime, max_nfev, profile):
+    global _fitdata
+    _fitdata = (time, flux, error, model, exptime, max_nfev, profile)
+
+
+def _FitOne(indx):
+    # helper for FitFlares, runs FlareStats on one flare in a worker
+    import appaloosa
+    time, flux, error, model, exptime, max_nfev, profile = _fitdata
+    fitinfo = {}
+    stats = appaloosa.FlareStats(time, flux, error, model, istart=indx[0], istop=indx[1],
+                                 exptime=exptime, max_nfev=max_nfev, fitinfo=fitinfo,
+                                 profile=profile)
+    if len(fitinfo) == 0:
+        return list(stats)
+    return list(stats) + [fitinfo['status'], fitinfo['nfev']]
+
+
+def FitFlares(time, flux, error, model, istart, istop, nproc=1, threads=False,
+              exptime=None, max_nfev=MAX_NFEV, profile='standard'):
+    '''
+    Measure the FlareStats (incl. the aflare1 fit) of many flares at once
+
+    Parameters
+    ----------
+    time, flux, error, model : 1d numpy arrays
+        As for FlareStats
+    istart, istop : int arrays
+        The start and stop index of each flare
+    nproc : int, optional
+        Number of workers to use (Default is 1, i.e. no pool)
+    threads : bool, optional
+        Use threads instead of processes (Default is False). Threads avoid
+        copying the light curve to each process, processes do not share
+        the GIL
+    exptime : float or 1d numpy array, optional
+        Passed to FlareStats, to fit the exposure averaged model
+    max_nfev : int, optional
+        The most model evaluations to spend fitting each flare
+    profile : str or list, optional
+        The FlareStats statistics to compute (Default is 'standard')
+
+    Returns
+    -------
+    DataFrame with the FlareStats columns, plus fit_status and fit_nfev
+    (see FitAflare1) for each flare if the profile has the aflare1 fit
+    '''
+    import appaloosa
+
+    order, header = appaloosa.FlareStatsPlan(profile)
+    fitted = 'aflare1' in order
+    if fitted:
+        header = header + ['fit_status', 'fit_nfev']
+
+    jobs = list(zip(istart, istop))
+    initargs = (time, flux, error, model, exptime, max_nfev, profile)
+
+    if nproc > 1 and len(jobs) > 1:
+        if threads is True:
+            pool = ThreadPool(nproc, initializer=_InitFit, initargs=initargs)
+        else:
+            pool = Pool(nproc, initializer=_InitFit, initargs=initargs)
+        rows = pool.map(_FitOne, jobs)
+        pool.close()
+        pool.join()
+    else:
+        _InitFit(*initargs)
+        rows = [_FitOne(j) for j in jobs]
+
+    out = pd.DataFrame(rows, columns=header)
+    if fitted:
+        out['fit_status'] = out['fit_status'].astype('int')
+        out['fit_nfev'] = out['fit_nfev'].astype('int')
+    return out
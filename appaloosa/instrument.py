@@ -0,0 +1,127 @@
+'''
+Per-stage timing and memory instrumentation for the flare finding pipeline
+
+Usage, e.g. in RunLC:
+
+    prof = instrument.Profiler(enabled=True, ObjectID='12345678')
+    with prof.span('QtrFlat', npts=len(time)):
+        flux_qtr = detrend.QtrFlat(time, flux_raw, qtr)
+    prof.write(outfile + '_timing.jsonl')
+
+Spans can be nested, and are named by their path (e.g. "MultiFind/FitSin").
+Each span records wall time, CPU time, the process peak RSS, and any sizes
+passed in as keywords. A disabled Profiler (or NULL) hands back one shared
+do-nothing span, so leaving the instrumentation in place costs ~nothing.
+'''
+
+import time
+import json
+import sys
+from atomic import AtomicFile
+
+try:
+    import resource
+except ImportError:
+    # e.g. on Windows, peak RSS is not recorded
+    resource = None
+
+
+def PeakRSS():
+    '''
+    The peak resident set size of this process so far, in MB
+    (NaN if it can't be measured on this platform)
+    '''
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS, kilobytes on linux
+    if sys.platform == 'darwin':
+        return rss / 1024. / 1024.
+    return rss / 1024.
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULLSPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, prof, name, info):
+        self.prof = prof
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+        self.prof._stack.append(self.name)
+        self.rss0 = PeakRSS()
+        self.cpu0 = time.process_time()
+        self.wall0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.perf_counter() - self.wall0
+        cpu = time.process_time() - self.cpu0
+        rec = {'span': '/'.join(self.prof._stack),
+               'wall_sec': wall,
+               'cpu_sec': cpu,
+               'peak_rss_mb': PeakRSS(),
+               'peak_rss_growth_mb': PeakRSS() - self.rss0}
+        rec.update(self.info)
+        self.prof.records.append(rec)
+        self.prof._stack.pop()
+        return False
+
+
+class Profiler(object):
+    '''
+    Collects timing spans for one run.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        If False, span() does nothing (Default is True)
+    kwargs : optional
+        metadata added to every record written, e.g. ObjectID. A 'Run'
+        id (the start time of the run) is added unless one is given, so
+        records from different runs can be told apart
+    '''
+    def __init__(self, enabled=True, **kwargs):
+        self.enabled = enabled
+        self.meta = dict(kwargs)
+        self.meta.setdefault('Run', time.time())
+        self.records = []
+        self._stack = []
+
+    def span(self, name, **info):
+        '''
+        A context manager timing the code inside it. Any keywords (e.g.
+        npts=len(time)) are stored with the record.
+        '''
+        if not self.enabled:
+            return _NULLSPAN
+        return _Span(self, name, info)
+
+    def write(self, filename):
+        '''
+        Write the records as JSON lines, one span per line. The file is
+        replaced (via a temporary file), so re-running a light curve
+        doesn't add a second set of records to it
+        '''
+        if not self.enabled or len(self.records) == 0:
+            return
+        with AtomicFile(filename) as tmpfile:
+            with open(tmpfile, 'w') as f:
+                for rec in self.records:
+                    out = dict(self.meta)
+                    out.update(rec)
+                    f.write(json.dumps(out, default=str) + '\n')
+        return
+
+
+# the shared disabled profiler, the default everywhere
+NULL = Profiler(enabled=False)
@@ -0,0 +1,98 @@
+'''
+On-disk cache of the parsed and cleaned light curves made by appaloosa.Get
+
+Each light curve is stored as one uncompressed .npy file holding a
+(6, N) float64 array, one contiguous row per column. Hits are loaded back
+with a memory map, so re-running the pipeline with new detection parameters
+skips the FITS/CSV parsing, dropna, cadence and error estimates.
+
+Files are keyed by the source path, size, modification time and the
+loader version. Bump LOADER_VERSION whenever Get (or a GetLC* function)
+changes what it returns, which will invalidate all old cache entries.
+'''
+
+import numpy as np
+import os
+import hashlib
+import tempfile
+
+LOADER_VERSION = 2
+
+# the row order of the cached arrays, same order as Get returns them
+COLUMNS = ('qtr', 'time', 'quality', 'exptime', 'flux_raw', 'error')
+
+
+def CacheKey(file, mode, **kwargs):
+    '''
+    Build the cache key for a light curve file
+
+    Parameters
+    ----------
+    file : str
+        path to the light curve file
+    mode : str
+        the loader mode used by appaloosa.Get (e.g. 'fits', 'txt')
+    kwargs : optional
+        any other loader options that change the output (e.g. win_size)
+
+    Returns
+    -------
+    hex string
+    '''
+    st = os.stat(file)
+    opts = ','.join([k + '=' + str(kwargs[k]) for k in sorted(kwargs)])
+    keystr = '|'.join([os.path.abspath(file), str(st.st_size),
+                       str(st.st_mtime_ns), mode, opts,
+                       str(LOADER_VERSION)])
+    return hashlib.sha1(keystr.encode('utf-8')).hexdigest()
+
+
+def CacheLoad(cachedir, key):
+    '''
+    Load a cached light curve through a (copy-on-write) memory map
+
+    Returns
+    -------
+    tuple of 1-d arrays in the order of COLUMNS, or None if not cached
+    '''
+    cfile = os.path.join(cachedir, key + '.npy')
+    if not os.path.isfile(cfile):
+        return None
+
+    try:
+        data = np.load(cfile, mmap_mode='c')
+    except (ValueError, IOError):
+        # truncated or otherwise unreadable, treat as a miss
+        return None
+
+    if (data.ndim != 2) or (data.shape[0] != len(COLUMNS)):
+        return None
+
+    return tuple(data[k] for k in range(len(COLUMNS)))
+
+
+def CacheSave(cachedir, key, qtr, time, quality, exptime, flux_raw, error):
+    '''
+    Save the cleaned light curve arrays. The file is written to a temporary
+    name and renamed in to place, so partial files never look like hits.
+    '''
+    if not os.path.isdir(cachedir):
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            pass
+
+    data = np.empty((len(COLUMNS), len(time)), dtype='float64')
+    for k, col in enumerate((qtr, time, quality, exptime, flux_raw, error)):
+        data[k] = col
+
+    fd, tmpfile = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmpfile, os.path.join(cachedir, key + '.npy'))
+    except OSError:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+    return
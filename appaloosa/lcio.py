@@ -0,0 +1,137 @@
+'''
+File-format backends for reading light curves, used by appaloosa.Get
+
+astropy is only imported when a FITS file is actually read.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def ReadFitsColumns(file, columns, ext=1):
+    '''
+    Read only the requested columns from a FITS binary table.
+
+    The file is opened with a memory map, and each column is converted from
+    the FITS big-endian type to native float64 in a single pass, straight
+    in to a preallocated buffer. Nothing else in the table is copied.
+
+    Parameters
+    ----------
+    file : str
+        the FITS file location
+    columns : list of str
+        the names of the table columns to read, e.g. ['TIME', 'SAP_FLUX']
+    ext : int, optional
+        the extension holding the table (Default is 1)
+
+    Returns
+    -------
+    dict of 1-d float64 numpy arrays, keyed by column name
+    '''
+    from astropy.io import fits
+
+    out = {}
+    with fits.open(file, memmap=True) as hdu:
+        data_rec = hdu[ext].data
+        n = len(data_rec)
+        for col in columns:
+            buf = np.empty(n, dtype='float64')
+            np.copyto(buf, data_rec.field(col), casting='unsafe')
+            out[col] = buf
+        # drop the reference so the memory map can be closed
+        del data_rec
+
+    return out
+
+
+def GetLCfits(file, ftype='sap'):
+    
+    '''
+    Parameters
+    ----------
+    file : light curve file location for a MAST archive .fits file
+    ftype : str, optional
+        Which flux to use, 'sap' (Default) or 'pdc' for the PDCSAP flux
+
+    Returns
+    -------
+    lc: light curve DataFrame with columns [time, quality, flux_raw, error]
+    '''
+
+    if ftype == 'sap':
+        fcol = 'SAP_FLUX'
+    else:
+        fcol = 'PDCSAP_FLUX'
+
+    data = ReadFitsColumns(file, ['TIME', fcol, fcol + '_ERR', 'SAP_QUALITY'])
+    lc = pd.DataFrame({'time':data['TIME'],
+                      'flux_raw':data[fcol],
+                      'error':data[fcol + '_ERR'],
+                      'quality':data['SAP_QUALITY']})
+    
+
+    return lc
+
+
+def GetLCvdb(file):
+
+    '''
+    Parameters
+    ----------
+    file : light curve file location for a Vanderburg de-trended .txt file
+
+    Returns
+    -------
+    lc: light curve DataFrame with columns [time, flux_raw]
+    '''
+    
+    lc = pd.read_csv(file,index_col=False)
+    lc.rename(index=str, 
+              columns={'BJD - 2454833': 'time',' Corrected Flux':'flux_raw'},
+              inplace=True,
+              )
+    return lc
+
+
+def GetLCeverest(file):
+    
+    '''
+    Parameters
+    ----------
+    file : light curve file location for a Vanderburg de-trended .txt file
+
+    Returns
+    -------
+    lc: light curve DataFrame with columns [time, flux_raw]
+    '''
+    
+    data = ReadFitsColumns(file, ['TIME', 'FLUX'])
+    lc = pd.DataFrame({'time':data['TIME'],
+                      'flux_raw':data['FLUX'],})
+    #keep the outliers... for now
+    #lc['quality'] = data_rec['OUTLIER'].byteswap().newbyteorder()
+  
+    return lc
+
+
+def GetLCtxt(file):
+
+    '''
+    Parameters
+    ----------
+    file : light curve file location for a basic .txt file
+
+    Returns
+    -------
+    lc: light curve DataFrame with columns [time, flux_raw, error]
+    '''
+    
+    lc = pd.read_csv(file,
+                     index_col=False,
+                     usecols=(0,1,2),
+                     skiprows=1,
+                     header = None,
+                     names = ['time','flux_raw','error'])
+        
+    return lc
@@ -0,0 +1,224 @@
+'''
+Light curve sources for the database mode of appaloosa (see GetLCdb)
+
+A source keeps one open connection for its lifetime, fetches many KEPLERIDs
+per query, and only waits (with exponential backoff) when a query fails
+with one of the driver's errors. Anything else (e.g. the driver isn't
+installed, or a bug) is raised straight away.
+
+MySQLSource talks to the UW "Kepler" database. SQLiteSource reads a local
+file with the same Kepler.source schema, so the database path can be run
+and tested offline.
+'''
+
+import numpy as np
+import abc
+import time
+import sqlite3
+
+# the light curve columns returned for each KEPLERID, in order
+COLUMNS = ['QUARTER', 'TIME', 'PDCSAP_FLUX', 'PDCSAP_FLUX_ERR',
+           'SAP_QUALITY', 'LCFLAG', 'SAP_FLUX', 'SAP_FLUX_ERR']
+
+
+class LCSource(abc.ABC):
+    '''
+    Base class for a database of light curves with the Kepler.source schema.
+    Subclasses provide connect() and the DB-API "errors" to retry on.
+
+    Parameters
+    ----------
+    ntry : int, optional
+        How many times to try a query before giving up (Default is 10)
+    backoff : float, optional
+        Seconds to wait after the first failure, doubled after each
+        following failure (Default is 1)
+    maxwait : float, optional
+        The longest single wait between tries, in seconds (Default is 60)
+    batchsize : int, optional
+        Max number of KEPLERIDs to put in each query (Default is 100)
+    emptytry : int, optional
+        How many more times to ask for KEPLERIDs that came back with no
+        data, in case the database was only briefly unhappy (Default is 2).
+        Objects that really aren't in the database cost this many extra
+        queries.
+    '''
+    placeholder = '%s'
+    # the driver's exceptions that are worth re-trying a query for
+    errors = ()
+
+    def __init__(self, ntry=10, backoff=1.0, maxwait=60.0, batchsize=100,
+                 emptytry=2):
+        self.ntry = ntry
+        self.backoff = backoff
+        self.maxwait = maxwait
+        self.batchsize = batchsize
+        self.emptytry = emptytry
+        self.conn = None
+
+    @abc.abstractmethod
+    def connect(self):
+        '''
+        Open and return a new DB-API connection
+        '''
+
+    def connection(self):
+        # reuse the open connection, only connect the first time (or after
+        # a failure closed it)
+        if self.conn is None:
+            self.conn = self.connect()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except self.errors:
+                pass
+        self.conn = None
+
+    def query(self, query, args=()):
+        '''
+        Run a query and return all rows. On failure the connection is
+        dropped and the query re-tried after an exponential backoff.
+        '''
+        for k in range(self.ntry):
+            try:
+                cur = self.connection().cursor()
+                cur.execute(query, args)
+                rows = cur.fetchall()
+                cur.close()
+                return rows
+            except self.errors:
+                self.close()
+                if k == self.ntry - 1:
+                    raise
+                time.sleep(min(self.backoff * 2.**k, self.maxwait))
+
+    def fetch(self, objectids, type=''):
+        '''
+        Get the light curves for many objects.
+
+        Parameters
+        ----------
+        objectids : list of KEPLERIDs
+        type : str, optional
+            If either 'slc' or 'llc' then just get 1 type of cadence. Default
+            is empty, so gets both
+
+        Returns
+        -------
+        dict of numpy arrays, keyed by int(KEPLERID). Each array has the
+        columns in COLUMNS, sorted by TIME. Objects with no data get an
+        empty (0, 8) array.
+        '''
+        ids = [int(k) for k in objectids]
+        out = {}
+
+        self._fetch(ids, type, out)
+
+        # like the old one-at-a-time queries, give objects with no data
+        # another go before believing it
+        for k in range(self.emptytry):
+            missing = [kid for kid in ids if kid not in out]
+            if len(missing) == 0:
+                break
+            time.sleep(min(self.backoff * 2.**k, self.maxwait))
+            self._fetch(missing, type, out)
+
+        for kid in ids:
+            if kid not in out:
+                out[kid] = np.zeros((0, len(COLUMNS)))
+
+        return out
+
+    def _fetch(self, ids, type, out):
+        # query for the ids in batches, and put the light curves in out
+        for i in range(0, len(ids), self.batchsize):
+            batch = ids[i:i+self.batchsize]
+
+            query = 'SELECT KEPLERID, ' + ', '.join(COLUMNS) + \
+                    ' FROM Kepler.source WHERE KEPLERID IN (' + \
+                    ', '.join([self.placeholder] * len(batch)) + ')'
+
+            # only get SLC or LLC data if requested
+            if type == 'slc':
+                query = query + ' AND LCFLAG=0 '
+            if type == 'llc':
+                query = query + ' AND LCFLAG=1 '
+
+            query = query + ' ORDER BY KEPLERID, TIME;'
+
+            rows = self.query(query, tuple(batch))
+            data = np.array(rows, dtype='float').reshape(-1, len(COLUMNS) + 1)
+
+            # rows come back grouped by KEPLERID, so split at the ID changes
+            uid, first = np.unique(data[:, 0], return_index=True)
+            for kid, lc in zip(uid, np.split(data[:, 1:], first[1:])):
+                out[int(kid)] = lc
+        return
+
+
+class MySQLSource(LCSource):
+    '''
+    The UW Kepler MySQL database. The "auth.txt" file (host, user, password)
+    is only read once, when the source is made. MySQLdb is imported then
+    too, so a missing driver fails straight away instead of being re-tried.
+    '''
+    def __init__(self, authfile='auth.txt', **kwargs):
+        import MySQLdb
+        LCSource.__init__(self, **kwargs)
+        self.errors = (MySQLdb.Error,)
+        # this holds the keys to the db... don't put on github!
+        self.auth = np.loadtxt(authfile, dtype='str')
+
+    def connect(self):
+        import MySQLdb
+        return MySQLdb.connect(passwd=self.auth[2], db="Kepler",
+                               user=self.auth[1], host=self.auth[0])
+
+
+class SQLiteSource(LCSource):
+    '''
+    A local SQLite file with the same Kepler.source schema as the MySQL
+    database. The file is attached as "Kepler", so queries are unchanged.
+    '''
+    placeholder = '?'
+    errors = (sqlite3.Error,)
+
+    def __init__(self, dbfile, **kwargs):
+        LCSource.__init__(self, **kwargs)
+        self.dbfile = dbfile
+
+    def connect(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('ATTACH DATABASE ? AS Kepler', (self.dbfile,))
+        return conn
+
+    def create(self):
+        '''
+        Make the Kepler.source table, and the index on KEPLERID
+        '''
+        conn = self.connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS Kepler.source (KEPLERID INTEGER, ' +
+                     ', '.join([c + ' REAL' for c in COLUMNS]) + ')')
+        conn.execute('CREATE INDEX IF NOT EXISTS Kepler.source_keplerid ' +
+                     'ON source (KEPLERID, TIME)')
+        conn.commit()
+        return
+
+    def insert(self, objectid, data):
+        '''
+        Add the light curve for one object
+
+        Parameters
+        ----------
+        objectid : KEPLERID
+        data : numpy array with the columns in COLUMNS
+        '''
+        conn = self.connection()
+        rows = [(int(objectid),) + tuple(float(x) for x in row) for row in data]
+        conn.executemany('INSERT INTO Kepler.source VALUES (' +
+                         ', '.join(['?'] * (len(COLUMNS) + 1)) + ')', rows)
+        conn.commit()
+        return
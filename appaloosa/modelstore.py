@@ -0,0 +1,194 @@
+'''
+Save the detrend model of each light curve segment in a compact form, so
+it can be rebuilt on any time grid without re-fitting it.
+
+A model is a list of components, each a dict with a 'kind':
+'sin' : the FitSin periods, amplitudes, phases & offsets ('params', N x 4)
+        plus a constant 'offset'
+'spline' : the IRLSSpline B-spline knots 't', coefficients 'c', order 'k'
+'interp' : points 'x', 'y' to linearly interpolate between (MultiBoxcar,
+           or any model only known on the data's own time grid)
+and optionally a 'scale' to multiply it by. The model is the sum of them.
+
+Each segment is keyed by its first & last time and a hash of the data the
+model was fit to, see FindModel. RunLC writes these with savemodel=True:
+
+    models = modelstore.LoadModels(outfile + '_model.h5')
+    m = modelstore.FindModel(models, time[dl[i]:dr[i]], flux_gap[dl[i]:dr[i]])
+    flux_model = modelstore.EvalModel(m['components'], time[dl[i]:dr[i]])
+'''
+
+import numpy as np
+import pandas as pd
+import hashlib
+from version import __version__
+from atomic import AtomicFile
+
+# the array fields of each kind of component
+FIELDS = {'sin': ('per', 'amp', 't0', 'yoff', 'offset'),
+          'spline': ('t', 'c', 'k'),
+          'interp': ('x', 'y')}
+
+
+def DataHash(time, flux):
+    '''
+    A short hash of the time & flux arrays, to tell if a saved model was
+    fit to the same data
+    '''
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(time, dtype='float').tobytes())
+    h.update(np.ascontiguousarray(flux, dtype='float').tobytes())
+    return h.hexdigest()[0:16]
+
+
+def SegmentModel(time, flux, components, mode=3):
+    '''
+    Package the components of one segment's model with the keys it is
+    found by (see FindModel)
+    '''
+    return {'tstart': float(time[0]), 'tstop': float(time[-1]), 'npts': len(time),
+            'hash': DataHash(time, flux), 'mode': mode, 'components': components}
+
+
+def EvalModel(components, time):
+    '''
+    Rebuild a model on a time grid
+
+    Parameters
+    ----------
+    components : list of dicts
+        see the top of this file
+    time : numpy array
+
+    Returns
+    -------
+    the model flux at each time
+    '''
+    from scipy.interpolate import splev
+
+    time = np.asarray(time, dtype='float')
+    model = np.zeros_like(time)
+
+    for comp in components:
+        if comp['kind'] == 'sin':
+            m = np.zeros_like(time) + comp['offset']
+            for per, amp, t0, yoff in comp['params']:
+                m = m + np.sin((time - t0) * 2.0 * np.pi / per) * amp + yoff
+        elif comp['kind'] == 'spline':
+            # splev wants the coefficients padded out to the knot length
+            c = np.concatenate((comp['c'], np.zeros(len(comp['t']) - len(comp['c']))))
+            m = splev(time, (comp['t'], c, int(comp['k'])))
+        elif comp['kind'] == 'interp':
+            m = np.interp(time, comp['x'], comp['y'])
+        else:
+            raise ValueError('Unknown model component: ' + str(comp['kind']))
+
+        model = model + m * comp.get('scale', 1.0)
+
+    return model
+
+
+def _Flatten(seg, j, comp):
+    # one component -> a long table of (seg, comp, kind, field, value) rows
+    if comp['kind'] == 'sin':
+        p = np.asarray(comp['params'], dtype='float').reshape(-1, 4)
+        arrays = {'per': p[:, 0], 'amp': p[:, 1], 't0': p[:, 2], 'yoff': p[:, 3],
+                  'offset': [comp['offset']]}
+    else:
+        arrays = {f: np.atleast_1d(comp[f]) for f in FIELDS[comp['kind']]}
+    arrays['scale'] = [comp.get('scale', 1.0)]
+
+    fields = np.concatenate([np.repeat(f, len(arrays[f])) for f in arrays])
+    values = np.concatenate([np.asarray(arrays[f], dtype='float') for f in arrays])
+    return pd.DataFrame({'seg': seg, 'comp': j, 'kind': comp['kind'],
+                         'field': fields, 'value': values})
+
+
+def SaveModels(filename, models, metadata=None):
+    '''
+    Write a list of segment models (from SegmentModel) to an HDF5 file,
+    with tables 'segments' (one row per segment) and 'components' (every
+    value of every component, in long format)
+    '''
+    segs = pd.DataFrame([{k: m[k] for k in ('tstart', 'tstop', 'npts', 'hash', 'mode')}
+                         for m in models],
+                        columns=['tstart', 'tstop', 'npts', 'hash', 'mode'])
+    segs['seg'] = np.arange(len(models))
+
+    comps = [_Flatten(i, j, c) for i in range(len(models))
+             for j, c in enumerate(models[i]['components'])]
+    if len(comps) > 0:
+        comps = pd.concat(comps, ignore_index=True)
+    else:
+        comps = pd.DataFrame(columns=['seg', 'comp', 'kind', 'field', 'value'])
+
+    meta = {'Appaloosa-Version': __version__}
+    if metadata is not None:
+        meta.update(metadata)
+
+    # write to a temporary file and rename it in to place (see atomic.py)
+    with AtomicFile(filename) as tmpfile:
+        with pd.HDFStore(tmpfile, mode='w') as store:
+            store.put('segments', segs)
+            store.put('components', comps)
+            store.get_storer('segments').attrs.metadata = meta
+    return
+
+
+def LoadModels(filename):
+    '''
+    Read the segment models written by SaveModels
+
+    Returns
+    -------
+    list of dicts, like those from SegmentModel
+    '''
+    store = pd.HDFStore(filename, mode='r')
+    segs = store['segments']
+    comps = store['components']
+    store.close()
+
+    models = [{'tstart': r.tstart, 'tstop': r.tstop, 'npts': r.npts, 'hash': r.hash,
+               'mode': r.mode, 'components': []} for r in segs.itertuples()]
+
+    # the rows of each field are in order, so groupby keeps the arrays intact
+    for (seg, j), c in comps.groupby(['seg', 'comp'], sort=True):
+        kind = c['kind'].values[0]
+        arrays = {f: v['value'].values for f, v in c.groupby('field')}
+        comp = {'kind': kind, 'scale': arrays['scale'][0]}
+        if kind == 'sin':
+            comp['params'] = np.vstack([arrays[f] for f in ('per', 'amp', 't0', 'yoff')]).T
+            comp['offset'] = arrays['offset'][0]
+        elif kind == 'spline':
+            comp.update({'t': arrays['t'], 'c': arrays['c'], 'k': int(arrays['k'][0])})
+        else:
+            comp.update({'x': arrays['x'], 'y': arrays['y']})
+        models[int(seg)]['components'].append(comp)
+
+    return models
+
+
+def FindModel(models, time, flux=None):
+    '''
+    Find the saved model for a segment of data
+
+    Parameters
+    ----------
+    models : list of dicts
+        from LoadModels
+    time : numpy array
+        the time of the segment
+    flux : numpy array, optional
+        If given, the model must also have been fit to exactly this flux
+        (checked by the DataHash)
+
+    Returns
+    -------
+    the model dict, or None if there isn't one
+    '''
+    for m in models:
+        if (m['npts'] == len(time) and m['tstart'] == time[0] and
+                m['tstop'] == time[-1]):
+            if flux is None or m['hash'] == DataHash(time, flux):
+                return m
+    return None
@@ -0,0 +1,157 @@
+'''
+Diagnostic plots for the flare finding in appaloosa.py
+
+Kept separate so that matplotlib is only imported when a plot is made.
+'''
+
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+matplotlib.rcParams.update({'font.size':18})
+matplotlib.rcParams.update({'font.family':'serif'})
+
+
+def PlotCompleteness(ed_fake, frac_rec, rl, frac_rec_sm, ed68_i, ed90_i,
+                     outfile, show=True):
+    '''
+    The fake flare recovery (completeness) curve from RunLC
+    '''
+    plt.figure()
+    plt.plot(ed_fake, frac_rec, c='k')
+    plt.plot(ed_fake[rl], frac_rec_sm, c='red', linestyle='dashed', lw=2)
+    plt.vlines([ed68_i, ed90_i], ymin=0, ymax=1, colors='b',alpha=0.75, lw=5)
+    plt.xlabel('Flare Equivalent Duration (seconds)')
+    plt.ylabel('Fraction of Recovered Flares')
+
+    plt.xlim((0,np.nanmax(ed_fake)))
+    plt.savefig(outfile, dpi=300, bbox_inches='tight', pad_inches=0.5)
+    if show is True:
+        plt.show()
+    plt.close()
+    return
+
+
+def PlotLightcurve(time, flux_gap, flux_model, istart, istop,
+                   outfile, show=True):
+    '''
+    A chunk of the flattened light curve, with the model and flares from RunLC
+    '''
+    plt.figure()
+    plt.plot(time, flux_gap, 'k', alpha=0.7, lw=0.8)
+
+    for g in range(len(istart)):
+        plt.plot(time[istart[g]:istop[g]+1],
+                 flux_gap[istart[g]:istop[g]+1],color='red', lw=1)
+
+    plt.plot(time, flux_model, 'blue', lw=3, alpha=0.7)
+
+
+    plt.xlabel('Time (BJD - 2454833 days)')
+    plt.ylabel(r'Flux (e- sec$^{-1}$)')
+
+    xdur = np.nanmax(time) - np.nanmin(time)
+    xdur0 = np.nanmin(time) + xdur/2.
+    xdur1 = np.nanmin(time) + xdur/2. + 2.6
+    plt.xlim(xdur0, xdur1) # only plot a chunk of the data
+
+    xdurok = np.where((time >= xdur0) & (time <= xdur1))
+    if len(xdurok[0])>0:
+        yminmax = [np.nanmin(flux_gap[xdurok]), np.nanmax(flux_gap[xdurok])]
+        if sum(np.isfinite(yminmax)) > 1:
+            plt.ylim(yminmax[0], yminmax[1])
+
+    plt.savefig(outfile, dpi=300, bbox_inches='tight', pad_inches=0.5)
+    if show is True:
+        plt.show()
+    plt.close()
+    return
+
+
+def PlotMultiFind(time, flux, flux_model, cand1, outfile='', show=True):
+    '''
+    The debugging plot from MultiFind: data, model and flare candidate points
+    '''
+    plt.figure()
+    plt.title('debugging plot')
+    plt.scatter(time, flux, alpha=0.5,label='flux')
+    plt.plot(time,flux_model, c='black',label='flux model')
+    plt.scatter(time[cand1], flux[cand1], c='red',label='flare candidates')
+    plt.legend()
+    if outfile != '':
+        plt.savefig(outfile, dpi=300, bbox_inches='tight', pad_inches=0.5)
+    if show is True:
+        plt.show()
+    plt.close()
+    return
+
+
+def RenderDiagnostics(diagfile, prefix='', show=False, multifind=False):
+    '''
+    Draw the diagnostic plots from the data products that RunLC saves with
+    diagnostics=True (see appaloosa.SaveDiagnostics).
+
+    Parameters
+    ----------
+    diagfile : str
+        The "_diag.h5" file from RunLC
+    prefix : str, optional
+        Start of the output .pdf file names. Default is the diagfile name,
+        without the "_diag.h5"
+    show : bool, optional
+        Also show each plot on screen (Default is False)
+    multifind : bool, optional
+        Also draw the MultiFind debugging plot for every gap (Default is False)
+    '''
+    import pandas as pd
+
+    if prefix == '':
+        prefix = diagfile.replace('_diag.h5', '')
+
+    store = pd.HDFStore(diagfile, mode='r')
+    lc = store['lightcurve']
+    flares = store['flares']
+    limits = store['limits']
+    if '/completeness' in store.keys():
+        comp = store['completeness']
+    else:
+        comp = None
+    store.close()
+
+    time = lc['time'].values
+    flux = lc['flux'].values
+    flux_model = lc['flux_model'].values
+
+    if comp is not None:
+        for g in np.unique(comp['gap']):
+            c = comp[comp['gap'] == g]
+            lim = limits[limits['gap'] == g]
+            ed_fake = c['ed_fake'].values
+            rl = np.isfinite(c['frac_rec_sm'].values)
+            PlotCompleteness(ed_fake, c['frac_rec'].values, rl,
+                             c['frac_rec_sm'].values[rl],
+                             lim['ed68'].values[0], lim['ed90'].values[0],
+                             prefix + '_fake_recovered_' + str(int(g)) + '.pdf',
+                             show=show)
+
+    PlotLightcurve(time, flux, flux_model, flares['istart'].values,
+                   flares['istop'].values, prefix + '_lightcurve.pdf', show=show)
+
+    if multifind is True:
+        for g in np.unique(lc['gap']):
+            x = np.where((lc['gap'].values == g))[0]
+            cand1 = np.where((lc['cand'].values[x] > 0))[0]
+            PlotMultiFind(time[x], flux[x], flux_model[x], cand1,
+                          outfile=prefix + '_multifind_' + str(int(g)) + '.pdf',
+                          show=show)
+
+    return
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python plotting.py aprun/123/kplr000123456-2009_llc.fits_diag.h5
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 2:
+        RenderDiagnostics(sys.argv[1], prefix=sys.argv[2])
+    else:
+        RenderDiagnostics(sys.argv[1])
@@ -1,5 +1,6 @@
 import numpy as np
 import os
+from multiprocessing import Pool
 
 
 def PostCondor(flares='fakes.lis', outfile='condorout.dat'):
@@ -131,6 +132,95 @@ def PostCondor(flares='fakes.lis', outfile='condorout.dat'):
 
     return
 
+def _ReadFlareTimes(file):
+    # helper for PostFlarePer, reads the flare peak times from one output
+    import pandas as pd
+    import appaloosa
+
+    try:
+        # h5load closes the store, the with makes sure it's closed on errors too
+        with pd.HDFStore(file, mode='r') as store:
+            df, metadata = appaloosa.h5load(store)
+    except (IOError, KeyError):
+        return '', np.array([])
+
+    if df.shape[0] == 0:
+        return str(metadata['ObjectID']), np.array([])
+    return str(metadata['ObjectID']), np.array(df['t_peak'], dtype='float')
+
+
+def _ScoreFlarePer(args):
+    # helper for PostFlarePer, scores one block of stars
+    import appaloosa
+
+    times_list, minper, maxper, nper = args
+    return appaloosa.FlarePerBatch(times_list, minper=minper,
+                                   maxper=maxper, nper=nper)
+
+
+def PostFlarePer(flares='flares.lis', outfile='flareper.csv',
+                 minper=0.1, maxper=30.0, nper=20000,
+                 nproc=4, blocksize=500):
+    '''
+    Search for periodicity in the flare occurrence times of every star in
+    the catalog, using the batched FlarePerBatch from appaloosa.py
+
+    Reads the flare peak times from the "_flare.h5" outputs of RunLC,
+    combines all files (e.g. quarters) for each ObjectID, and scores all
+    stars on one shared frequency grid in parallel.
+
+    the list of flare outputs can be generated like so:
+    find aprun/* -name "*_flare.h5" > flares.lis
+
+    Parameters
+    ----------
+    flares : str, optional
+        File with the list of "_flare.h5" outputs
+    outfile : str, optional
+        Output table, with columns:
+        ObjectID, Nflares, peak_period, peak_power, false_alarm_prob
+    minper, maxper, nper : optional
+        The period grid, same as FlarePer
+    nproc : int, optional
+        Number of processes to use (Default is 4)
+    blocksize : int, optional
+        Number of stars scored together in each batch (Default is 500)
+    '''
+
+    files = np.loadtxt(flares, dtype='str', ndmin=1)
+
+    pool = Pool(nproc)
+
+    # 1) read all the flare times, group them by star
+    stars = {}
+    for objectid, tpeak in pool.imap(_ReadFlareTimes, files, chunksize=64):
+        if objectid == '':
+            continue
+        stars.setdefault(objectid, []).append(tpeak)
+
+    kics = sorted(stars.keys())
+    times_list = [np.sort(np.concatenate(stars[k])) for k in kics]
+
+    # 2) score blocks of stars in parallel, all on the same frequency grid
+    jobs = [(times_list[i:i+blocksize], minper, maxper, nper)
+            for i in range(0, len(kics), blocksize)]
+    results = pool.map(_ScoreFlarePer, jobs)
+    pool.close()
+    pool.join()
+
+    fout = open(outfile, 'w')
+    fout.write('# ObjectID, Nflares, peak_period, peak_power, false_alarm_prob \n')
+    k = 0
+    for pk, pp, fap in results:
+        for i in range(len(pk)):
+            fout.write(kics[k] + ', ' + str(len(times_list[k])) + ', ' +
+                       str(pk[i]) + ', ' + str(pp[i]) + ', ' + str(fap[i]) + '\n')
+            k = k + 1
+    fout.close()
+
+    return
+
+
 if __name__ == "__main__":
     # import sys
     PostCondor()
@@ -5,7 +5,6 @@ Code originally from here: https://github.com/jradavenport/rayleigh
 '''
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 def RayleighTest(t, v):
@@ -24,13 +23,132 @@ def RayleighTest(t, v):
     return z
 
 
-def RayleighPowerSpectrum(times, minper=1.0, maxper=500., nper=100):
+def _SinCosSums(times, freqs, offsets, chunk=2**22):
+    '''
+    Sum sin and cos of the phases over events, in blocks of frequencies.
+
+    Parameters
+    ----------
+    times : 1-d numpy array
+        event times for all stars, concatenated
+    freqs : 1-d numpy array
+    offsets : 1-d numpy array
+        index in "times" where each star's events begin (for reduceat)
+    chunk : int, optional
+        max number of (event x frequency) elements held in memory at once
+
+    Returns
+    -------
+    S, C : 2-d numpy arrays, shape (N stars, N frequencies)
+    '''
+    nfreq = len(freqs)
+    S = np.zeros((len(offsets), nfreq))
+    C = np.zeros((len(offsets), nfreq))
+
+    # how many frequencies fit in one block, given the number of events
+    fstep = max(1, int(chunk / max(1, len(times))))
+
+    for i in range(0, nfreq, fstep):
+        theta = (2. * np.pi) * np.outer(times, freqs[i:i+fstep])
+        S[:, i:i+fstep] = np.add.reduceat(np.sin(theta), offsets, axis=0)
+        C[:, i:i+fstep] = np.add.reduceat(np.cos(theta), offsets, axis=0)
+
+    return S, C
+
+
+def _SinCosRecurrence(times, f0, df, nfreq, offsets, chunk=2**22, reseed=100):
+    '''
+    Sum sin and cos of the phases over events for a uniform frequency grid,
+    a block of B frequencies at a time, stepping the whole block along the
+    grid with the trig recurrence:
+        exp(i 2pi (f + B df) t) = exp(i 2pi f t) * exp(i 2pi B df t)
+
+    Each block then costs one complex multiply instead of a sin and a cos,
+    and memory is bounded by "chunk" like _SinCosSums. The phases are
+    re-computed exactly every "reseed" blocks to stop round-off from
+    building up.
+    '''
+    S = np.zeros((len(offsets), nfreq))
+    C = np.zeros((len(offsets), nfreq))
+
+    # how many frequencies fit in one block, given the number of events
+    fstep = int(min(nfreq, max(1, chunk / max(1, len(times)))))
+    block = f0 + df * np.arange(fstep)
+    step = np.exp((2j * np.pi * df * fstep) * times)[:, None]
+
+    for j, i in enumerate(range(0, nfreq, fstep)):
+        if (j % reseed) == 0:
+            z = np.exp((2j * np.pi) * np.outer(times, block + df * i))
+        else:
+            z = z * step
+        n = min(fstep, nfreq - i)
+        S[:, i:i+n] = np.add.reduceat(z.imag[:, :n], offsets, axis=0)
+        C[:, i:i+n] = np.add.reduceat(z.real[:, :n], offsets, axis=0)
+
+    return S, C
+
+
+def RayleighPowerBatch(times_list, freqs, method='block', chunk=2**22):
+    '''
+    Evaluate the normalized Rayleigh test for many lists of event times
+    (e.g. the flare peak times of many stars) over the same frequency grid.
+
+    Parameters
+    ----------
+    times_list : list of 1-d arrays
+        event times for each star. Stars with no events get z=0
+    freqs : 1-d numpy array
+        frequency grid, in units of 1/time
+    method : str, optional
+        'block' (Default) evaluates the sums in blocked matrix form over
+        (events x frequencies). 'recurrence' does the same blocks, but
+        steps them along the frequency grid with a trig recurrence instead
+        of calling sin and cos, which is faster for dense grids. The
+        recurrence requires a uniformly spaced grid.
+    chunk : int, optional
+        The max number of (event x frequency) elements to hold in memory
+        at once (Default is 2**22)
+
+    Returns
+    -------
+    z : 2-d numpy array, shape (N stars, N frequencies)
+    '''
+    freqs = np.asarray(freqs, dtype='float')
+    nevent = np.array([np.size(t) for t in times_list], dtype='int')
+
+    z = np.zeros((len(times_list), len(freqs)))
+    has = np.flatnonzero(nevent > 0)
+    if len(has) == 0:
+        return z
+
+    times = np.concatenate([np.asarray(times_list[k], dtype='float').ravel()
+                            for k in has])
+    offsets = np.append(0, np.cumsum(nevent[has])[:-1])
+
+    if method == 'recurrence':
+        df = freqs[1] - freqs[0] if len(freqs) > 1 else 0.
+        if not np.allclose(np.diff(freqs), df):
+            raise ValueError('method="recurrence" requires a uniform frequency grid')
+        S, C = _SinCosRecurrence(times, freqs[0], df, len(freqs), offsets, chunk=chunk)
+    else:
+        S, C = _SinCosSums(times, freqs, offsets, chunk=chunk)
+
+    z[has, :] = (S**2. + C**2.) / nevent[has][:, None]
+    return z
+
+
+def RayleighPowerSpectrum(times, minper=1.0, maxper=500., nper=100,
+                          method='block'):
     '''
     Compute the power spectrum over a range of periods by evaluating the
     Rayleigh test at each frequency.
 
     Periods are assumed to be in units of Days.
 
+    Returns
+    -------
+    z : 1-d numpy array, the Rayleigh power at each of the "nper"
+        linearly spaced frequencies
     '''
 
     maxfreq = 1. / (minper * 24. * 60. * 60.)
@@ -41,8 +159,9 @@ def RayleighPowerSpectrum(times, minper=1.0, maxper=500., nper=100):
 
     # periods = 1. / freqs / (24. * 60. * 60.)
 
-    z = map(lambda v: RayleighTest(times * (24. * 60. * 60.), v), freqs)
-    return z
+    z = RayleighPowerBatch([np.asarray(times) * (24. * 60. * 60.)], freqs,
+                           method=method)
+    return z[0]
 
 
 def DrogeTest():
@@ -52,6 +171,7 @@ def DrogeTest():
 
     Remake Figure 2 for 64 solar flare events.
     '''
+    import matplotlib.pyplot as plt
 
     # Table 1, Occurance Times of ISEE 3 Electron Flares
     # Units of Days since 01-AUG-1978
@@ -90,4 +210,4 @@ def DrogeTest():
     plt.ylabel('Rayleigh power (z)')
     plt.show()
 
-    return
\ No newline at end of file
+    return
@@ -0,0 +1,116 @@
+'''
+Run-length encoding of candidate masks, shared by the flare finding in
+appaloosa.py (FINDflare, DetectCandidate, MultiFind).
+
+Everything here is vectorized (diff + flatnonzero), so there are no loops
+over cadences, which matters for 130k point SLC quarters that get searched
+many times per star once the fake flare injection is counted.
+'''
+
+import numpy as np
+
+
+def Runs(mask, minlen=1):
+    '''
+    Find the runs of consecutive True values in a boolean mask
+
+    Parameters
+    ----------
+    mask : numpy array
+        bool (or 0/1) array
+    minlen : int, optional
+        Only return runs at least this many points long (Default is 1).
+        This is the N3 rule in FINDflare
+
+    Returns
+    -------
+    (start index, stop index, length) of each run. The stop index is
+    inclusive, i.e. the last True point in the run
+    '''
+    m = np.asarray(mask, dtype='bool').astype('int8')
+
+    # +1 where a run starts, -1 just after a run stops
+    d = np.diff(np.concatenate(([0], m, [0])))
+    start = np.flatnonzero(d == 1)
+    stop = np.flatnonzero(d == -1) - 1
+    length = stop - start + 1
+
+    if minlen > 1:
+        keep = length >= minlen
+        start, stop, length = start[keep], stop[keep], length[keep]
+
+    return start, stop, length
+
+
+def GroupIndices(indx, minsep=0):
+    '''
+    Combine a sorted list of candidate indices in to events, where any two
+    candidates closer than (or equal to) minsep points apart are in the same
+    event.
+
+    Parameters
+    ----------
+    indx : numpy array
+        sorted int array of candidate indices
+    minsep : int, optional
+        The number of datapoints required between individual events
+        (Default is 0, so only exactly consecutive indices are grouped)
+
+    Returns
+    -------
+    (start index, stop index) of each event. Empty int arrays if there are
+    no candidates
+    '''
+    indx = np.asarray(indx, dtype='int')
+    if len(indx) == 0:
+        return np.array([], dtype='int'), np.array([], dtype='int')
+
+    brk = np.flatnonzero(np.diff(indx) > minsep)
+    start = indx[np.concatenate(([0], brk + 1))]
+    stop = indx[np.concatenate((brk, [len(indx) - 1]))]
+    return start, stop
+
+
+def RunMask(start, stop, npts):
+    '''
+    The inverse of Runs: a 0/1 int array of length npts, which is 1 from
+    each start to stop index (inclusive). Runs may overlap.
+    '''
+    start = np.asarray(start, dtype='int')
+    stop = np.asarray(stop, dtype='int')
+
+    edge = np.zeros(npts + 1, dtype='int')
+    np.add.at(edge, start, 1)
+    np.add.at(edge, stop + 1, -1)
+    return (np.cumsum(edge[:-1]) > 0).astype('int')
+
+
+def TrimRuns(mask, keep):
+    '''
+    Shrink each run of True in mask down to the span between its first and
+    last "keep" point. Runs with no keep points in them are dropped.
+
+    Parameters
+    ----------
+    mask : numpy array
+        bool (or 0/1) array
+    keep : numpy array
+        bool array, same length as mask
+
+    Returns
+    -------
+    0/1 int array, like RunMask
+    '''
+    mask = np.asarray(mask, dtype='bool')
+    start, stop, _ = Runs(mask)
+
+    up = np.flatnonzero(mask & np.asarray(keep, dtype='bool'))
+    if len(up) == 0:
+        return np.zeros(len(mask), dtype='int')
+
+    # which run each keep point is in, then the first & last one per run
+    run = np.searchsorted(stop, up)
+    first = np.flatnonzero(np.concatenate(([True], run[1:] != run[:-1])))
+    last = np.concatenate((first[1:] - 1, [len(up) - 1]))
+
+    return RunMask(up[first], up[last], len(mask))
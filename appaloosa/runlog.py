@@ -0,0 +1,113 @@
+'''
+A log of which light curves have been run, so a big batch can be resumed
+after a partial failure instead of guessing from the output files.
+
+The log is a small SQLite database with one row per input file: a hash of
+the file's contents, its status ('running', 'done' or 'failed'), the run
+time, the Appaloosa version and a hash of the RunLC parameters. A file only
+counts as done if it finished with the same contents, version and
+parameters, so changing any of them re-runs it.
+
+    log = runlog.OpenLog('run1_runlog.db')
+    key = runlog.Key(file, params)
+    if not runlog.IsDone(log, key):
+        ...
+        runlog.Record(log, key, 'done', wall_sec=dt)
+
+worker.RunShard keeps one of these next to each shard's output, and
+shards.RunLocal will with logfile=. ReadLog collects them in to a table.
+'''
+
+import json
+import socket
+import sqlite3
+import hashlib
+import datetime
+import pandas as pd
+from version import __version__
+
+# RunLC options that don't change the results, left out of the parameter hash
+IGNORE = ('debug', 'display', 'verbosefake', 'store', 'source', 'profile',
+          'diagnostics', 'cachedir', 'nproc')
+
+
+def FileHash(file, blocksize=2**20):
+    '''
+    A short hash of a file's contents. If the file can't be read (or the
+    "file" is really an object ID, as for dbmode='mysql') the hash of the
+    name is used instead, so it still gets a row in the log.
+    '''
+    h = hashlib.sha1()
+    try:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+    except (IOError, OSError):
+        h = hashlib.sha1(('name:' + str(file)).encode('utf-8'))
+    return h.hexdigest()[0:16]
+
+
+def ParamHash(params):
+    '''
+    A short hash of a dict of RunLC parameters (anything in IGNORE is
+    left out)
+    '''
+    use = {k: params[k] for k in params if k not in IGNORE}
+    s = json.dumps(use, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[0:16]
+
+
+def Key(file, params):
+    '''
+    The (file, file hash, parameter hash) a run is logged under
+    '''
+    return str(file), FileHash(file), ParamHash(params)
+
+
+def OpenLog(filename):
+    '''
+    Open (or create) a run log. Returns the sqlite3 connection.
+    '''
+    log = sqlite3.connect(filename, timeout=60)
+    log.execute('CREATE TABLE IF NOT EXISTS runs ('
+                'file TEXT PRIMARY KEY, filehash TEXT, status TEXT, '
+                'version TEXT, params TEXT, wall_sec REAL, date TEXT, '
+                'host TEXT, error TEXT)')
+    log.commit()
+    return log
+
+
+def IsDone(log, key, version=__version__):
+    '''
+    Has this file (with the same contents) already been run to the end,
+    with this version of the code and these parameters?
+    '''
+    row = log.execute('SELECT filehash, status, version, params FROM runs WHERE file=?',
+                      (key[0],)).fetchone()
+    return row is not None and tuple(row) == (key[1], 'done', version, key[2])
+
+
+def Record(log, key, status, wall_sec=0., error=''):
+    '''
+    Set the status of a file in the log (replacing any earlier run of it)
+    '''
+    log.execute('INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?,?)',
+                (key[0], key[1], status, __version__, key[2], float(wall_sec),
+                 str(datetime.datetime.now()), socket.gethostname(), error))
+    log.commit()
+    return
+
+
+def ReadLog(files):
+    '''
+    Read one or more run logs in to a DataFrame, one row per file
+    '''
+    if isinstance(files, str):
+        files = [files]
+
+    out = []
+    for file in files:
+        log = sqlite3.connect(file)
+        out.append(pd.read_sql_query('SELECT * FROM runs', log))
+        log.close()
+    return pd.concat(out, ignore_index=True)
@@ -0,0 +1,287 @@
+'''
+Split a big list of light curves in to shards that should each take about
+the same time to run, for Condor (see condor.PrepWWU) or a local runner.
+
+An SLC file has ~30x the cadences of an LLC file, so splitting the file
+list in to equal-count chunks leaves some shards running for days after
+the rest are done. Instead the cost of each file is estimated, either
+from its FITS header (the number of cadences) or from the _timing.jsonl
+of a previous run (see instrument.py), and files are packed in to shards
+longest first, always on to the least loaded shard (the LPT rule).
+
+    man = shards.PlanShards(files, nshard=100, timing=glob.glob('*_timing.jsonl'),
+                            outfile='run1_shards.json')
+    # then run each shard, e.g.
+    # $ python shards.py run run1_shards.json 7
+'''
+
+import numpy as np
+import os
+import sys
+import json
+import heapq
+import datetime
+from version import __version__
+
+# typical number of cadences per file, when the header can't be read
+NPTS_DEFAULT = {'llc': 4500, 'slc': 45000}
+
+
+def Cadence(file):
+    '''
+    Is this a long ('llc') or short ('slc') cadence file? From the name,
+    as for the Kepler files (kplr..._llc.fits). Default is 'llc'
+    '''
+    if os.path.basename(file).find('slc') >= 0:
+        return 'slc'
+    return 'llc'
+
+
+def HeaderNpts(file):
+    '''
+    The number of cadences in a FITS light curve, from the header only
+    (NAXIS2 of the light curve table). -1 if it can't be read
+    '''
+    from astropy.io import fits
+    try:
+        return int(fits.getheader(file, 1)['NAXIS2'])
+    except (IOError, OSError, KeyError, IndexError):
+        return -1
+
+
+def ReadTiming(files):
+    '''
+    Collect the run time and size of each light curve from the
+    _timing.jsonl files of previous runs (see RunLC's profile option)
+
+    Returns
+    -------
+    dict of File: (wall seconds, number of cadences). The time is the sum
+    of the top level spans, the size from the QtrFlat span. If a file was
+    run more than once, only its latest run (by the records' 'Run' id) is
+    used. Old records without a Run id count as one run, older than any
+    with one.
+    '''
+    runs = {}
+    for tfile in files:
+        for line in open(tfile, 'r'):
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            name = rec.get('File', '')
+            if name == '' or rec.get('span', '/').find('/') >= 0:
+                continue
+            run = float(rec.get('Run', -1))
+            wall, npts = runs.setdefault(name, {}).get(run, (0., -1))
+            if rec.get('span') == 'QtrFlat':
+                npts = rec.get('npts', npts)
+            runs[name][run] = (wall + rec.get('wall_sec', 0.), npts)
+
+    return {name: runs[name][max(runs[name])] for name in runs}
+
+
+def EstimateCosts(files, timing=None, readheader=True):
+    '''
+    Predict how long each file will take to run
+
+    Parameters
+    ----------
+    files : list of str
+    timing : list of str or dict, optional
+        _timing.jsonl files from previous runs (or the output of
+        ReadTiming). Files that were timed use their measured time, and
+        the rest are scaled from their number of cadences by the median
+        seconds per cadence of the timed ones (for each cadence type)
+    readheader : bool, optional
+        Read the number of cadences from each FITS header (Default is
+        True). If False, or it can't be read, use NPTS_DEFAULT
+
+    Returns
+    -------
+    numpy array of the cost of each file, in seconds if there was timing
+    information, otherwise in cadences
+    '''
+    if timing is None:
+        timing = {}
+    elif not isinstance(timing, dict):
+        timing = ReadTiming(timing)
+
+    cad = np.array([Cadence(f) for f in files])
+    npts = np.array([HeaderNpts(f) if readheader else -1 for f in files], dtype='float')
+    bad = npts <= 0
+    npts[bad] = [NPTS_DEFAULT[c] for c in cad[bad]]
+
+    # seconds per cadence, from whatever was timed before
+    rate = {'llc': 1., 'slc': 1.}
+    if len(timing) > 0:
+        for c in rate:
+            r = [w / n for f, (w, n) in timing.items() if n > 0 and Cadence(f) == c]
+            if len(r) == 0:
+                r = [w / n for f, (w, n) in timing.items() if n > 0]
+            if len(r) > 0:
+                rate[c] = np.median(r)
+
+    cost = npts * np.array([rate[c] for c in cad])
+    for k, f in enumerate(files):
+        if f in timing:
+            cost[k] = timing[f][0]
+    return cost
+
+
+def PackShards(costs, nshard):
+    '''
+    Pack jobs in to nshard shards of about equal total cost: biggest job
+    first, each on to the shard with the least total so far (LPT)
+
+    Returns
+    -------
+    list of nshard lists of job indices
+    '''
+    costs = np.asarray(costs, dtype='float')
+    nshard = max(1, min(nshard, len(costs)))
+
+    shards = [[] for i in range(nshard)]
+    heap = [(0., i) for i in range(nshard)]
+    for k in np.argsort(-costs, kind='stable'):
+        load, i = heapq.heappop(heap)
+        shards[i].append(int(k))
+        heapq.heappush(heap, (load + costs[k], i))
+    return shards
+
+
+def MakeManifest(files, costs, shards, **kwargs):
+    '''
+    The shard manifest: the version and date, anything in kwargs, and for
+    each shard its predicted cost and its list of files
+    '''
+    costs = np.asarray(costs, dtype='float')
+    man = {'Appaloosa-Version': __version__,
+           'Date': str(datetime.datetime.now()),
+           'nshard': len(shards),
+           'shards': [{'shard': i, 'cost': float(np.sum(costs[s])),
+                       'files': [files[k] for k in s]}
+                      for i, s in enumerate(shards)]}
+    man.update(kwargs)
+    return man
+
+
+def WriteManifest(filename, man):
+    '''
+    Save a manifest (from MakeManifest) as JSON
+    '''
+    f = open(filename, 'w')
+    json.dump(man, f, indent=1)
+    f.close()
+    return
+
+
+def ReadManifest(filename):
+    '''
+    Read the manifest written by WriteManifest (a dict)
+    '''
+    f = open(filename, 'r')
+    man = json.load(f)
+    f.close()
+    return man
+
+
+def PlanShards(files, nshard=10, timing=None, readheader=True, outfile=''):
+    '''
+    Estimate the cost of every file and pack them in to shards. See
+    EstimateCosts and PackShards.
+
+    Parameters
+    ----------
+    files : list of str
+    nshard : int, optional
+        (Default is 10)
+    timing : list of str or dict, optional
+        _timing.jsonl files from previous runs, see EstimateCosts
+    readheader : bool, optional
+        Read the FITS headers for the number of cadences (Default is True)
+    outfile : str, optional
+        If set, write the manifest to this JSON file
+
+    Returns
+    -------
+    the manifest dict
+    '''
+    files = list(files)
+    if timing is not None and not isinstance(timing, dict):
+        timing = ReadTiming(timing)
+
+    costs = EstimateCosts(files, timing=timing, readheader=readheader)
+    shards = PackShards(costs, nshard)
+
+    units = 'cadences'
+    if timing is not None and len(timing) > 0:
+        units = 'seconds'
+
+    man = MakeManifest(files, costs, shards, cost_units=units)
+    if outfile != '':
+        WriteManifest(outfile, man)
+    return man
+
+
+def RunLocal(manifest, shard, logfile='', force=False, **kwargs):
+    '''
+    Run every file in one shard of a manifest with RunLC, here. Any kwargs
+    are passed to RunLC (Default dbmode='fits', nfake=100 like condor)
+
+    With a logfile (see runlog.py), files already done with this version &
+    parameters are skipped (unless force=True), and a file that fails is
+    logged and the rest of the shard still runs.
+    '''
+    import appaloosa
+    import runlog
+    import time
+    import traceback
+
+    if not isinstance(manifest, dict):
+        manifest = ReadManifest(manifest)
+
+    opts = {'dbmode': 'fits', 'nfake': 100}
+    opts.update(kwargs)
+
+    log = None
+    if logfile != '':
+        log = runlog.OpenLog(logfile)
+
+    for file in manifest['shards'][shard]['files']:
+        if log is None:
+            appaloosa.RunLC(file=file, **opts)
+            continue
+
+        key = runlog.Key(file, opts)
+        if force is False and runlog.IsDone(log, key):
+            continue
+
+        runlog.Record(log, key, 'running')
+        t0 = time.time()
+        try:
+            appaloosa.RunLC(file=file, **opts)
+            runlog.Record(log, key, 'done', wall_sec=time.time() - t0)
+        except Exception:
+            runlog.Record(log, key, 'failed', wall_sec=time.time() - t0,
+                          error=traceback.format_exc(limit=3)[-256:])
+
+    if log is not None:
+        log.close()
+    return
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python shards.py plan all_fits.lis 100 run1_shards.json [timing.jsonl ...]
+# $python shards.py run run1_shards.json 7 [run1_runlog.db]
+if __name__ == "__main__":
+    if sys.argv[1] == 'plan':
+        files = list(np.loadtxt(sys.argv[2], dtype='str', ndmin=1, usecols=(0,)))
+        man = PlanShards(files, nshard=int(sys.argv[3]), outfile=sys.argv[4],
+                         timing=sys.argv[5:] if len(sys.argv) > 5 else None)
+        cost = [s['cost'] for s in man['shards']]
+        print(str(man['nshard']) + ' shards, cost min/max: ' +
+              str(np.min(cost)) + ' / ' + str(np.max(cost)) + ' ' + man['cost_units'])
+    elif sys.argv[1] == 'run':
+        RunLocal(sys.argv[2], int(sys.argv[3]),
+                 logfile=sys.argv[4] if len(sys.argv) > 4 else '')
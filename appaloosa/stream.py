@@ -0,0 +1,346 @@
+'''
+Streaming flare detection, for photometry that arrives a chunk at a time
+(e.g. ongoing ground-based or TESS-like monitoring), instead of the whole
+light curve at once like RunLC.
+
+    sf = stream.StreamFinder(window=0.5)
+    for time, flux, error, flags in chunks:
+        for event in sf.add(time, flux, error, flags):
+            print(event['t_peak'], event['Equiv_Dur'])
+    events = sf.flush()
+
+Each point is detrended with a running median once there's half a window
+of data after it (or a gap), then searched with the FINDflare cuts, using
+the noise in the sigwindow days of residuals up to it. The consecutive-point
+(N3) and minsep rules carry across chunk boundaries, and flares are handed
+back with their FlareStats properties once they close and the continuum
+after them has come in. Only about a window's worth of data (plus any open
+flare) is kept, so memory does not grow with the light curve.
+
+The running median, the noise and the FlareStats of each flare only use
+data within a fixed time of each point, so how the data is split in to
+chunks doesn't change the flares found (see CheckChunks).
+'''
+
+import numpy as np
+import pandas as pd
+import runlength
+from appaloosa import FlareStats, FlagCuts
+
+
+class StreamFinder(object):
+    '''
+    Incremental flare finder
+
+    Parameters
+    ----------
+    window : float, optional
+        Width of the running median detrend, in days (Default is 0.5)
+    sigwindow : float, optional
+        How many days of residuals, up to and including each point, to
+        measure its noise from (Default is 2)
+    maxgap : float, optional
+        Gaps longer than this (days) start a new span of data, and the
+        detrend and flares do not cross them (Default is 0.125)
+    N1, N2, N3 : optional
+        The FINDflare coefficients (Defaults are 3, 1, 3)
+    minsep : int, optional
+        Flares closer than this many points are combined (Default is 3)
+    std_window : int, optional
+        Rolling window (in points) for the noise, as in FINDflare with
+        avg_std=True, but ending at each point instead of centered on it
+        (Default is 7)
+    '''
+    def __init__(self, window=0.5, sigwindow=2.0, maxgap=0.125,
+                 N1=3, N2=1, N3=3, minsep=3, std_window=7):
+        self.window = window
+        self.sigwindow = sigwindow
+        self.maxgap = maxgap
+        self.N1 = N1
+        self.N2 = N2
+        self.N3 = N3
+        self.minsep = minsep
+        self.std_window = std_window
+
+        self.header = FlareStats(np.arange(3.), np.ones(3), np.ones(3), np.ones(3),
+                                 ReturnHeader=True) + ['istart', 'istop']
+
+        # the bounded buffer of recent data
+        self.time = np.zeros(0)
+        self.flux = np.zeros(0)
+        self.error = np.zeros(0)
+        self.flags = np.zeros(0, dtype='int')
+        self.model = np.zeros(0)
+        self.passed = np.zeros(0, dtype='bool')
+
+        self.tref = None     # time of the very first point
+        self.offset = 0      # absolute index of the first point in the buffer
+        self.nsettled = 0    # absolute index of the first un-detrended point
+        self.run_start = -1  # absolute start of a run still open at the end
+        self.pending = []    # [start, stop] of closed flares not yet emitted
+        self.nflares = 0
+
+    def add(self, time, flux, error, flags=None):
+        '''
+        Add a chunk of data, which must come after the data already added
+
+        Returns
+        -------
+        list of dicts, one per flare that finished in this chunk. Keys are
+        the FlareStats header, plus the absolute istart/istop indices.
+        '''
+        time = np.asarray(time, dtype='float')
+        if flags is None:
+            flags = np.zeros(len(time), dtype='int')
+        if self.tref is None and len(time) > 0:
+            self.tref = time[0]
+
+        self.time = np.concatenate((self.time, time))
+        self.flux = np.concatenate((self.flux, np.asarray(flux, dtype='float')))
+        self.error = np.concatenate((self.error, np.asarray(error, dtype='float')))
+        self.flags = np.concatenate((self.flags, np.asarray(flags, dtype='int')))
+        self.model = np.concatenate((self.model, np.zeros(len(time)) + np.nan))
+        self.passed = np.concatenate((self.passed, np.zeros(len(time), dtype='bool')))
+
+        return self._process(final=False)
+
+    def flush(self):
+        '''
+        The data has ended: detrend what is left, and return the remaining
+        flares (same format as add)
+        '''
+        return self._process(final=True)
+
+    def _segments(self):
+        # index (in the buffer) where each span of data starts
+        return np.concatenate(([0], np.flatnonzero(np.diff(self.time) >= self.maxgap) + 1))
+
+    def _process(self, final=False):
+        n = len(self.time)
+        if n == 0:
+            return []
+
+        segstart = self._segments()
+
+        # which points can be detrended now: those with half a window of
+        # data after them, or a gap after them
+        i0 = self.nsettled - self.offset
+        if final:
+            i1 = n
+        else:
+            i1 = max(np.searchsorted(self.time, self.time[-1] - self.window / 2.,
+                                     side='right'), segstart[-1])
+        if i1 <= i0:
+            return []
+
+        self._detrend(i0, i1, segstart)
+        self._cuts(i0, i1, segstart)
+
+        # the first point of each span can't be in a flare (like FINDflare
+        # never flags the 1st point), which also keeps flares out of gaps
+        self.passed[segstart] = False
+
+        self._findruns(i0, i1, segstart, final)
+        self.nsettled = self.offset + i1
+
+        events = self._emit(i1, segstart, final)
+        self._trim(i1)
+        return events
+
+    def _tindex(self, j0, j1):
+        # the buffer's times as a DatetimeIndex, for pandas' time based
+        # rolling windows. Counted from the first point of the stream, so a
+        # point gets the same value whichever chunk it came in
+        return pd.Timestamp(0) + pd.to_timedelta(self.time[j0:j1] - self.tref, unit='D')
+
+    def _detrend(self, i0, i1, segstart):
+        # running median of the good points within +/- window/2 days,
+        # and within each span of data
+        good = FlagCuts(self.flags, returngood=False) < 1
+        f = np.where(good, self.flux, np.nan)
+        win = pd.Timedelta(self.window, unit='D')
+
+        segstop = np.append(segstart[1:], len(self.time))
+        for s0, s1 in zip(segstart, segstop):
+            if s1 <= i0 or s0 >= i1:
+                continue
+            med = pd.Series(f[s0:s1], index=self._tindex(s0, s1)).rolling(
+                win, center=True, min_periods=1).median()
+            j0 = max(i0, s0)
+            j1 = min(i1, s1)
+            self.model[j0:j1] = med.values[j0 - s0:j1 - s0]
+        return
+
+    def _cuts(self, i0, i1, segstart):
+        # FINDflare Eqn 3a-c on the new residuals. The median and noise of
+        # each point are from the sigwindow days of residuals ending at it
+        # (plus the std_window points before, for the rolling std)
+        k0 = np.searchsorted(self.time, self.time[i0] - self.sigwindow, side='right')
+        k0 = max(k0 - (self.std_window - 1), 0)
+
+        resid = self.flux[k0:i1] - self.model[k0:i1]
+        rstd = pd.Series(resid).rolling(self.std_window).std().values
+
+        tidx = self._tindex(k0, i1)
+        win = pd.Timedelta(self.sigwindow, unit='D')
+        med_i = pd.Series(resid, index=tidx).rolling(win, min_periods=1).median().values[i0 - k0:]
+        sig_i = pd.Series(rstd, index=tidx).rolling(win, min_periods=1).median().values[i0 - k0:]
+
+        r = resid[i0 - k0:]
+        ca = r - med_i
+        cb = np.abs(r - med_i) / sig_i
+        cc = np.abs(r - med_i - self.error[i0:i1]) / sig_i
+        bad = FlagCuts(self.flags[i0:i1], returngood=False)
+
+        self.passed[i0:i1] = (ca > 0) & (cb > self.N1) & (cc > self.N2) & (bad < 1)
+        return
+
+    def _findruns(self, i0, i1, segstart, final):
+        # re-scan from the start of any run left open by the last chunk
+        j0 = i0
+        if self.run_start >= 0:
+            j0 = self.run_start - self.offset
+        self.run_start = -1
+
+        start, stop, length = runlength.Runs(self.passed[j0:i1])
+        start = start + j0
+        stop = stop + j0
+
+        if len(start) > 0 and stop[-1] == i1 - 1 and not final:
+            # a run touching the last detrended point might keep going,
+            # unless a new span of data starts right after it
+            if not (i1 < len(self.time) and i1 in segstart):
+                self.run_start = start[-1] + self.offset
+                start, stop, length = start[:-1], stop[:-1], length[:-1]
+
+        keep = length >= self.N3
+        for s, e in zip(start[keep] + self.offset, stop[keep] + self.offset):
+            # combine with the previous flare if close, and in the same span
+            if (len(self.pending) > 0 and s - self.pending[-1][1] <= self.minsep and
+                    not np.any((segstart + self.offset > self.pending[-1][1]) &
+                               (segstart + self.offset <= s))):
+                self.pending[-1][1] = e
+            else:
+                self.pending.append([s, e])
+        return
+
+    def _emit(self, i1, segstart, final):
+        # a flare is done once minsep points have passed with no new run,
+        # and the continuum after it (1 flare duration) is detrended
+        events = []
+        tdone = self.time[i1 - 1]
+        while len(self.pending) > 0:
+            s, e = self.pending[0]
+            bs = s - self.offset
+            be = e - self.offset
+            if be == bs:
+                be = be + 1
+
+            closed = np.any((segstart > be) & (segstart <= i1))
+            if not (final or closed):
+                if self.run_start >= 0 and self.run_start - e <= self.minsep:
+                    break
+                if (i1 - 1) - be <= self.minsep:
+                    break
+                if tdone < self.time[be] + (self.time[be] - self.time[bs]):
+                    break
+
+            # hand FlareStats the flare and 1 duration of continuum either
+            # side (all it uses), in the detrended part of the span it's in
+            s0 = segstart[segstart <= bs][-1]
+            s1 = min(np.append(segstart[segstart > bs], i1)[0], i1)
+            be = min(be, s1 - 1)
+            dur = self.time[be] - self.time[bs]
+            s0 = max(s0, np.searchsorted(self.time, self.time[bs] - dur, side='left'))
+            s1 = min(s1, np.searchsorted(self.time, self.time[be] + dur, side='right'))
+
+            stats = FlareStats(self.time[s0:s1], self.flux[s0:s1], self.error[s0:s1],
+                               self.model[s0:s1], istart=bs - s0, istop=be - s0)
+            events.append(dict(zip(self.header, list(stats) + [s, e])))
+            self.pending.pop(0)
+            self.nflares = self.nflares + 1
+
+        return events
+
+    def _trim(self, i1):
+        # keep enough past data for the running median, the noise (and the
+        # rolling std before it), and the continuum & points of any flare
+        # still open or pending
+        tkeep = self.time[min(i1, len(self.time) - 1)] - max(self.window, self.sigwindow)
+        for s, e in self.pending:
+            dur = self.time[e - self.offset] - self.time[s - self.offset]
+            tkeep = min(tkeep, self.time[s - self.offset] - dur)
+        if self.run_start >= 0:
+            trun = self.time[self.run_start - self.offset]
+            tkeep = min(tkeep, trun - max(self.window, self.time[i1 - 1] - trun))
+
+        k = int(np.searchsorted(self.time, tkeep)) - (self.std_window - 1)
+        k = min(k, i1)
+        if k <= 0:
+            return
+
+        self.time = self.time[k:]
+        self.flux = self.flux[k:]
+        self.error = self.error[k:]
+        self.flags = self.flags[k:]
+        self.model = self.model[k:]
+        self.passed = self.passed[k:]
+        self.offset = self.offset + k
+        return
+
+
+def CheckChunks(chunks=(50, 500, 2000, None), ndays=10., cadence='slc', seed=42, **kwargs):
+    '''
+    Run a StreamFinder over a synthetic light curve (synthetic.SyntheticLC)
+    split in to chunks of each size, and check they all find the same
+    flares, with the same properties
+
+    Parameters
+    ----------
+    chunks : list, optional
+        The chunk sizes (in points) to try. None is the whole light curve
+        in one go, which the others are compared to
+    ndays, cadence, seed : optional
+        Passed to SyntheticLC
+    kwargs : optional
+        Passed to StreamFinder
+
+    Returns
+    -------
+    True if every chunk size gave the same flares. Raises a ValueError
+    (naming the chunk size) if not.
+    '''
+    import synthetic
+    lc, _ = synthetic.SyntheticLC(ndays=ndays, cadence=cadence, seed=seed)
+
+    base = None
+    for n in sorted(chunks, key=lambda n: np.inf if n is None else n, reverse=True):
+        step = len(lc) if n is None else n
+        sf = StreamFinder(**kwargs)
+        events = []
+        for i in range(0, len(lc), step):
+            c = lc.iloc[i:i + step]
+            events = events + sf.add(c.time.values, c.flux.values, c.error.values,
+                                     c.quality.values)
+        events = pd.DataFrame(events + sf.flush(), columns=sf.header)
+
+        if base is None:
+            base = events
+        elif (len(events) != len(base) or
+              not np.allclose(events.values, base.values, equal_nan=True)):
+            raise ValueError('chunks of ' + str(n) + ' points found different flares: ' +
+                             str(len(events)) + ' vs ' + str(len(base)))
+    return True
+
+
+# let this file be called from the terminal directly, to check the flares
+# found don't depend on the chunk size. e.g.:
+# $python stream.py
+# $python stream.py 10 100 1000
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        CheckChunks(chunks=[int(n) for n in sys.argv[1:]] + [None])
+    else:
+        CheckChunks()
+    print('same flares for every chunk size')
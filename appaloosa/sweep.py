@@ -0,0 +1,308 @@
+'''
+Detrend once, detect many times: tune the flare detection parameters
+(FINDflare N1/N2/N3, gapwindow, minsep, the ED68 smoothing) without
+re-running RunLC for every choice.
+
+    sweepfile = sweep.PrepSweep(file='kplr...llc.fits', nfake=100)
+    grid = sweep.ParamGrid(N1=[2, 3, 4], N3=[2, 3, 4], minsep=[1, 3, 5])
+    summary, flares = sweep.RunSweep(sweepfile, grid, nproc=8)
+
+PrepSweep reads the light curve, flattens it, and runs the slow MultiFind
+detrend (MultiModel) on every segment, both for the real data and with
+fake flares injected (once). The models and residuals are saved to
+outfile + '_sweep.h5'. RunSweep then re-runs only the cheap detection step
+(MultiDetect) for each parameter set, in parallel.
+'''
+
+import numpy as np
+import pandas as pd
+import itertools
+from multiprocessing import Pool
+import appaloosa
+import detrend
+from version import __version__
+
+# the detection parameters that can be swept, and their RunLC values
+DEFAULTS = {'N1': 3, 'N2': 1, 'N3': 3, 'gapwindow': 0.1, 'minsep': 3, 'smooth': 3}
+
+
+def ParamGrid(**kwargs):
+    '''
+    Every combination of the given detection parameters, e.g.
+    ParamGrid(N1=[2, 3], N3=[2, 3]) gives 4 parameter sets. Parameters not
+    given are kept at their DEFAULTS.
+
+    Returns
+    -------
+    list of dicts
+    '''
+    keys = sorted(DEFAULTS.keys())
+    for k in kwargs:
+        if k not in DEFAULTS:
+            raise ValueError('Can not sweep over ' + k + ', only: ' + ', '.join(keys))
+
+    values = [np.atleast_1d(kwargs.get(k, DEFAULTS[k])) for k in keys]
+    return [dict(zip(keys, v)) for v in itertools.product(*values)]
+
+
+def PrepSweep(file='', objectid='', ftype='sap', lctype='', dbmode='fits',
+              mode=3, nfake=100, maxgap=0.125, gapwindow=0.1, dofake=True,
+              cachedir='', source=None, outfile='', debug=False):
+    '''
+    Do the slow part of RunLC once: read, flatten, detrend every segment,
+    and inject & detrend fake flares. See RunLC for the options.
+
+    The HDF5 file written has these tables:
+    lc : seg, time, flux, error, flags, model, diff (the real data), and
+         fake_flux, fake_error, fake_model, fake_diff (with the fake flares
+         injected, in relative flux units like FakeFlares)
+    fakes : seg, t0, ampl, dur, ed, s2n of the injected flares
+
+    Returns
+    -------
+    the name of the file, outfile + '_sweep.h5'
+    '''
+    out, objectid, qtr, time, lcflag, exptime, flux_raw, error = \
+        appaloosa.LoadLC(file=file, objectid=objectid, ftype=ftype, lctype=lctype,
+                         dbmode=dbmode, cachedir=cachedir, source=source, debug=debug)
+    if outfile == '':
+        outfile = out
+
+    flux_qtr = detrend.QtrFlat(time, flux_raw, qtr)
+    flux_gap = detrend.GapFlat(time, flux_qtr, maxgap=maxgap)
+    _, dl, dr = detrend.FindGaps(time, maxgap=maxgap)
+
+    npts = len(time)
+    cols = ['model', 'diff', 'fake_flux', 'fake_error', 'fake_model', 'fake_diff']
+    lc = {c: np.zeros(npts) + np.nan for c in cols}
+    seg = np.zeros(npts, dtype='int')
+    fakes = []
+
+    for i in range(len(dl)):
+        s = slice(dl[i], dr[i])
+        seg[s] = i
+
+        model, diff = appaloosa.MultiModel(time[s], flux_gap[s], error[s], mode=mode,
+                                           debug=debug)
+        lc['model'][s] = model
+        lc['diff'][s] = diff
+
+        if dofake is False:
+            continue
+
+        # avoid the flares found with the RunLC parameters, like RunLC does
+        istart, istop = appaloosa.MultiDetect(time[s], flux_gap[s], error[s], lcflag[s],
+                                              model, diff, mode=mode, gapwindow=gapwindow)
+
+        medflux = np.nanmedian(model)
+        fflux = flux_gap[s] / medflux - 1.0
+        ferror = error[s] / medflux
+
+        new_flux, t0, ampl, dur, ed, s2n = \
+            appaloosa.InjectFakes(time[s], fflux, ferror, time[s][istart], time[s][istop],
+                                  nfake=nfake)
+
+        fmodel, fdiff = appaloosa.MultiModel(time[s], new_flux, ferror, mode=mode,
+                                             debug=debug)
+        lc['fake_flux'][s] = new_flux
+        lc['fake_error'][s] = ferror
+        lc['fake_model'][s] = fmodel
+        lc['fake_diff'][s] = fdiff
+
+        fakes.append(pd.DataFrame({'seg': i, 't0': t0, 'ampl': ampl, 'dur': dur,
+                                   'ed': ed, 's2n': s2n}))
+
+    lc['seg'] = seg
+    lc['time'] = time
+    lc['flux'] = flux_gap
+    lc['error'] = error
+    lc['flags'] = lcflag
+
+    if len(fakes) > 0:
+        fakes = pd.concat(fakes, ignore_index=True)
+    else:
+        fakes = pd.DataFrame(columns=['seg', 't0', 'ampl', 'dur', 'ed', 's2n'])
+
+    sweepfile = outfile + '_sweep.h5'
+    store = pd.HDFStore(sweepfile, mode='w')
+    store.put('lc', pd.DataFrame(lc))
+    store.put('fakes', fakes)
+    store.get_storer('lc').attrs.metadata = {'ObjectID': objectid, 'File': file,
+                                             'mode': mode, 'nfake': nfake,
+                                             'dofake': dofake, 'maxgap': maxgap,
+                                             'Appaloosa-Version': __version__}
+    store.close()
+
+    return sweepfile
+
+
+def LoadSweep(sweepfile):
+    '''
+    Read the file from PrepSweep
+
+    Returns
+    -------
+    (lc table, fakes table, metadata dict)
+    '''
+    store = pd.HDFStore(sweepfile, mode='r')
+    lc = store['lc']
+    fakes = store['fakes']
+    metadata = store.get_storer('lc').attrs.metadata
+    store.close()
+    return lc, fakes, metadata
+
+
+def SweepOne(lc, fakes, metadata, params, stats=False):
+    '''
+    Run the detection (MultiDetect) and fake flare recovery on a prepared
+    light curve, for one set of parameters (see ParamGrid)
+
+    Parameters
+    ----------
+    lc, fakes, metadata :
+        from LoadSweep
+    params : dict
+        the detection parameters, missing ones are set from DEFAULTS
+    stats : bool, optional
+        Also measure the FlareStats of every flare (slow). Default is False,
+        which gives just the start/stop of each flare
+
+    Returns
+    -------
+    (summary dict, flare table)
+    '''
+    p = dict(DEFAULTS)
+    p.update(params)
+    mode = metadata['mode']
+
+    time = lc['time'].values
+    seg = lc['seg'].values
+    cols = {c: lc[c].values for c in lc.columns}
+
+    useg, first = np.unique(seg, return_index=True)
+    last = np.append(first[1:], len(seg))
+
+    flares = []
+    nrec = 0
+    nfake = 0
+    ed68 = []
+    ed90 = []
+    for i, i0, i1 in zip(useg, first, last):
+        s = slice(i0, i1)
+        istart, istop = appaloosa.MultiDetect(time[s], cols['flux'][s], cols['error'][s],
+                                              cols['flags'][s], cols['model'][s],
+                                              cols['diff'][s], mode=mode,
+                                              N1=p['N1'], N2=p['N2'], N3=p['N3'],
+                                              gapwindow=p['gapwindow'], minsep=p['minsep'])
+
+        fl = pd.DataFrame({'seg': i, 'istart': istart + i0, 'istop': istop + i0,
+                           't_start': time[s][istart], 't_stop': time[s][istop]})
+        if stats is True and len(istart) > 0:
+            header = appaloosa.FlareStats(time[s], cols['flux'][s], cols['error'][s],
+                                          cols['model'][s], ReturnHeader=True)
+            rows = [appaloosa.FlareStats(time[s], cols['flux'][s], cols['error'][s],
+                                         cols['model'][s], istart=istart[k], istop=istop[k])
+                    for k in range(len(istart))]
+            fl = pd.concat((fl, pd.DataFrame(rows, columns=header).drop(
+                columns=['t_start', 't_stop'])), axis=1)
+        flares.append(fl)
+
+        fk = fakes[fakes['seg'] == i]
+        if len(fk) == 0:
+            continue
+
+        fstart, fstop = appaloosa.MultiDetect(time[s], cols['fake_flux'][s],
+                                              cols['fake_error'][s], cols['flags'][s],
+                                              cols['fake_model'][s], cols['fake_diff'][s],
+                                              mode=mode, N1=p['N1'], N2=p['N2'], N3=p['N3'],
+                                              gapwindow=p['gapwindow'], minsep=p['minsep'])
+        rec_fake, ed_bin_center, rec_bin = \
+            appaloosa.FakeCompleteness(time[s], fstart, fstop, fk['t0'].values,
+                                       fk['ed'].values)
+        ed68_i, ed90_i, _, _ = appaloosa.EDLimits(ed_bin_center, rec_bin, smooth=p['smooth'])
+
+        nrec = nrec + np.sum(rec_fake)
+        nfake = nfake + len(rec_fake)
+        ed68.append(ed68_i)
+        ed90.append(ed90_i)
+
+    flares = pd.concat(flares, ignore_index=True)
+
+    ed68 = np.array(ed68, dtype='float')
+    ed90 = np.array(ed90, dtype='float')
+    summary = dict(p)
+    summary.update({'nflares': flares.shape[0],
+                    'nfake': nfake,
+                    'nrec': int(nrec),
+                    'frac_rec': float(nrec) / nfake if nfake > 0 else np.nan,
+                    # the median limit over segments, -99 = never reached
+                    'ed68': np.median(ed68[ed68 > 0]) if np.sum(ed68 > 0) > 0 else -99,
+                    'ed90': np.median(ed90[ed90 > 0]) if np.sum(ed90 > 0) > 0 else -99})
+    return summary, flares
+
+
+# each worker process reads the sweep file once
+_sweepdata = None
+
+
+def _InitSweep(sweepfile):
+    global _sweepdata
+    _sweepdata = LoadSweep(sweepfile)
+
+
+def _SweepJob(args):
+    # helper for RunSweep, runs one parameter set in a worker
+    k, params, stats = args
+    lc, fakes, metadata = _sweepdata
+    summary, flares = SweepOne(lc, fakes, metadata, params, stats=stats)
+    summary['param_id'] = k
+    flares['param_id'] = k
+    return summary, flares
+
+
+def RunSweep(sweepfile, grid=None, nproc=1, stats=False, outfile=''):
+    '''
+    Run every parameter set in the grid against the prepared light curve
+
+    Parameters
+    ----------
+    sweepfile : str
+        the file from PrepSweep
+    grid : list of dicts, optional
+        from ParamGrid. Default is just the RunLC parameters
+    nproc : int, optional
+        Number of processes to use (Default is 1)
+    stats : bool, optional
+        Also measure the FlareStats of every flare, see SweepOne
+    outfile : str, optional
+        If set, save the summary and flares tables to this HDF5 file
+
+    Returns
+    -------
+    summary : DataFrame with one row per parameter set: the parameters,
+        param_id, nflares, nfake, nrec, frac_rec, ed68, ed90
+    flares : DataFrame of every flare found, for every param_id
+    '''
+    if grid is None:
+        grid = ParamGrid()
+    jobs = [(k, grid[k], stats) for k in range(len(grid))]
+
+    if nproc > 1:
+        pool = Pool(nproc, initializer=_InitSweep, initargs=(sweepfile,))
+        results = pool.map(_SweepJob, jobs)
+        pool.close()
+        pool.join()
+    else:
+        _InitSweep(sweepfile)
+        results = [_SweepJob(j) for j in jobs]
+
+    summary = pd.DataFrame([r[0] for r in results])
+    flares = pd.concat([r[1] for r in results], ignore_index=True)
+
+    if outfile != '':
+        store = pd.HDFStore(outfile, mode='w')
+        store.put('summary', summary)
+        store.put('flares', flares)
+        store.close()
+
+    return summary, flares
@@ -0,0 +1,158 @@
+'''
+Make synthetic, Kepler-like light curves with injected flares of known
+properties. Useful as test data, and for benchmarking the pipeline.
+
+The light curves have quarters, monthly data-downlink gaps, long (30 min)
+or short (1 min) cadence, starspot modulation, red (correlated) noise,
+quality flags and flares made with the aflare model.
+'''
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from aflare import aflare1, aflare1_ed
+
+# Kepler cadences, in days
+LLC = 1765.5 / 60. / 60. / 24.
+SLC = 58.85 / 60. / 60. / 24.
+
+# roughly how Kepler splits up the data, in days
+QTR_LEN = 93.
+MONTH_LEN = QTR_LEN / 3.
+DOWNLINK_GAP = 1.0
+
+# the least data (in days) left between a random gap and the ends of the
+# data or any other gap, so every segment is long enough to detrend
+MIN_SEG = 1.0
+
+
+def SyntheticLC(ndays=30., cadence='llc', nflares=20, flux0=1e4,
+                spot_amp=0.01, spot_per=5., noise=1e-3,
+                red_amp=5e-4, red_tau=0.5, ampl=(0.005, 0.5), fwhm=(2., 60.),
+                badfrac=0.002, tstart=0., seed=None):
+    '''
+    Generate a synthetic light curve
+
+    Parameters
+    ----------
+    ndays : float, optional
+        Total length in days, including gaps (Default is 30)
+    cadence : str, optional
+        'llc' for 30 min, or 'slc' for 1 min cadence (Default is 'llc')
+    nflares : int, optional
+        Number of flares to inject (Default is 20)
+    flux0 : float, optional
+        The median flux of the star (Default is 1e4)
+    spot_amp : float, optional
+        Relative amplitude of the starspot modulation (Default is 0.01)
+    spot_per : float, optional
+        Rotation period in days (Default is 5)
+    noise : float, optional
+        Relative white noise per cadence (Default is 1e-3)
+    red_amp : float, optional
+        Relative amplitude of the red noise (Default is 5e-4)
+    red_tau : float, optional
+        Correlation time of the red noise, in days (Default is 0.5)
+    ampl : tuple, optional
+        Range of flare amplitudes, in relative flux (Default is (0.005, 0.5))
+    fwhm : tuple, optional
+        Range of flare FWHM, in minutes (Default is (2, 60))
+    badfrac : float, optional
+        Fraction of points given bad quality flags (Default is 0.002)
+    tstart : float, optional
+        Time of the first point (Default is 0)
+    seed : int, optional
+        Random seed
+
+    Returns
+    -------
+    lc : DataFrame with columns
+        [time, flux, error, quality, qtr, exptime, flux_true_flare]
+    flares : DataFrame with the true flare properties
+        [t_peak, fwhm, amplitude, Equiv_Dur]. ED is in seconds
+    '''
+    rng = np.random.RandomState(seed)
+
+    if cadence == 'slc':
+        dt = SLC
+    else:
+        dt = LLC
+
+    time = tstart + np.arange(0, ndays, dt)
+
+    # cut out the data-downlink gaps, at the end of each month
+    phase = np.mod(time - tstart, MONTH_LEN)
+    time = time[phase < (MONTH_LEN - DOWNLINK_GAP)]
+    qtr = np.floor((time - tstart) / QTR_LEN)
+
+    # and a few random short gaps, longer than the FindGaps default (3hr),
+    # each at least MIN_SEG from the ends of its stretch of data
+    for k in range(int(ndays / 20.) + 1):
+        width = rng.uniform(0.2, 0.5)
+        seg = np.append(0, np.cumsum(np.diff(time) > 1.5 * dt))
+        first = np.searchsorted(seg, seg, side='left')
+        last = np.searchsorted(seg, seg, side='right') - 1
+        ok = ((time - time[first]) >= MIN_SEG) & ((time[last] - time) >= MIN_SEG + width)
+        if not np.any(ok):
+            # too short for another gap
+            continue
+        t0 = rng.choice(time[ok])
+        time_ok = (time < t0) | (time > t0 + width)
+        time = time[time_ok]
+        qtr = qtr[time_ok]
+
+    n = len(time)
+
+    # starspots: 2 spots at slightly different periods, slowly evolving
+    spots = (spot_amp * np.sin(2. * np.pi * time / spot_per + rng.uniform(0, 2*np.pi)) *
+             (1. + 0.3 * np.sin(2. * np.pi * time / (ndays + 10.))) +
+             0.5 * spot_amp * np.sin(2. * np.pi * time / (spot_per * 1.05) +
+                                     rng.uniform(0, 2*np.pi)))
+
+    # red noise: an AR(1) process with correlation time red_tau
+    a = np.exp(-dt / red_tau)
+    kick = rng.normal(0., red_amp * np.sqrt(1. - a**2.), n)
+    kick[0] = rng.normal(0., red_amp)
+    red = lfilter([1.], [1., -a], kick)
+
+    white = rng.normal(0., noise, n)
+
+    # the flares, avoid the first/last day so they're well sampled
+    tpeak = np.sort(rng.uniform(time[0] + 1., time[-1] - 1., nflares))
+    fwhm_f = rng.uniform(fwhm[0], fwhm[1], nflares) / 60. / 24.
+    ampl_f = np.exp(rng.uniform(np.log(ampl[0]), np.log(ampl[1]), nflares))
+
+    flare_flux = np.zeros(n)
+    ed = np.zeros(nflares)
+    for k in range(nflares):
+        fl = aflare1(time, tpeak[k], fwhm_f[k], ampl_f[k])
+        flare_flux = flare_flux + fl
+        # the exact ED of the template, in seconds
+        ed[k] = aflare1_ed(fwhm_f[k], ampl_f[k], tpeak=tpeak[k], tmin=time[0], tmax=time[-1])
+
+    flux = flux0 * (1. + spots + red + white + flare_flux)
+    error = np.ones(n) * noise * flux0
+
+    # quality flags: some bad (16, 128, 2048), some harmless (1, 4)
+    quality = np.zeros(n, dtype='int')
+    nbad = int(badfrac * n)
+    quality[rng.randint(0, n, nbad)] = rng.choice([16, 128, 2048], nbad)
+    quality[rng.randint(0, n, nbad)] += rng.choice([1, 4], nbad)
+
+    lc = pd.DataFrame({'time': time, 'flux': flux, 'error': error,
+                       'quality': quality, 'qtr': qtr,
+                       'exptime': np.ones(n) * dt,
+                       'flux_true_flare': flare_flux})
+    flares = pd.DataFrame({'t_peak': tpeak, 'fwhm': fwhm_f,
+                           'amplitude': ampl_f, 'Equiv_Dur': ed})
+
+    return lc, flares
+
+
+def WriteTxt(lc, file):
+    '''
+    Save a synthetic light curve as a basic .txt file (time, flux, error),
+    which RunLC can read with dbmode='txt'
+    '''
+    lc[['time', 'flux', 'error']].to_csv(file, index=False)
+    return
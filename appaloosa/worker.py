@@ -0,0 +1,199 @@
+'''
+Run many light curves in one process, e.g. one Condor job per shard (see
+shards.py and condor.PrepWWU) instead of one job per light curve.
+
+Starting a fresh Python, importing numpy/scipy/pandas/astropy/gatspy and
+opening the database for every one of ~a million light curves costs more
+than the flare finding on many of them. A worker pays that once, and
+writes the results of its whole shard to one HDF5 file (tables 'flares',
+'limits' and 'status', see RunLC's store option) instead of 2+ files per
+light curve.
+
+Each light curve's results are first written to their own file in a
+_parts directory (via a temporary file and a rename), and only then marked
+done in the shard's run log (runlog.py). The shard output is rebuilt from
+the parts at the end, the same way. So a job killed part way through never
+leaves a corrupt or partial file behind, and running the same shard again
+only runs the light curves that didn't finish (or that were run with a
+different version or parameters).
+
+    $ python worker.py run1_shards.json 7
+    $ python worker.py --list all_fits.lis 0 1000
+'''
+
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+import hashlib
+import traceback
+import appaloosa
+import shards
+import runlog
+from atomic import AtomicFile
+
+
+def Warmup():
+    '''
+    Import the modules the pipeline only loads when first needed (so they
+    don't slow down a single light curve run), before the first target
+    '''
+    import scipy.optimize
+    import scipy.stats
+    import scipy.signal
+    import scipy.interpolate
+    try:
+        import gatspy.periodic
+        import astropy.io.fits
+    except ImportError:
+        pass
+    return
+
+
+def ShardFiles(manifest='', shard=0, filelist='', start=0, stop=None):
+    '''
+    The light curve files to run: one shard of a manifest (from
+    shards.PlanShards), or the lines start:stop of a file list
+    '''
+    if manifest != '':
+        return shards.ReadManifest(manifest)['shards'][shard]['files']
+
+    files = list(np.loadtxt(filelist, dtype='str', ndmin=1, usecols=(0,)))
+    return files[start:stop]
+
+
+def PartFile(partdir, file):
+    '''
+    Where the results for one light curve go, in a shard's _parts directory
+    '''
+    name = hashlib.sha1(str(file).encode('utf-8')).hexdigest()[0:16]
+    return os.path.join(partdir, name + '.h5')
+
+
+def MergeParts(outfile, parts):
+    '''
+    Combine the results of each light curve (from RunShard) in to one file,
+    with the tables 'flares', 'limits' and 'status'. Written to a temporary
+    file and renamed in to place.
+    '''
+    with AtomicFile(outfile) as tmpfile:
+        with pd.HDFStore(tmpfile, mode='w') as store:
+            for part in parts:
+                if not os.path.isfile(part):
+                    continue
+                with pd.HDFStore(part, mode='r') as ps:
+                    for table in ('flares', 'limits', 'status'):
+                        if '/' + table in ps.keys():
+                            df = ps.select(table)
+                            if len(df) > 0:
+                                appaloosa.StoreAppend(store, table, df)
+    return
+
+
+def RunShard(manifest='', shard=0, filelist='', start=0, stop=None, outfile='',
+             dbmode='fits', nfake=100, force=False, **kwargs):
+    '''
+    Run RunLC on every light curve in a shard, in this process, with all
+    the results going to one HDF5 file.
+
+    Parameters
+    ----------
+    manifest : str, optional
+        The shard manifest (JSON) to take the files from
+    shard : int, optional
+        Which shard of the manifest to run (Default is 0)
+    filelist : str, optional
+        Or, a text file with one light curve per line...
+    start, stop : int, optional
+        ...and the range of lines in it to run
+    outfile : str, optional
+        The output file. Default is the manifest (or file list) name,
+        with _shardN.h5 (or _start-stop.h5) on the end. The run log is
+        the same name with _runlog.db instead of .h5, and the results of
+        each light curve are kept in the directory with _parts instead
+    dbmode, nfake, kwargs : optional
+        Passed to RunLC
+    force : bool, optional
+        Run every light curve, even those the run log says are already
+        done (Default is False)
+
+    Returns
+    -------
+    the output filename. Its 'status' table has a row per light curve
+    with the run time, and the error message if it failed (a failure
+    doesn't stop the rest of the shard, and leaves no flares or limits
+    for that light curve).
+    '''
+    files = ShardFiles(manifest=manifest, shard=shard, filelist=filelist,
+                       start=start, stop=stop)
+
+    if outfile == '':
+        if manifest != '':
+            outfile = os.path.splitext(manifest)[0] + '_shard' + str(shard) + '.h5'
+        else:
+            outfile = (os.path.splitext(filelist)[0] + '_' + str(start) + '-' +
+                       str(stop if stop is not None else 'end') + '.h5')
+
+    partdir = os.path.splitext(outfile)[0] + '_parts'
+    if not os.path.isdir(partdir):
+        try:
+            os.makedirs(partdir)
+        except OSError:
+            pass
+
+    log = runlog.OpenLog(os.path.splitext(outfile)[0] + '_runlog.db')
+    params = dict(kwargs, dbmode=dbmode, nfake=nfake)
+
+    Warmup()
+
+    parts = []
+    for file in files:
+        part = PartFile(partdir, file)
+        parts.append(part)
+
+        key = runlog.Key(file, params)
+        if force is False and runlog.IsDone(log, key) and os.path.isfile(part):
+            continue
+
+        runlog.Record(log, key, 'running')
+        t0 = time.time()
+        error = ''
+
+        # if the job is stopped in here, the part file is left as it was
+        with AtomicFile(part) as tmpfile:
+            store = pd.HDFStore(tmpfile, mode='w')
+            try:
+                try:
+                    appaloosa.RunLC(file=file, dbmode=dbmode, nfake=nfake, store=store,
+                                    **kwargs)
+                except Exception:
+                    # keep going, and record what went wrong for this one
+                    error = traceback.format_exc(limit=3)[-256:]
+                    # but don't keep any results it got part way through
+                    store.close()
+                    store = pd.HDFStore(tmpfile, mode='w')
+
+                status = pd.DataFrame({'wall_sec': [time.time() - t0],
+                                       'ok': [int(error == '')], 'error': [error]})
+                appaloosa.StoreAppend(store, 'status', status, File=file)
+            finally:
+                store.close()
+
+        # only marked done once its results are safely in place
+        runlog.Record(log, key, 'done' if error == '' else 'failed',
+                      wall_sec=time.time() - t0, error=error)
+    log.close()
+
+    MergeParts(outfile, parts)
+    return outfile
+
+
+# let this file be called from the terminal directly. e.g.:
+# $python worker.py run1_shards.json 7
+# $python worker.py --list all_fits.lis 0 1000
+if __name__ == "__main__":
+    if sys.argv[1] == '--list':
+        RunShard(filelist=sys.argv[2], start=int(sys.argv[3]), stop=int(sys.argv[4]))
+    else:
+        RunShard(manifest=sys.argv[1], shard=int(sys.argv[2]))